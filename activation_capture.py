@@ -0,0 +1,147 @@
+import re
+import fnmatch
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+DEFAULT_LAYER_TYPES = (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d)
+REDUCERS = ('mean', 'random_projection', 'subsample', 'flatten')
+
+
+def select_layers(model, patterns=None, num_layers=None, layer_types=DEFAULT_LAYER_TYPES):
+    """
+    (name, module) pairs from model.named_modules(), in forward-definition order.
+
+    patterns: glob patterns over the module names ('wav2vec.encoder.layers.1?'),
+    or regexes prefixed with 're:' ('re:wav2vec\\.encoder\\.layers\\.\\d+$'); a module
+    matching any of them is selected, whatever its type. Without patterns, every
+    module of layer_types. num_layers keeps that many, evenly spaced over depth.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    matchers = []
+    for pattern in patterns or []:
+        if pattern.startswith('re:'):
+            matchers.append(re.compile(pattern[3:]).fullmatch)
+        else:
+            matchers.append(lambda name, pattern=pattern: fnmatch.fnmatchcase(name, pattern))
+
+    layers = [(name, module) for name, module in model.named_modules() if name and
+              (any(match(name) for match in matchers) if matchers else isinstance(module, layer_types))]
+    if num_layers and len(layers) > num_layers:
+        layers = [layers[i] for i in np.unique(np.linspace(0, len(layers) - 1, num_layers).round().astype(int))]
+    return layers
+
+
+def _positions_to_middle(output, module):
+    # -> (batch, positions, features): Conv outputs are (batch, channels, *positions),
+    # the others (Linear, transformer layers) (batch, *positions, features)
+    if output.dim() == 2:
+        return output.unsqueeze(1)
+    if isinstance(module, torch.nn.modules.conv._ConvNd):
+        return output.flatten(2).transpose(1, 2)
+    return output.reshape(output.shape[0], -1, output.shape[-1])
+
+
+class ActivationCapture:
+    """
+    Forward hooks that reduce layer outputs as they are produced.
+
+    Each selected layer's output is reduced on its device right in the hook, so
+    the full (batch, time, features) activation is never kept:
+      mean               mean over time / positions -> (batch, features)
+      random_projection  mean, then a fixed Gaussian projection to projection_dims
+                         (inner products, hence CKA, are approximately preserved)
+      subsample          n_frames evenly spaced time steps -> (batch, n_frames * features);
+                         (batch, features) outputs have no time axis and pass through
+      flatten            the whole output -> (batch, -1), as before (fixed-size inputs only)
+    or any callable (output, module) -> (batch, width).
+
+    The reduced batch is read with pop_batch() after each forward pass, by a
+    streaming consumer such as rsa_utils.LayerSimilarity.
+    """
+    def __init__(self, model, layers=None, num_layers=None, reducer='mean', projection_dims=256, n_frames=8, seed=0):
+        if not callable(reducer) and reducer not in REDUCERS:
+            raise ValueError(f"Invalid reducer. Use one of {REDUCERS} or a callable.")
+        self.layers = select_layers(model, layers, num_layers)
+        self.reducer = reducer
+        self.projection_dims = projection_dims
+        self.n_frames = n_frames
+        self.seed = seed
+        self.batch = OrderedDict()
+        self._projections = {}
+        self._hooks = []
+
+    @classmethod
+    def from_config(cls, config, model, **kwargs):
+        settings = {'layers': config.ACTIVATION_LAYERS, 'num_layers': config.SIMILARITY_LAYERS,
+                    'reducer': config.ACTIVATION_REDUCER, 'seed': config.SEED}
+        return cls(model, **{**settings, **kwargs})
+
+    @property
+    def layer_names(self):
+        return [name for name, _ in self.layers]
+
+    #### hooks
+    def attach(self):
+        if not self._hooks:
+            self._hooks = [module.register_forward_hook(self._hook(name)) for name, module in self.layers]
+        return self
+
+    def detach(self):
+        for h in self._hooks:
+            h.remove()
+        self._hooks = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.detach()
+        return False
+
+    def _hook(self, name):
+        def hook_fn(module, input, output):
+            if isinstance(output, tuple): # e.g. transformer layers: (hidden_states, attentions)
+                output = output[0]
+            if isinstance(output, torch.Tensor):
+                with torch.no_grad():
+                    self.batch[name] = self.reduce(name, module, output.detach())
+        return hook_fn
+
+    #### reduction
+    def _projection(self, name, width, device):
+        key = (name, width)
+        if key not in self._projections:
+            # seeded by layer name: the same projection in every run and process
+            generator = torch.Generator().manual_seed(self.seed + zlib.crc32(name.encode('utf-8')))
+            matrix = torch.randn(width, self.projection_dims, generator=generator) / self.projection_dims ** 0.5
+            self._projections[key] = matrix
+        matrix = self._projections[key]
+        if matrix.device != device:
+            matrix = self._projections[key] = matrix.to(device)
+        return matrix
+
+    def reduce(self, name, module, output):
+        if callable(self.reducer):
+            return self.reducer(output, module)
+        if self.reducer == 'flatten':
+            return output.reshape(output.shape[0], -1)
+        if self.reducer == 'subsample' and output.dim() == 2:
+            return output # one position: subsampling would only repeat it
+        positions = _positions_to_middle(output, module)
+        if self.reducer == 'subsample':
+            index = torch.linspace(0, positions.shape[1] - 1, self.n_frames, device=output.device).round().long()
+            return positions[:, index].reshape(output.shape[0], -1)
+        pooled = positions.float().mean(dim=1)
+        if self.reducer == 'random_projection' and pooled.shape[1] > self.projection_dims:
+            pooled = pooled @ self._projection(name, pooled.shape[1], pooled.device)
+        return pooled
+
+    #### results
+    def pop_batch(self):
+        """The reduced activations of the last forward pass (layer name -> tensor on the model's device)."""
+        batch, self.batch = self.batch, OrderedDict()
+        return batch
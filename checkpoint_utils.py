@@ -0,0 +1,171 @@
+import os
+import re
+import queue
+import shutil
+import threading
+
+import torch
+
+
+def cpu_snapshot(obj):
+    """Copy every tensor in a (nested) state dict to CPU so training can keep updating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, cpu_snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(value) for value in obj)
+    return obj
+
+
+def trainable_state_dict(model):
+    """
+    state_dict without frozen parameters (e.g. the pretrained wav2vec2 encoder).
+    Buffers are kept: they are small and may change in train mode (BatchNorm).
+    """
+    frozen = {name for name, param in model.named_parameters() if not param.requires_grad}
+    return {key: value for key, value in model.state_dict().items() if key not in frozen}
+
+
+def model_state_dict(model, trainable_only=False):
+    return trainable_state_dict(model) if trainable_only else model.state_dict()
+
+
+def load_partial_state_dict(model, state_dict, pretrained=None, model_pretrained=None):
+    """
+    Load a full or trainable-only state dict. Parameters missing from it keep the
+    values the model was built with (the frozen pretrained weights), so a partial
+    state dict is refused when it was saved on top of another pretrained model
+    (pretrained: stored with it, model_pretrained: what the model was built from).
+    """
+    missing = set(model.state_dict()) - set(state_dict)
+    if missing and pretrained is not None and model_pretrained is not None and pretrained != model_pretrained:
+        raise RuntimeError(f"Partial state_dict saved on top of '{pretrained}', but the model was built from "
+                           f"'{model_pretrained}'; {len(missing)} tensors would not match.")
+    result = model.load_state_dict(state_dict, strict=False)
+    if result.unexpected_keys:
+        raise RuntimeError(f"Unexpected keys in state_dict: {result.unexpected_keys[:5]}")
+    if result.missing_keys:
+        print(f'Partial state_dict: {len(result.missing_keys)} tensors kept from the model as built (frozen weights).')
+    return result
+
+
+def atomic_save(obj, path):
+    # a crash mid-write leaves the previous file intact: write aside, then rename
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _history_path(path, tag):
+    stem, ext = os.path.splitext(path)
+    return f'{stem}_e{tag:04d}{ext}'
+
+
+def _keep_history(path, tag, keep_last):
+    # older versions are hard links to files already written: no extra I/O
+    history_path = _history_path(path, tag)
+    if os.path.exists(history_path):
+        os.remove(history_path)
+    try:
+        os.link(path, history_path)
+    except OSError:
+        shutil.copy2(path, history_path)
+
+    stem, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(stem) + r'_e(\d+)' + re.escape(ext) + '$')
+    directory = os.path.dirname(path) or '.'
+    tagged = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            tagged.append((int(match.group(1)), name))
+    tagged.sort()
+    for _, name in tagged[:-keep_last]:
+        os.remove(os.path.join(directory, name))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread.
+
+    save() snapshots the state to CPU on the caller's thread (so later optimizer
+    steps cannot leak into it) and returns; the file is written with atomic_save.
+    With a tag (e.g. the epoch) and keep_last > 1, the last keep_last versions are
+    kept next to `path` as hard links named <stem>_e<tag><ext>.
+    At most max_pending snapshots wait in memory; a further save() blocks until
+    the writer catches up. With asynchronous=False, save() writes in place.
+    """
+    def __init__(self, keep_last=1, max_pending=2, asynchronous=True):
+        self.keep_last = keep_last
+        self.asynchronous = asynchronous
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        if asynchronous:
+            self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+            self._thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(keep_last=config.CKPT_KEEP_LAST, asynchronous=config.CKPT_ASYNC)
+
+    def save(self, state, path, tag=None):
+        self._raise_error()
+        job = (cpu_snapshot(state), path, tag)
+        if self.asynchronous:
+            self._queue.put(job)
+        else:
+            self._write(*job)
+
+    def _write(self, state, path, tag):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        atomic_save(state, path)
+        if tag is not None and self.keep_last > 1:
+            _keep_history(path, tag, self.keep_last)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    self._write(*job)
+            except Exception as e:
+                self.error = e
+                print(f'Error writing checkpoint {job[1]}: {e}')
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background checkpoint write failed') from error
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        if self.asynchronous:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._thread is not None and self._thread.is_alive():
+            # still flush what was queued, but do not mask the original exception
+            self._queue.put(None)
+            self._thread.join()
+        return False
@@ -5,6 +5,7 @@ import datetime
 from collections import namedtuple
 import re
 
+from model_registry import ModelRegistry
 # dropout
 # bath norm
 # optimizer adam
@@ -64,6 +65,21 @@ class Config:
     # monitoring
     N_STEP_FIG: int = 2
     N_EMBEDDINGS: int = 2000 # n of embeddings to show
+    # train_model figures: rendered and logged by a background process (figure_worker.FigureWorker)
+    ASYNC_FIGURES: bool = True
+    FIGURE_QUEUE_SIZE: int = 4 # waiting figure requests; the oldest is dropped when full
+    # embedding figure (projection.EmbeddingProjector): 'pca' (cheap, for frequent logging), 'tsne', 'opentsne', 'umap'
+    EMBEDDING_PROJECTION: str = 'tsne'
+    PROJECTION_PCA_DIMS: int = 50 # PCA pre-reduction before t-SNE / UMAP
+    PROJECTION_REFIT_PCA_EVERY: int = 5 # calls between PCA refits
+    PROJECTION_WARM_START: bool = True # start from the previous epoch's layout
+    # layer similarity figure (rsa_utils.LayerSimilarity), accumulated during evaluation
+    LAYER_SIMILARITY: str = 'cka' # 'cka': minibatch linear CKA, 'rsa': Spearman correlation of RDMs
+    SIMILARITY_LAYERS: int = 12 # hooked layers, evenly spaced over depth
+    # activation_capture.ActivationCapture: which layers and how their outputs are reduced in the hook
+    ACTIVATION_LAYERS = None # glob / 're:' patterns over named_modules, e.g. [r're:wav2vec\.encoder\.layers\.\d+']; None: Linear / Conv
+    ACTIVATION_REDUCER: str = 'mean' # 'mean' (over time), 'random_projection', 'subsample' (time steps), 'flatten'
+    SIMILARITY_BATCHES: int = 8 # evaluation batches accumulated; 0: all
 
     VISUALIZE = False # during training 
     
@@ -71,8 +87,21 @@ class Config:
     
     NUM_EPOCHS: int = 5
     BATCH_SIZE: int = 32
+    # Raw-waveform loaders (wav2vec models): length-bucketed batches, padded to the batch max
+    BUCKET_BY_LENGTH: bool = True
+    BUCKET_SIZE: int = 50 # batches per sorting bucket (fixed BATCH_SIZE only)
+    MAX_TOKENS_PER_BATCH: int = 0 # max padded samples per batch (e.g. 16000*120), 0: fixed BATCH_SIZE
+    MAX_AUDIO_LENGTH: int = 0 # truncate clips (samples at 16 kHz), 0: keep full clip
+    WAVEFORM_STORE: bool = True # decode once into a float16 memmap under DATA_FULL_DIR/waveform_store
+    # DataLoader workers (prepare_dataloaders); workers are seeded from SEED and run 1 torch thread each
+    NUM_WORKERS: int = min(4, os.cpu_count() or 1) # 0: load on the training thread
+    PIN_MEMORY: bool = True # only used when cuda is available
+    PERSISTENT_WORKERS: bool = True # keep workers alive across epochs
+    PREFETCH_FACTOR: int = 2 # batches prefetched per worker
     lr: float = 0.0005 #1e-4 ~ 1e-3
     weight_decay: float = 0.0005 #0.1 # 1e-5 ~ 1e-4
+    BACKBONE_LR_SCALE: float = 0.1 # wav2vec2 lr = lr * BACKBONE_LR_SCALE (top layer)
+    LAYER_DECAY: float = 1.0 # layer-wise lr decay below the top layer, e.g. 0.8; 1.0: off
     # Model settings
     DATA_NAME= "RAVDESS"#_audio_speech"
     MODEL: str = "classifier_only"#"wav2vec_pretrained"#"wav2vec_v2" "classifer" "wav2vec_finetuned"
@@ -81,6 +110,25 @@ class Config:
     # os.path.join('wav2vec_I_fine_tune_best')
     path_pretrained="facebook/wav2vec2-base" # model pretrained
     
+    # Pooling of wav2vec2 frames (wav2vec_pretrained / wav2vec_finetuning)
+    POOLING: str = 'mean' # 'mean', 'attention', 'stats'
+    POOL_LAYERS = None # hidden_states indices for a weighted layer sum, e.g. [6, 9, 12]. Layers above max are dropped
+    
+    # Feature cache (classifier_only): pooled wav2vec2 features stored under DATA_FULL_DIR/feature_cache
+    FEATURE_CACHE: bool = True
+    FEATURE_MODEL_ID: str = "facebook/wav2vec2-base"
+    FEATURE_POOLING: str = 'mean' # 'mean', 'mean_std'
+    # MELD mp4 -> wav (prep_audio)
+    N_PREP_WORKERS: int = os.cpu_count() or 1
+    PREP_SAMPLE_RATE: int = 16000 # written mono at the wav2vec2 rate, no resampling later
+    
+    # Offline extraction (main.py --mode extract)
+    EXTRACT_BATCH_SIZE: int = 16
+    EXTRACT_MAX_TOKENS: int = 16000*160 # max padded samples per batch, 0: no limit
+    EXTRACT_NUM_WORKERS: int = 4 # audio decode processes
+    EXTRACT_NUM_THREADS: int = 0 # torch intra-op threads, 0: torch default
+    EXTRACT_PREFETCH: int = 2 # batches decoded ahead
+    
     ACTIVATION: str = "relu"
     OPTIMIZER: str = "adam"
     # For regul
@@ -94,6 +142,15 @@ class Config:
     
     SCHEDULER: bool = BOOL_REGUL
     GRADIENT_CLIP: bool = BOOL_REGUL
+    GRAD_CLIP_NORM: float = 1.0 # max_norm when GRADIENT_CLIP
+    # Mixed precision / gradient accumulation (train_utils.train_epoch)
+    AMP_DTYPE: str = '' # '', 'bf16' (cuda or cpu), 'fp16' (cuda only, with GradScaler)
+    EFFECTIVE_BATCH_SIZE: int = 0 # samples per optimizer step, accumulated over BATCH_SIZE micro-batches; 0: BATCH_SIZE
+    scaler_state: dict = None # GradScaler state restored by load_checkpoint
+    # Checkpoints (train_model): written on a background thread, atomically (temp file + rename)
+    CKPT_ASYNC: bool = True
+    CKPT_KEEP_LAST: int = 1 # >1: also keep the last K epochs as hard links <ckpt>_e<epoch>.pth
+    CKPT_TRAINABLE_ONLY: bool = True # per-epoch checkpoint without frozen parameters (the pretrained wav2vec2 encoder); best_model_*.pth is always full
     eta_min: float = 1e-4 /100
     
     MODEL_INIT: bool = BOOL_MODEL_INIT # no need for finetuning
@@ -101,6 +158,7 @@ class Config:
     dataset={"RAVDESS": "https://zenodo.org/record/1188976/files/Audio_Speech_Actors_01-24.zip?download=1",
          "MELD": "https://huggingface.co/datasets/declare-lab/MELD/resolve/main/MELD.Raw.tar.gz",
          "MELD_toy": "https://huggingface.co/datasets/declare-lab/MELD/resolve/main/MELD.Raw.tar.gz"}
+    dataset_sha256={"RAVDESS": None, "MELD": None, "MELD_toy": None} # set to verify downloads
     # select_dataset = "RAVDESS"
     
     if DATA_NAME=="MELD_toy":
@@ -145,7 +203,9 @@ class Config:
     TARGET:str ='test'
     
     # Metric
-    EvaluationResult = namedtuple('EvaluationResult', ['loss', 'accuracy', 'precision', 'recall', 'f1', 'labels', 'predictions'])
+    # per_class: precision / recall / f1 / support lists indexed by label (None where not computed)
+    EvaluationResult = namedtuple('EvaluationResult', ['loss', 'accuracy', 'precision', 'recall', 'f1', 'labels', 'predictions', 'per_class'],
+                                  defaults=(None,))
     METRIC_AVG='weighted'
     
     # Wandb settings
@@ -153,10 +213,18 @@ class Config:
     WANDB_PROJECT: str = ''#field(init=False)
     ENTITY: str = "biasdrive-neuromatch"
     id_wandb: str = ""
+    WANDB_MODE = None # wandb.init mode: 'online', 'offline', 'disabled'; None: wandb's default (WANDB_MODE env)
     sweep_id: str =""
+    RUN_ID: str = "" # ModelRegistry run of MODEL_DIR, set by start_run
     IS_SWEEP: bool = False
     SWEEP_NAIVE: bool =True
     N_SWEEP: int = 50
+    # Local sweep (hyperparameter_search.run_local_sweep): no wandb server needed
+    SWEEP_LOCAL: bool = True
+    N_SWEEP_WORKERS: int = max(1, (os.cpu_count() or 1) // 4) # concurrent trials (forked processes, cpu only)
+    SWEEP_THREADS_PER_TRIAL: int = 0 # torch threads per trial, 0: cpu_count // N_SWEEP_WORKERS
+    SWEEP_WANDB_MODE: str = 'disabled' # wandb mode inside trials: 'disabled' or 'offline'
+    FIND_BEST_STACK: int = 64 # find_best: classifier_only checkpoints stacked into one vectorised evaluation pass
     
     model_benchmark='svm'
     C_val: float = 1#0.1
@@ -168,7 +236,7 @@ class Config:
     
     sweep_config = {
         'method': 'bayes',
-        'metric': {'goal': 'maximize', 'name': 'val.loss' },
+        'metric': {'goal': 'minimize', 'name': 'val.loss' },
         'parameters': {
             'lr': {'min': 0.0001, 'max': 0.01},
             'batch_size': {'values': [16, 32, 64, 128]},
@@ -176,7 +244,9 @@ class Config:
             "activation":{"values":['relu', 'leaky_relu', 'gelu']},
             #'optimizer': {'values': ['adam', 'SGD']},
            # 'num_epochs': {'min': 5, 'max': 50},
-        }
+        },
+        # stop weak runs at epochs min_iter * eta**k (wandb hyperband; ASHAScheduler in local sweeps)
+        'early_terminate': {'type': 'hyperband', 'min_iter': 1, 'eta': 3},
     }
     
     CONFIG_DEFAULTS = {
@@ -215,38 +285,46 @@ class Config:
         self.update_path()
         
     def update_path(self):
+        # paths only: the versioned model folder is created and registered by start_run when training starts
         self.DATA_FULL_DIR = os.path.join(self.DATA_DIR, self.DATA_NAME)
         self.WANDB_PROJECT=f"{self.MODEL}_{self.DATA_NAME}"
         #self.WANDB_PROJECT = f"{self.PROJECT_DIR}_{self.MODEL}"#_{date_str}"
-        self.MODEL_DIR = os.path.join(self.MODEL_BASE_DIR, self.WANDB_PROJECT, self.WANDB_PROJECT)
-        
-            # file_name = file_name.replace('best_model_', '')
-        if os.path.exists(self.MODEL_DIR):
-            self.MODEL_DIR = generate_unique_path(self.MODEL_DIR, is_file=False)
-            print(f'New model stuffs will be saved: {self.MODEL_DIR}\n')
-            
-        self.MODEL_RESULTS = os.path.join(self.MODEL_DIR, 'results')
-        self.MODEL_PRE_BASE_DIR = os.path.join(self.MODEL_DIR, 'finetuned')
-        
-        self.MODEL_SAVE_PATH = os.path.join(self.MODEL_DIR, f'best_model_{self.WANDB_PROJECT}.pth')
-        self.CKPT_SAVE_PATH = os.path.join(self.MODEL_DIR, f'checkpoint_{self.WANDB_PROJECT}.pth')
-        self.best_model_info_path = os.path.join(self.MODEL_BASE_DIR, 'best_model_info.txt')
-        
-        if os.path.exists(self.MODEL_SAVE_PATH):
-            self.MODEL_SAVE_PATH = generate_unique_path(self.MODEL_SAVE_PATH, is_file=True)#generate_unique_filename(self.MODEL_SAVE_PATH)
-            self.CKPT_SAVE_PATH = generate_unique_path(self.CKPT_SAVE_PATH, is_file=True)#generate_unique_filename(self.CKPT_SAVE_PATH)
-            print(f'New model will be saved: {self.MODEL_SAVE_PATH}')
-            # file_name, _ = os.path.splitext(os.path.basename(self.MODEL_SAVE_PATH))
+        self.RUN_ID = ''
+        self.set_model_dir(os.path.join(self.MODEL_BASE_DIR, self.WANDB_PROJECT, self.WANDB_PROJECT))
         ####
         #self.path_pretrained = os.path.join(self.MODEL_BASE_DIR, 'wav2vec_I_fine_tune_best')
 
 
         print(f'\n\n##### Current Project Location #####\n-Base Directory: {self.BASE_DIR}\n-Data: {self.DATA_FULL_DIR}\n-Current Model: {self.MODEL_DIR}\n-Current Model name: {self.MODEL_SAVE_PATH}\n\nFigure will be saved per {self.N_STEP_FIG}-step\n')
-        os.makedirs(self.MODEL_DIR, exist_ok=True)
+        os.makedirs(self.DATA_FULL_DIR, exist_ok=True)
+
+    def set_model_dir(self, model_dir):
+        self.MODEL_DIR = model_dir
+        self.MODEL_RESULTS = os.path.join(self.MODEL_DIR, 'results')
+        self.MODEL_PRE_BASE_DIR = os.path.join(self.MODEL_DIR, 'finetuned')
+        self.MODEL_SAVE_PATH = os.path.join(self.MODEL_DIR, f'best_model_{self.WANDB_PROJECT}.pth')
+        self.CKPT_SAVE_PATH = os.path.join(self.MODEL_DIR, f'checkpoint_{self.WANDB_PROJECT}.pth')
+
+    def start_run(self):
+        """New training run: next free <name>_v<k> folder from the model registry, created and registered."""
+        if self.RUN_ID:
+            return self.RUN_ID
+        base_model_dir = os.path.join(self.MODEL_BASE_DIR, self.WANDB_PROJECT, self.WANDB_PROJECT)
+        registry = ModelRegistry.open(self.MODEL_BASE_DIR)
+        version = registry.next_version(self.WANDB_PROJECT)
+        model_dir = base_model_dir if version == 0 else f'{base_model_dir}_v{version}'
+        if os.path.exists(model_dir): # created outside the registry
+            model_dir = generate_unique_path(base_model_dir, is_file=False)
+            match = re.search(r'_v(\d+)$', model_dir)
+            version = int(match.group(1)) if match else 0
+        # the folder is new, so MODEL_SAVE_PATH is free: no probing for _v<k> file names
+        self.set_model_dir(model_dir)
         os.makedirs(self.MODEL_RESULTS, exist_ok=True)
         os.makedirs(self.MODEL_PRE_BASE_DIR, exist_ok=True)
-        os.makedirs(self.DATA_FULL_DIR, exist_ok=True)
-        
+        self.RUN_ID = registry.register_run(self, version)['run_id']
+        print(f'New model stuffs will be saved: {self.MODEL_DIR}\n')
+        return self.RUN_ID
+
     # def __setattr__(self, name:str, value: any) -> None:
     #     if hasattr(self, name):
     #         old_value = getattr(self, name)
@@ -1,38 +1,36 @@
 import os
+import json
+import math
+import random
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import torch
 import torchaudio
 import requests
 import zipfile
-from transformers import Wav2Vec2Processor, Wav2Vec2Model
-from torch.utils.data import Dataset, DataLoader, random_split
-from sklearn.utils import resample
+from torch.utils.data import Dataset, DataLoader, Sampler, TensorDataset, random_split
 from collections import Counter
 
 from tqdm import tqdm
 
 from config import Config
+from feature_extraction import extract_to_cache, load_waveform_16k, get_num_samples_16k, make_length_batches, resample
+from waveform_store import WaveformStore
 import pandas as pd
-import nltk
-import spacy
 import string
 import tarfile
 
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-# preprocess the data (common across all models)
-from sentence_transformers import SentenceTransformer
+# Heavy / optional dependencies (transformers, moviepy, nltk, sklearn) are imported
+# where they are used so that `import data_utils` stays cheap.
 
 # # word2vec
 # #from gensim.models import Word2Vec
 # # url = "https://raw.githubusercontent.com/ataislucky/Data-Science/main/dataset/emotion_train.txt"
-        
-from sklearn.preprocessing import StandardScaler
-import moviepy.editor as mp
-
-import os
-from tqdm import tqdm
-import moviepy.editor as mp
 
 def get_logits_from_output(outputs):
     if isinstance(outputs, dict):
@@ -46,54 +44,103 @@ def get_logits_from_output(outputs):
     else:
         return outputs  # 예상치 못한 형식이지만 그대로 반환
 
+def extract_audio_track(source_path, destination_path, sample_rate=16000):
+    """
+    Decode only the audio stream of a video into a mono wav at `sample_rate`.
+    Written to a temp file and renamed, so an interrupted run never leaves a partial wav.
+    Returns (status, error) with status in 'ok', 'missing_source', 'failed'.
+    """
+    if not os.path.exists(source_path):
+        return 'missing_source', f'{source_path} not found'
+    tmp_path = destination_path + '.part'
+    try:
+        if shutil.which('ffmpeg'):
+            cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', source_path,
+                   '-vn', '-ac', '1', '-ar', str(sample_rate), '-f', 'wav', tmp_path]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                return 'failed', result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f'ffmpeg exit {result.returncode}'
+        else:
+            import moviepy.editor as mp
+            audio = mp.AudioFileClip(source_path, fps=sample_rate)
+            audio.write_audiofile(tmp_path, fps=sample_rate, codec='pcm_s16le', ffmpeg_params=['-ac', '1', '-f', 'wav'], logger=None)
+            audio.close()
+        os.replace(tmp_path, destination_path)
+        return 'ok', ''
+    except Exception as e:
+        return 'failed', str(e)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _extract_audio_job(job):
+    name, source_path, destination_path, sample_rate = job
+    status, error = extract_audio_track(source_path, destination_path, sample_rate)
+    return name, status, error
+
+def read_prep_manifest(manifest_path):
+    done = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    done[entry['file']] = entry
+    return done
+
 def prep_audio(config, text_train_df, destination_base_path, TARGET):  # by Lek Hong
-    
+    """
+    Extract 16 kHz mono wavs from the MELD .mp4 clips listed in text_train_df.
+
+    Clips are converted in a pool of N_PREP_WORKERS processes. Every result is appended
+    to prep_manifest.jsonl in the destination folder, so a rerun only converts files
+    that are not done yet.
+    """
     os.makedirs(destination_base_path, exist_ok=True)
     
     if TARGET == 'train':
         TARGET_SPLIT = 'train_splits'
+    elif TARGET == 'dev':
+        TARGET_SPLIT = 'dev_splits_complete'
     elif TARGET == 'test':
         TARGET_SPLIT = 'output_repeated_splits_test'
     else:
         print('No target specified.')
         return
 
-    for dialogue_id, utterance_id in tqdm(zip(text_train_df["Dialogue_ID"], text_train_df["Utterance_ID"])):
-        # Source and destination paths
-        source_path = os.path.join(config.DATA_DIR, 'MELD.Raw', TARGET, TARGET_SPLIT, f'dia{dialogue_id}_utt{utterance_id}.mp4')
-        destination_path = os.path.join(destination_base_path, f'dia{dialogue_id}_utt{utterance_id}.wav')
-        
-        # Check if the destination audio file already exists
-        if os.path.exists(destination_path):
-            print(f"File {destination_path} already exists. Skipping...")
-            continue
-
-        try:
-            # Load the video file
-            video = mp.VideoFileClip(source_path)
-
-            # Extract the audio
-            audio = video.audio
-
-            if audio is None:
-                print(f"Audio extraction failed for {source_path}. Skipping...")
-                video.close()
-                continue
-
-            # Write the audio to the destination path
-            audio.write_audiofile(destination_path)
-
-            # Close the video and audio objects to release resources
-            audio.close()
-            video.close()
-
-        except Exception as e:
-            print(f"Error processing {source_path}: {e}")
+    manifest_path = os.path.join(destination_base_path, 'prep_manifest.jsonl')
+    done = read_prep_manifest(manifest_path)
+    sample_rate = config.PREP_SAMPLE_RATE
+
+    jobs = []
+    n_skipped = 0
+    for dialogue_id, utterance_id in zip(text_train_df["Dialogue_ID"], text_train_df["Utterance_ID"]):
+        name = f'dia{dialogue_id}_utt{utterance_id}'
+        source_path = os.path.join(config.DATA_DIR, 'MELD.Raw', TARGET, TARGET_SPLIT, f'{name}.mp4')
+        destination_path = os.path.join(destination_base_path, f'{name}.wav')
+        if os.path.exists(destination_path) and done.get(name, {}).get('status', 'ok') == 'ok':
+            n_skipped += 1
             continue
+        jobs.append((name, source_path, destination_path, sample_rate))
+    print(f'Audio extraction: {len(jobs)} to convert, {n_skipped} already done ({config.N_PREP_WORKERS} workers, {sample_rate} Hz mono)')
+    if not jobs:
+        return
 
-        audio.write_audiofile(destination_path)
+    counts = Counter()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, config.N_PREP_WORKERS)) as pool, open(manifest_path, 'a') as manifest:
+        for name, status, error in tqdm(pool.map(_extract_audio_job, jobs, chunksize=4), total=len(jobs), desc="Extracting audio"):
+            counts[status] += 1
+            manifest.write(json.dumps({'file': name, 'status': status, 'error': error, 'sample_rate': sample_rate}) + '\n')
+            manifest.flush()
+            if status != 'ok':
+                print(f'{name}: {status} - {error}')
+    elapsed = time.perf_counter() - start
+    print(f'Audio extraction done in {elapsed:.1f} s ({len(jobs) / max(elapsed, 1e-9):.2f} files/sec): {dict(counts)}')
 
 def extract_features_and_labels(dataloader):
+    if isinstance(dataloader, FeatureTensorLoader):
+        return dataloader.features.cpu().numpy(), dataloader.labels.cpu().numpy()
     all_features = []
     all_labels = []
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -107,9 +154,10 @@ def extract_features_and_labels(dataloader):
             features = features.view(features.size(0), -1)
         all_features.append(features.cpu().numpy())
         all_labels.append(labels.cpu().numpy())
-        return np.vstack(all_features), np.concatenate(all_labels)
+    return np.vstack(all_features), np.concatenate(all_labels)
 
 def prep_data_for_benchmark(data_loader):
+    from sklearn.preprocessing import StandardScaler
     X, y= extract_features_and_labels(data_loader)
     print(f"Shape of X_train: {X.shape}")
 
@@ -162,9 +210,106 @@ class TextDataset(Dataset):
         label = self.labels[idx]
         return features, label
     
-processor = Wav2Vec2Processor.from_pretrained("facebook/wav2vec2-base")
-wav2vec2_model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-base")
-#wav2vec2_model.gradient_checkpointing_enable()
+_PRETRAINED = {} # model_id -> (processor, model), shared by every caller in the process
+_PRETRAINED_LOCK = threading.Lock()
+
+def _reset_pretrained_lock():
+    # a fork taken while another thread holds the lock would leave it locked forever in the child
+    global _PRETRAINED_LOCK
+    _PRETRAINED_LOCK = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pretrained_lock)
+
+def get_wav2vec2(model_id=None):
+    """Return the process-wide (processor, frozen model) pair, loading it on first use."""
+    model_id = model_id or Config.FEATURE_MODEL_ID
+    pair = _PRETRAINED.get(model_id)
+    if pair is None:
+        with _PRETRAINED_LOCK:
+            pair = _PRETRAINED.get(model_id)
+            if pair is None:
+                from transformers import Wav2Vec2Processor, Wav2Vec2Model
+                print(f'Loading wav2vec2 feature extractor: {model_id}')
+                processor = Wav2Vec2Processor.from_pretrained(model_id)
+                model = Wav2Vec2Model.from_pretrained(model_id)
+                model.eval()
+                #model.gradient_checkpointing_enable()
+                pair = (processor, model)
+                _PRETRAINED[model_id] = pair
+    return pair
+
+def download_file(url, destination_path, expected_sha256=None, chunk_size=1 << 20, timeout=60):
+    """
+    Stream `url` to `destination_path` in chunks and return its sha256.
+
+    Bytes go to destination_path + '.part'; an interrupted download is resumed with an
+    HTTP Range request (restarted if the server ignores it). The file is renamed into
+    place only after the checksum matches `expected_sha256` (when given), and the digest
+    is written next to it as .sha256.
+    """
+    part_path = destination_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    hasher = hashlib.sha256()
+
+    with requests.get(url, stream=True, headers=headers, timeout=timeout) as response:
+        if offset and response.status_code == 416: # nothing left to fetch
+            mode = None
+        elif offset and response.status_code == 206:
+            print(f'Resuming download at {offset / 2**20:.1f} MB')
+            mode = 'ab'
+        elif response.status_code == 200:
+            offset = 0
+            mode = 'wb'
+        else:
+            raise IOError(f"Download failed ({response.status_code}): {url}")
+
+        if offset:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+        if mode is not None:
+            total = int(response.headers.get('Content-Length', 0)) + offset
+            with open(part_path, mode) as f, tqdm(total=total or None, initial=offset, unit='B', unit_scale=True, desc="Downloading") as progress_bar:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    progress_bar.update(len(chunk))
+
+    digest = hasher.hexdigest()
+    if expected_sha256 and digest != expected_sha256:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for {url}: expected {expected_sha256}, got {digest}")
+    os.replace(part_path, destination_path)
+    with open(destination_path + '.sha256', 'w') as f:
+        f.write(digest)
+    return digest
+
+def extract_tar_members(tar_path, destination, keep):
+    """Single streaming pass over a (gzip) tar, extracting only members for which keep(name) is True."""
+    n_extracted = 0
+    with tarfile.open(tar_path, 'r:*') as tar:
+        for member in tar:
+            if member.isfile() and keep(member.name):
+                tar.extract(member, path=destination)
+                n_extracted += 1
+    return n_extracted
+
+def _extract_zip_chunk(zip_path, names, destination):
+    # one ZipFile handle per thread; zlib releases the GIL while inflating
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for name in names:
+            zip_ref.extract(name, destination)
+    return len(names)
+
+def extract_zip_members(zip_path, destination, keep, n_workers=1):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        names = [info.filename for info in zip_ref.infolist() if not info.is_dir() and keep(info.filename)]
+    n_workers = max(1, min(n_workers, len(names)))
+    chunks = [names[i::n_workers] for i in range(n_workers)]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return sum(pool.map(lambda chunk: _extract_zip_chunk(zip_path, chunk, destination), chunks))
 
 def download_dataset(config):
     
@@ -183,33 +328,35 @@ def download_dataset(config):
     print(f'Dataset: {config.DATA_NAME}')
     if not os.path.exists(dataset_path):
         print("Downloading dataset...")
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(dataset_path, 'wb') as f:
-                f.write(response.content)
-            print("Download complete.")
-        else:
-            print("Failed to download the dataset.")
+        try:
+            digest = download_file(url, dataset_path, expected_sha256=config.dataset_sha256.get(config.DATA_NAME))
+            print(f"Download complete. sha256: {digest}")
+        except Exception as e:
+            print(f"Failed to download the dataset: {e}")
             return config.DATA_DIR, False
     else:
         print("Dataset already exists. Skipping download.\n")
     TARGET=config.TARGET
     print(extracted_path)
-    if not os.path.exists(extracted_path):
+    if dataset_ext == 'zip':
+        needs_extraction = not os.path.exists(extracted_path)
+    else: # each TARGET split is pulled out of the main archive on demand
+        needs_extraction = not (os.path.exists(os.path.join(extracted_path, f'{TARGET}.tar.gz')) or os.path.exists(os.path.join(extracted_path, TARGET)))
+    if needs_extraction:
         print('Data extraction starts.')
         if dataset_ext == 'zip':
             try:
-                with zipfile.ZipFile(dataset_path, 'r') as zip_ref:
-                    zip_ref.extractall(extracted_path)
-                print("Extracted dataset.")
+                n_files = extract_zip_members(dataset_path, extracted_path, lambda name: name.endswith('.wav'), n_workers=config.N_PREP_WORKERS)
+                print(f"Extracted dataset: {n_files} files.")
             except Exception as e:
                 print(f"Extraction failed: {e}")
                 return config.DATA_DIR, False
         elif dataset_ext =='tar.gz':
+            # only the split archive for TARGET and the label csvs
+            keep = lambda name: name.endswith(f'/{TARGET}.tar.gz') or name.endswith('.csv')
             try:
-                with tarfile.open(dataset_path, 'r:gz') as tar:  # gzip 압축된 tar 파일
-                    tar.extractall(path=config.DATA_DIR)
-                print("Extracted main dataset.")
+                n_files = extract_tar_members(dataset_path, config.DATA_DIR, keep)
+                print(f"Extracted main dataset: {n_files} files.")
                 
             except Exception as e:
                 print(f"Extraction failed - main: {e}")
@@ -223,41 +370,57 @@ def download_dataset(config):
         try:
             path_tar2=os.path.join(extracted_path, f'{TARGET}.tar.gz')
             print(path_tar2)
-                                
-            with tarfile.open(path_tar2, 'r:gz') as tar:  # gzip 압축된 tar 파일
-                path_tar3=os.path.join(extracted_path, f'{TARGET}')
-                print(path_tar3)
-                tar.extractall(path=path_tar3)
-            print("Extracted sub dataset.")
+            path_tar3=os.path.join(extracted_path, f'{TARGET}')
+            print(path_tar3)
+            n_files = extract_tar_members(path_tar2, path_tar3, lambda name: name.endswith('.mp4'))
+            print(f"Extracted sub dataset: {n_files} files.")
             
         except Exception as e:
             print(f"Extraction failed - sub: {e}")
             return config.DATA_DIR, False
     return extracted_path, True
 
-def preprocess_data_meld(data_dir, text_train_df):
-    data = []
-    labels = []
-    count=0
-    for root, _, files in os.walk(data_dir):
-        for file in files:
-            if file.endswith(".wav"):
-                file_path = os.path.join(root, file)
-                data.append(file_path)
+def get_meld_manifest_path(data_dir, label_df):
+    # the manifest depends on the label table (e.g. sampled csv), so its content hash is part of the name
+    signature = hashlib.sha1(pd.util.hash_pandas_object(label_df, index=False).values.tobytes()).hexdigest()[:12]
+    data_dir = os.path.normpath(data_dir)
+    return os.path.join(os.path.dirname(data_dir), f'{os.path.basename(data_dir)}_manifest_{signature}.csv')
 
-                dialogue_id = int(file.split("_")[0][3:])
-                utterance_id = int(file.split("_")[1].split(".")[0][3:])
-                try:
-                    label = text_train_df.loc[(text_train_df["Dialogue_ID"]==dialogue_id) & (text_train_df["Utterance_ID"]==utterance_id), "Emotion"].item()
-                    labels.append(label)
-                except:
-                    print('No file or err')
-                    count+=1
-    print('Total err: ', count)
+def preprocess_data_meld(data_dir, text_train_df, use_manifest=True):
+    """
+    File paths and emotion labels of the MELD .wav files under data_dir.
 
-    if len(data) == 0:
+    Filenames (dia{Dialogue_ID}_utt{Utterance_ID}.wav) are parsed in one pass and joined
+    against the label table indexed by (Dialogue_ID, Utterance_ID). The path/label manifest
+    is saved next to data_dir and reused while data_dir is unchanged.
+    """
+    label_df = text_train_df[["Dialogue_ID", "Utterance_ID", "Emotion"]].drop_duplicates(["Dialogue_ID", "Utterance_ID"])
+    manifest_path = get_meld_manifest_path(data_dir, label_df)
+    if use_manifest and os.path.exists(manifest_path) and os.path.getmtime(manifest_path) >= os.path.getmtime(data_dir):
+        manifest = pd.read_csv(manifest_path)
+        print(f'Loaded MELD manifest ({len(manifest)} files): {manifest_path}')
+        return manifest['path'].to_numpy(), manifest['label'].to_numpy()
+
+    file_paths = [os.path.join(root, file) for root, _, files in os.walk(data_dir) for file in files if file.endswith(".wav")]
+    if len(file_paths) == 0:
         raise ValueError("No valid .wav files found in the dataset.")
-    return np.array(data), np.array(labels)
+
+    ids = pd.Series([os.path.basename(path) for path in file_paths]).str.extract(r'^dia(\d+)_utt(\d+)\.wav$')
+    files_df = pd.DataFrame({'path': file_paths, 'Dialogue_ID': pd.to_numeric(ids[0]), 'Utterance_ID': pd.to_numeric(ids[1])})
+    labels_by_id = label_df.set_index(["Dialogue_ID", "Utterance_ID"])["Emotion"]
+    merged = files_df.join(labels_by_id, on=["Dialogue_ID", "Utterance_ID"])
+
+    unlabeled = merged["Emotion"].isna()
+    if unlabeled.any():
+        examples = ', '.join(os.path.basename(path) for path in merged.loc[unlabeled, 'path'].head(5))
+        print(f'{unlabeled.sum()} of {len(merged)} .wav files have no label and are skipped (e.g. {examples})')
+    manifest = merged.loc[~unlabeled, ['path', 'Emotion']].rename(columns={'Emotion': 'label'})
+    if len(manifest) == 0:
+        raise ValueError("No .wav files in the dataset match the label table.")
+
+    manifest.to_csv(manifest_path, index=False)
+    print(f'Saved MELD manifest ({len(manifest)} files): {manifest_path}')
+    return manifest['path'].to_numpy(), manifest['label'].to_numpy()
 
 def preprocess_data(data_dir):
     data = []
@@ -273,22 +436,31 @@ def preprocess_data(data_dir):
         raise ValueError("No valid .wav files found in the dataset.")
     return np.array(data), np.array(labels)
 
-def extract_features(waveform, sample_rate):
+def pool_hidden_states(hidden_states, pooling='mean'):
+    # hidden_states: (time, hidden)
+    if pooling == 'mean':
+        return hidden_states.mean(dim=0)
+    elif pooling == 'mean_std':
+        return torch.cat([hidden_states.mean(dim=0), hidden_states.std(dim=0)])
+    else:
+        raise ValueError(f"Unknown pooling mode: {pooling}")
+
+def extract_features(waveform, sample_rate, pooling='mean', model_id=None):
+    processor, wav2vec2_model = get_wav2vec2(model_id)
     if waveform.ndim == 2:
         waveform = waveform.mean(dim=0)
-    if sample_rate != 16000:
-        resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)
-        waveform = resampler(waveform)
+    waveform = resample(waveform, sample_rate)
     inputs = processor(waveform, sampling_rate=16000, return_tensors="pt", padding=True)
     with torch.no_grad():
         outputs = wav2vec2_model(**inputs)
-    wav2vec2_features = outputs.last_hidden_state.squeeze(0).mean(dim=0).numpy()
+    wav2vec2_features = pool_hidden_states(outputs.last_hidden_state.squeeze(0), pooling).numpy()
     return wav2vec2_features.reshape(1, -1)  # reshape (1, input_size) 
 
 class AudioDataset(Dataset):
-    def __init__(self, data, labels):
+    def __init__(self, data, labels, pooling='mean'):
         self.data = data
         self.labels = labels
+        self.pooling = pooling
 
     def __len__(self):
         return len(self.data)
@@ -297,8 +469,103 @@ class AudioDataset(Dataset):
         audio_path = self.data[idx]
         label = self.labels[idx]
         waveform, sample_rate = torchaudio.load(audio_path)
-        features = extract_features(waveform, sample_rate)
+        features = extract_features(waveform, sample_rate, self.pooling)
         return features, label
+class WaveformDataset(Dataset):
+    """
+    Raw 16 kHz mono waveforms for the wav2vec models (no padding; see collate_fn).
+    With a WaveformStore, clips are sliced from its memmap instead of decoded and resampled.
+    """
+    def __init__(self, data, labels, max_length=None, store=None):
+        self.data = data
+        self.labels = labels
+        self.max_length = max_length
+        self.store = store
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_lengths(self):
+        if self.store is not None:
+            lengths = self.store.get_lengths(self.data)
+        else:
+            lengths = np.array([get_num_samples_16k(path) for path in self.data])
+        if self.max_length:
+            lengths = np.minimum(lengths, self.max_length)
+        return lengths
+
+    def __getitem__(self, idx):
+        if self.store is not None:
+            waveform = self.store.get(self.data[idx])
+            if self.max_length:
+                waveform = waveform[:self.max_length]
+            waveform = torch.from_numpy(waveform.astype(np.float32)) # only the sliced clip is converted
+        else:
+            waveform = torch.from_numpy(load_waveform_16k(self.data[idx]))
+            if self.max_length:
+                waveform = waveform[:self.max_length]
+        return waveform, self.labels[idx]
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of indices with similar clip lengths.
+
+    With shuffle, indices are permuted, cut into buckets of `bucket_size` batches
+    and sorted by length inside each bucket; the resulting batches are shuffled.
+    With max_tokens > 0 a batch is closed when n_items * longest would exceed it,
+    so batch size adapts to clip length. Those batches are packed from all clips
+    sorted by length (equal lengths in random order) rather than per bucket, so
+    their number depends only on the lengths; with shuffle only their order and
+    ties change between epochs. len() is therefore the same every epoch.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=0, shuffle=True, bucket_size=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.n_batches = self._count_batches()
+
+    def _count_batches(self):
+        n = len(self.lengths)
+        if self.max_tokens > 0:
+            return len(make_length_batches(self.lengths, self.batch_size, self.max_tokens))
+        if not self.shuffle:
+            return math.ceil(n / self.batch_size)
+        bucket_len = self.batch_size * self.bucket_size
+        return sum(math.ceil(min(bucket_len, n - start) / self.batch_size) for start in range(0, n, bucket_len))
+
+    def _make_batches(self, epoch):
+        n = len(self.lengths)
+        if not self.shuffle:
+            return make_length_batches(self.lengths, self.batch_size, self.max_tokens)
+
+        generator = torch.Generator().manual_seed(self.seed + epoch)
+        order = torch.randperm(n, generator=generator).numpy()
+        if self.max_tokens > 0:
+            # stable sort of the permuted lengths: the same length sequence, hence the same batch sizes, every epoch
+            batches = [[int(i) for i in order[batch]] for batch in
+                       make_length_batches(self.lengths[order], self.batch_size, self.max_tokens)]
+        else:
+            bucket_len = self.batch_size * self.bucket_size
+            batches = []
+            for start in range(0, n, bucket_len):
+                bucket = order[start:start + bucket_len]
+                for batch in make_length_batches(self.lengths[bucket], self.batch_size):
+                    batches.append([int(i) for i in bucket[batch]])
+        batch_order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i] for i in batch_order]
+
+    def __iter__(self):
+        batches = self._make_batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return self.n_batches
+
 def collate_fn(batch): 
     if isinstance(batch[0], dict): # if dict
     
@@ -312,10 +579,149 @@ def collate_fn(batch):
     audio_tensors = [torch.tensor(a, dtype=torch.float32) if not isinstance(a, torch.Tensor) else a for a in audio]
     audio_padded = torch.nn.utils.rnn.pad_sequence(audio_tensors, batch_first=True, padding_value=0.0)
     
+    # 1 for real samples, 0 for padding
+    lengths = torch.tensor([a.shape[0] for a in audio_tensors])
+    attention_mask = (torch.arange(audio_padded.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    
     # 레이블을 텐서로 변환
     labels_tensor = torch.tensor(labels, dtype=torch.long)
     
-    return {"audio": audio_padded, "label": labels_tensor}
+    return {"audio": audio_padded, "attention_mask": attention_mask, "label": labels_tensor}
+
+class FeatureTensorLoader:
+    """
+    Loader over dense (N, D) feature / (N,) label tensors for the classifier_only model.
+
+    Batches are slices (or index_select with shuffle) of the two tensors and come
+    out as the same {'audio', 'label'} dicts as collate_fn, with no per-row
+    __getitem__. The order is reshuffled every epoch from seed + epoch.
+    `.dataset` is a TensorDataset view of the same tensors.
+    """
+    def __init__(self, features, labels, batch_size, shuffle=False, seed=0, drop_last=False):
+        self.features = torch.as_tensor(features, dtype=torch.float32)
+        self.labels = torch.as_tensor(np.asarray(labels), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.dataset = TensorDataset(self.features, self.labels)
+
+    @classmethod
+    def from_subset(cls, subset, config, shuffle):
+        # subset of a TensorDataset (random_split): gather its rows once
+        features, labels = subset.dataset.tensors
+        indices = torch.as_tensor(subset.indices, dtype=torch.long)
+        return cls(features[indices], labels[indices], config.BATCH_SIZE, shuffle=shuffle, seed=config.SEED)
+
+    @property
+    def feature_dim(self):
+        return self.features.shape[1]
+
+    def to(self, device):
+        """Keep the whole feature matrix on `device` so batches need no host-to-device copy."""
+        self.features = self.features.to(device)
+        self.labels = self.labels.to(device)
+        self.dataset = TensorDataset(self.features, self.labels)
+        return self
+
+    def with_batch_size(self, batch_size):
+        loader = FeatureTensorLoader.__new__(FeatureTensorLoader)
+        loader.__dict__.update(self.__dict__)
+        loader.batch_size = batch_size
+        return loader
+
+    def __len__(self):
+        n = len(self.features)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.features)
+        stop = n - n % self.batch_size if self.drop_last else n
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            self.epoch += 1
+            order = torch.randperm(n, generator=generator).to(self.features.device)
+            for start in range(0, stop, self.batch_size):
+                idx = order[start:start + self.batch_size]
+                yield {'audio': self.features[idx], 'label': self.labels[idx]}
+        else:
+            for start in range(0, stop, self.batch_size):
+                yield {'audio': self.features[start:start + self.batch_size],
+                       'label': self.labels[start:start + self.batch_size]}
+
+def seed_worker(worker_id):
+    # torch seeds each worker with base_seed + worker_id, base_seed drawn from the loader generator
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+    torch.set_num_threads(1) # one intra-op thread per worker, no oversubscription
+
+def get_loader_kwargs(config, num_workers=None):
+    num_workers = config.NUM_WORKERS if num_workers is None else num_workers
+    kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': config.PIN_MEMORY and torch.cuda.is_available(),
+        'worker_init_fn': seed_worker,
+        'generator': torch.Generator().manual_seed(config.SEED),
+    }
+    if num_workers > 0:
+        kwargs['persistent_workers'] = config.PERSISTENT_WORKERS
+        kwargs['prefetch_factor'] = config.PREFETCH_FACTOR
+    return kwargs
+
+def make_loader(dataset, config, shuffle, lengths=None, num_workers=None):
+    loader_kwargs = get_loader_kwargs(config, num_workers)
+    if lengths is None:
+        return DataLoader(dataset, batch_size=config.BATCH_SIZE, shuffle=shuffle, collate_fn=collate_fn, **loader_kwargs)
+    batch_sampler = LengthBucketBatchSampler(lengths, config.BATCH_SIZE, max_tokens=config.MAX_TOKENS_PER_BATCH,
+                                             shuffle=shuffle, bucket_size=config.BUCKET_SIZE, seed=config.SEED)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **loader_kwargs)
+
+def benchmark_dataloader(dataset, config, worker_counts=(0, 1, 2, 4, 8), n_batches=50, lengths=None):
+    """Time n_batches from a fresh loader per worker count; worker start-up is reported separately."""
+    results = {}
+    for num_workers in worker_counts:
+        loader = make_loader(dataset, config, True, lengths, num_workers=num_workers)
+        start = time.perf_counter()
+        iterator = iter(loader)
+        next(iterator, None)
+        first_batch = time.perf_counter() - start
+        n_samples = 0
+        start = time.perf_counter()
+        for i, batch in enumerate(iterator):
+            if i >= n_batches:
+                break
+            n_samples += len(batch['label'])
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        del iterator, loader
+        results[num_workers] = n_samples / elapsed
+        print(f"num_workers={num_workers}: {results[num_workers]:.1f} samples/sec "
+              f"(first batch {first_batch:.2f} s, {n_samples} samples)")
+    best = max(results, key=results.get)
+    print(f"Fastest: num_workers={best} ({results[best]:.1f} samples/sec)")
+    return results
+
+def benchmark_feature_loader(loader, config, device=None, n_epochs=3):
+    """Time full passes over a FeatureTensorLoader as training uses it: features on the CPU, then on `device`."""
+    placements = [('cpu', torch.device('cpu'))]
+    if device is not None and torch.device(device).type != 'cpu':
+        placements.append((str(device), torch.device(device)))
+    results = {}
+    for name, target in placements:
+        timed = loader.with_batch_size(config.BATCH_SIZE).to(target)
+        start = time.perf_counter()
+        n_samples = 0
+        for _ in range(n_epochs):
+            for batch in timed:
+                n_samples += len(batch['label'])
+        if target.type == 'cuda':
+            torch.cuda.synchronize(target)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        results[name] = n_samples / elapsed
+        print(f"FeatureTensorLoader on {name}: {results[name]:.1f} samples/sec "
+              f"({n_epochs} epochs of {len(timed)} batches, batch size {timed.batch_size})")
+    return results
 
 def prepare_dataloaders(data, labels, config, combine_indices=None, balance=False):
     if combine_indices:
@@ -324,7 +730,16 @@ def prepare_dataloaders(data, labels, config, combine_indices=None, balance=Fals
     if balance:
         data, labels = balance_classes(data, labels)
     
-    full_dataset = AudioDataset(data, labels)
+    raw_audio = config.MODEL in ('wav2vec_pretrained', 'wav2vec_finetuning')
+    if raw_audio:
+        store = WaveformStore.from_config(config, data) if config.WAVEFORM_STORE else None
+        full_dataset = WaveformDataset(data, labels, max_length=config.MAX_AUDIO_LENGTH, store=store)
+    elif config.FEATURE_CACHE:
+        # dense (N, D) feature matrix, extracted once into the cache; batches are tensor slices
+        cache, _ = extract_to_cache(config, data)
+        full_dataset = TensorDataset(torch.from_numpy(cache.get_many(data)), torch.as_tensor(np.asarray(labels)))
+    else:
+        full_dataset = AudioDataset(data, labels, pooling=config.FEATURE_POOLING)
     
     train_size = int(config.RATIO_TRAIN * len(full_dataset))
     val_size = int(config.RATIO_TEST * len(full_dataset))
@@ -343,9 +758,19 @@ def prepare_dataloaders(data, labels, config, combine_indices=None, balance=Fals
         print_label_distribution(val_labels, "Validation")
         print_label_distribution(test_labels, "Test")
     
-    train_loader = DataLoader(train_dataset, batch_size=config.BATCH_SIZE, shuffle=True, collate_fn=collate_fn)
-    val_loader = DataLoader(val_dataset, batch_size=config.BATCH_SIZE, shuffle=False, collate_fn=collate_fn)
-    test_loader = DataLoader(test_dataset, batch_size=config.BATCH_SIZE, shuffle=False, collate_fn=collate_fn)
+    if isinstance(full_dataset, TensorDataset):
+        train_loader = FeatureTensorLoader.from_subset(train_dataset, config, True)
+        val_loader = FeatureTensorLoader.from_subset(val_dataset, config, False)
+        test_loader = FeatureTensorLoader.from_subset(test_dataset, config, False)
+    elif raw_audio and config.BUCKET_BY_LENGTH:
+        lengths = full_dataset.get_lengths()
+        train_loader = make_loader(train_dataset, config, True, lengths[train_dataset.indices])
+        val_loader = make_loader(val_dataset, config, False, lengths[val_dataset.indices])
+        test_loader = make_loader(test_dataset, config, False, lengths[test_dataset.indices])
+    else:
+        train_loader = make_loader(train_dataset, config, True)
+        val_loader = make_loader(val_dataset, config, False)
+        test_loader = make_loader(test_dataset, config, False)
     
     return train_loader, val_loader, test_loader
 
@@ -384,6 +809,7 @@ def combine_labels(config, class_info, labels, combine_indices):
 
 
 def balance_classes(data, labels):
+    from sklearn.utils import resample
     unique_labels = np.unique(labels)
     max_samples = max(Counter(labels).values())
     
@@ -410,6 +836,8 @@ def load_data(config):#, dataset):
 
 #### Text
 def preprocess_text(text):
+    from nltk.corpus import stopwords
+    from nltk.stem import WordNetLemmatizer
       # Initialize stop words and lemmatizer
     stop_words = set(stopwords.words('english'))
     lemmatizer = WordNetLemmatizer()
@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def feature_key(file_path, model_id, pooling):
+    """Content address of a pooled feature: file path + mtime + model id + pooling mode."""
+    file_path = os.path.abspath(file_path)
+    mtime = os.path.getmtime(file_path)
+    token = f"{file_path}|{mtime}|{model_id}|{pooling}"
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk store of pooled wav2vec2 features.
+
+    Rows are written in .npy shards under `cache_dir` and located through
+    index.json (key -> [shard, row]). Shards are opened with mmap_mode='r',
+    so a lookup returns a view into the page cache instead of a copy.
+    """
+    def __init__(self, cache_dir, model_id, pooling='mean', shard_size=4096):
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.pooling = pooling
+        self.shard_size = shard_size
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        self._shards = {}
+        self._pending_keys = []
+        self._pending_rows = []
+
+    @classmethod
+    def from_config(cls, config):
+        cache_dir = os.path.join(config.DATA_FULL_DIR, 'feature_cache')
+        return cls(cache_dir, config.FEATURE_MODEL_ID, config.FEATURE_POOLING)
+
+    def __getstate__(self):
+        # memmaps are reopened lazily in DataLoader workers
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, file_path):
+        return feature_key(file_path, self.model_id, self.pooling)
+
+    def __contains__(self, file_path):
+        return self.key(file_path) in self.index
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.cache_dir, f'shard_{shard_id:05d}.npy')
+
+    def _open_shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.load(self._shard_path(shard_id), mmap_mode='r')
+        return self._shards[shard_id]
+
+    def get(self, file_path):
+        entry = self.index.get(self.key(file_path))
+        if entry is None:
+            return None
+        shard_id, row = entry
+        return self._open_shard(shard_id)[row]
+
+    def get_many(self, file_paths):
+        rows = [self.get(path) for path in file_paths]
+        missing = sum(row is None for row in rows)
+        if missing:
+            raise KeyError(f"{missing} of {len(rows)} files are not in the feature cache: {self.cache_dir}")
+        return np.stack(rows)
+
+    def put(self, file_path, feature):
+        self._pending_keys.append(self.key(file_path))
+        self._pending_rows.append(np.asarray(feature, dtype=np.float32).reshape(-1))
+        if len(self._pending_rows) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_rows:
+            return
+        shard_id = max((entry[0] for entry in self.index.values()), default=-1) + 1
+        shard_path = self._shard_path(shard_id)
+        tmp_path = shard_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.stack(self._pending_rows))
+        os.replace(tmp_path, shard_path)
+
+        for row, key in enumerate(self._pending_keys):
+            self.index[key] = [shard_id, row]
+        self._pending_keys = []
+        self._pending_rows = []
+
+        tmp_index = self.index_path + '.tmp'
+        with open(tmp_index, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_index, self.index_path)
+
+    def missing(self, file_paths):
+        seen = set()
+        missing = []
+        for path in file_paths:
+            key = self.key(path)
+            if key not in self.index and key not in seen:
+                seen.add(key)
+                missing.append(path)
+        return missing
+
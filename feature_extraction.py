@@ -0,0 +1,199 @@
+import math
+import time
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torchaudio
+from tqdm import tqdm
+
+from feature_cache import FeatureCache
+
+TARGET_SAMPLE_RATE = 16000
+
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq, new_freq=TARGET_SAMPLE_RATE):
+    # one Resample per rate pair: the sinc kernel is built once per process, not per clip
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def resample(waveform, orig_freq, new_freq=TARGET_SAMPLE_RATE):
+    if orig_freq == new_freq:
+        return waveform
+    return get_resampler(int(orig_freq), int(new_freq))(waveform)
+
+
+def resample_batch(waveforms, orig_freq, new_freq=TARGET_SAMPLE_RATE):
+    """
+    Resample 1-D clips that share one rate in a single call.
+    Clips are zero-padded to the longest, resampled as a (batch, time) stack and
+    trimmed back to their own output length. The kernel already zero-pads the
+    edges, so the result matches resampling each clip on its own.
+    """
+    if orig_freq == new_freq:
+        return list(waveforms)
+    lengths = [w.shape[-1] for w in waveforms]
+    stacked = torch.nn.utils.rnn.pad_sequence(list(waveforms), batch_first=True)
+    resampled = resample(stacked, orig_freq, new_freq)
+    return [resampled[i, :math.ceil(length * new_freq / orig_freq)] for i, length in enumerate(lengths)]
+
+
+def _load_mono(audio_path):
+    waveform, sample_rate = torchaudio.load(audio_path)
+    if waveform.ndim == 2:
+        waveform = waveform.mean(dim=0)
+    return waveform, sample_rate
+
+
+def load_waveform_16k(audio_path):
+    waveform, sample_rate = _load_mono(audio_path)
+    return resample(waveform, sample_rate).numpy()
+
+
+def load_waveforms_16k(audio_paths):
+    # decode a batch, then resample each group of equal-rate clips together
+    decoded = [_load_mono(path) for path in audio_paths]
+    waveforms = [None] * len(decoded)
+    by_rate = {}
+    for i, (_, sample_rate) in enumerate(decoded):
+        by_rate.setdefault(sample_rate, []).append(i)
+    for sample_rate, idx in by_rate.items():
+        resampled = resample_batch([decoded[i][0] for i in idx], sample_rate)
+        for i, waveform in zip(idx, resampled):
+            waveforms[i] = waveform.numpy()
+    return waveforms
+
+
+def get_num_samples_16k(audio_path):
+    # header only, no decoding
+    info = torchaudio.info(audio_path)
+    return int(info.num_frames * TARGET_SAMPLE_RATE / info.sample_rate)
+
+
+def make_length_batches(lengths, max_batch_size, max_tokens=0):
+    """
+    Group indices of similar length into batches.
+    A batch is closed once it holds max_batch_size items or, if max_tokens > 0,
+    once its padded size (n_items * longest) would exceed max_tokens.
+    """
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    batch = []
+    longest = 0
+    for idx in order:
+        length = lengths[idx]
+        new_longest = max(longest, length)
+        too_many = len(batch) >= max_batch_size
+        too_long = max_tokens > 0 and batch and new_longest * (len(batch) + 1) > max_tokens
+        if too_many or too_long:
+            batches.append(batch)
+            batch, new_longest = [], length
+        batch.append(int(idx))
+        longest = new_longest
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def masked_pool(hidden_states, frame_mask, pooling='mean'):
+    # hidden_states: (batch, time, hidden), frame_mask: (batch, time)
+    mask = frame_mask.unsqueeze(-1).to(hidden_states.dtype)
+    n_frames = mask.sum(dim=1).clamp(min=1)
+    mean = (hidden_states * mask).sum(dim=1) / n_frames
+    if pooling == 'mean':
+        return mean
+    elif pooling == 'mean_std':
+        var = (((hidden_states - mean.unsqueeze(1)) * mask) ** 2).sum(dim=1) / (n_frames - 1).clamp(min=1)
+        return torch.cat([mean, var.sqrt()], dim=-1)
+    else:
+        raise ValueError(f"Unknown pooling mode: {pooling}")
+
+
+def forward_batch(waveforms, processor, model, pooling='mean'):
+    inputs = processor(waveforms, sampling_rate=TARGET_SAMPLE_RATE, return_tensors="pt",
+                       padding=True, return_attention_mask=True)
+    attention_mask = inputs['attention_mask']
+    # group-norm checkpoints (e.g. wav2vec2-base) are trained without attention_mask on zero padding
+    if model.config.feat_extract_norm == 'layer':
+        outputs = model(inputs['input_values'], attention_mask=attention_mask)
+    else:
+        outputs = model(inputs['input_values'])
+    hidden_states = outputs.last_hidden_state
+    frame_lengths = model._get_feat_extract_output_lengths(attention_mask.sum(dim=-1))
+    frame_mask = torch.arange(hidden_states.shape[1]).unsqueeze(0) < frame_lengths.unsqueeze(1)
+    return masked_pool(hidden_states, frame_mask, pooling).numpy()
+
+
+def extract_to_cache(config, file_paths, cache=None):
+    """
+    Batched wav2vec2 feature extraction into the on-disk FeatureCache.
+
+    Each length-sorted batch is decoded and resampled in one process-pool job
+    while the frozen model runs on the previous batch. Returns (cache, stats).
+    """
+    from data_utils import get_wav2vec2
+
+    if cache is None:
+        cache = FeatureCache.from_config(config)
+    missing = cache.missing(file_paths)
+    stats = {'n_utterances': len(missing), 'audio_seconds': 0.0, 'elapsed': 0.0}
+    if not missing:
+        print(f'Feature cache is complete: {len(cache)} entries in {cache.cache_dir}')
+        return cache, stats
+
+    if config.EXTRACT_NUM_THREADS > 0:
+        torch.set_num_threads(config.EXTRACT_NUM_THREADS)
+    processor, model = get_wav2vec2(config.FEATURE_MODEL_ID)
+
+    lengths = np.array([get_num_samples_16k(path) for path in missing])
+    batches = make_length_batches(lengths, config.EXTRACT_BATCH_SIZE, config.EXTRACT_MAX_TOKENS)
+    print(f'Extracting {len(missing)} utterances in {len(batches)} batches '
+          f'({config.EXTRACT_NUM_WORKERS} decode workers, {torch.get_num_threads()} torch threads)')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, config.EXTRACT_NUM_WORKERS)) as pool:
+        pending = deque()
+        batch_iter = iter(batches)
+
+        def submit_next():
+            batch = next(batch_iter, None)
+            if batch is not None:
+                paths = [missing[i] for i in batch]
+                pending.append((paths, pool.submit(load_waveforms_16k, paths)))
+
+        for _ in range(config.EXTRACT_PREFETCH):
+            submit_next()
+
+        with torch.inference_mode(), tqdm(total=len(missing), desc="Extracting features") as progress_bar:
+            while pending:
+                paths, future = pending.popleft()
+                submit_next()
+                waveforms = future.result()
+                features = forward_batch(waveforms, processor, model, cache.pooling)
+                for path, feature in zip(paths, features):
+                    cache.put(path, feature)
+                stats['audio_seconds'] += sum(len(w) for w in waveforms) / TARGET_SAMPLE_RATE
+                progress_bar.update(len(paths))
+    cache.flush()
+    stats['elapsed'] = time.perf_counter() - start
+    return cache, stats
+
+
+def print_throughput(stats):
+    elapsed = max(stats['elapsed'], 1e-9)
+    print(f"\n##### Feature extraction #####\n"
+          f"-Utterances: {stats['n_utterances']}\n"
+          f"-Elapsed: {stats['elapsed']:.1f} s\n"
+          f"-Throughput: {stats['n_utterances'] / elapsed:.2f} utterances/sec "
+          f"({stats['audio_seconds'] / elapsed:.1f} s audio/sec)\n")
+
+
+def run_extraction(config, file_paths):
+    cache, stats = extract_to_cache(config, file_paths)
+    if stats['n_utterances']:
+        print_throughput(stats)
+    print(f'Features stored in {cache.cache_dir} ({len(cache)} entries)')
+    return cache
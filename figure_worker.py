@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+from multiprocessing.connection import Client, Listener
+
+
+def _render_loop(requests, send_result, max_pending):
+    # runs in the worker process: headless backend before pyplot is imported
+    import matplotlib
+    matplotlib.use('Agg')
+    from visualization import render_figure, save_figure
+
+    while True:
+        jobs = [requests.get()]
+        # take everything already waiting; only the newest request per figure is rendered,
+        # and of those the newest max_pending
+        while jobs[-1] is not None:
+            try:
+                jobs.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        stop = jobs[-1] is None
+        latest = {}
+        for job in jobs:
+            if job is not None:
+                latest.pop((job['stage'], job['name']), None)
+                latest[(job['stage'], job['name'])] = job
+        to_render = list(latest.values())[-max_pending:]
+        n_stale = sum(job is not None for job in jobs) - len(to_render)
+        for job in to_render:
+            try:
+                save_figure(render_figure(job), job['path'])
+                send_result({**_summary(job), 'error': None, 'n_stale': n_stale})
+            except Exception as e:
+                send_result({**_summary(job), 'error': f'{type(e).__name__}: {e}', 'n_stale': n_stale})
+            n_stale = 0
+        if stop:
+            return
+
+
+def _worker_main(max_pending):
+    # entry point of the worker process (this file run as a script): it imports
+    # visualization only, never the training script that started it
+    authkey = bytes.fromhex(os.environ.pop('FIGURE_WORKER_AUTHKEY'))
+    with Listener(authkey=authkey) as listener:
+        print(listener.address, flush=True)
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno()) # the parent only reads the address
+        conn = listener.accept()
+
+    requests = queue.Queue()
+
+    def receive():
+        # keeps the connection drained while a figure renders, so submit() never waits
+        while True:
+            try:
+                job = conn.recv()
+            except (EOFError, OSError):
+                job = None
+            requests.put(job)
+            if job is None:
+                return
+
+    threading.Thread(target=receive, daemon=True).start()
+    _render_loop(requests, conn.send, max(1, max_pending))
+    conn.close()
+
+
+def _summary(job):
+    return {key: job[key] for key in ('stage', 'name', 'title', 'epoch', 'path')}
+
+
+class FigureWorker:
+    """
+    Renders figures (visualization.render_figure jobs) in a separate process with
+    the Agg backend, so the training loop only hands over small arrays.
+
+    The worker is this file run as a script, connected through an authenticated
+    multiprocessing.connection socket. When it falls behind, it renders only the
+    newest request per (stage, figure), and of those at most max_pending.
+    Finished figures are logged to wandb from this process by poll() (called each
+    epoch) and close(); wandb attaches them to the current step, with the epoch
+    they show in the caption.
+    """
+    def __init__(self, max_pending=4):
+        authkey = os.urandom(16)
+        # a fresh interpreter running this file: no fork of cuda / threads of the training process,
+        # and no re-import of the training script as multiprocessing's spawn would do
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(max_pending)],
+                                         stdout=subprocess.PIPE, text=True,
+                                         env={**os.environ, 'FIGURE_WORKER_AUTHKEY': authkey.hex()})
+        address = self._process.stdout.readline().strip()
+        self._process.stdout.close()
+        if not address:
+            raise RuntimeError(f'Figure worker failed to start (exit code {self._process.wait()}).')
+        self._conn = Client(address, authkey=authkey)
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_rendered = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_pending=config.FIGURE_QUEUE_SIZE) if config.ASYNC_FIGURES else None
+
+    def submit(self, job):
+        self.n_submitted += 1
+        self._conn.send(job) # a thread of the worker receives it at once; stale requests are dropped there
+
+    def poll(self):
+        """Log the figures rendered so far; never blocks."""
+        from visualization import log_figure
+        while True:
+            try:
+                if self._conn.closed or not self._conn.poll():
+                    return
+                result = self._conn.recv()
+            except (EOFError, OSError): # the worker has exited
+                self._conn.close()
+                return
+            self.n_dropped += result['n_stale']
+            if result['error'] is not None:
+                print(f"(Err) {result['name']} (epoch {result['epoch']}): {result['error']}")
+                continue
+            self.n_rendered += 1
+            print('Figure saved at: ', result['path'])
+            log_figure(result['stage'], result['name'], result['path'], f"{result['title']} (epoch {result['epoch']})")
+
+    def close(self, timeout=300):
+        """Render what is still queued, log it and stop the worker."""
+        if self._process.poll() is None:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            deadline = time.monotonic() + timeout
+            while self._process.poll() is None and time.monotonic() < deadline:
+                self.poll() # keep the result pipe drained while the worker finishes
+                time.sleep(0.1)
+            if self._process.poll() is None:
+                print('Figure worker did not finish in time; terminating it.')
+                self._process.terminate()
+                self._process.wait()
+        self.poll()
+        self._conn.close()
+        print(f'Figures: {self.n_rendered} rendered, {self.n_dropped} stale requests dropped, of {self.n_submitted}.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+if __name__ == '__main__':
+    _worker_main(int(sys.argv[1]))
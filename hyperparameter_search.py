@@ -1,9 +1,23 @@
+import os
+import copy
+import time
+import math
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
 import wandb
 from models import prep_model#, get_model
 from train_utils import train_model, log_metrics, evaluate_baseline
 #from data_utils import prepare_dataloaders
 from visualization import visualize_results#, plot_confusion_matrix
-from data_utils import prep_data_for_benchmark
+from data_utils import prep_data_for_benchmark, FeatureTensorLoader, make_loader
 
 
 def run_hyperparameter_sweep(config, train_loader, val_loader, model=None):
@@ -65,14 +79,12 @@ def run_hyperparameter_sweep(config, train_loader, val_loader, model=None):
         sweep_id = wandb.sweep(config.sweep_config, project=config.WANDB_PROJECT)
         
     else: #config.SWEEP_NAIVE:
-        sweep_id="8lad6k0u" #
-        config.WANDB_PROJECT="NMA_Project_SER_sweep_together_v1_e5"
-        
-        sweep_id = f"{config.ENTITY}/{config.WANDB_PROJECT}/{sweep_id}"
-        
-        
-        sweep_id_full = f"{config.ENTITY}/{config.WANDB_PROJECT}/{sweep_id}"#wandb.sweep
-        config.sweep_id = sweep_id_full
+        if config.sweep_id: # continue an existing sweep ("entity/project/id")
+            sweep_id = config.sweep_id
+        else:
+            sweep_id = wandb.sweep(config.sweep_config, entity=config.ENTITY, project=config.WANDB_PROJECT)
+            sweep_id = f"{config.ENTITY}/{config.WANDB_PROJECT}/{sweep_id}"
+        config.sweep_id = sweep_id
         print(f'\nSweep starts. Sweep id: {sweep_id}\n')
 
         # sweep_id = config.sweep_id
@@ -184,4 +196,426 @@ def run_sweep(config, train_loader, val_loader, model=None):
             visualize_results(config, model, val_loader, device, config.history, 'test')
     
     wandb.agent(sweep_id, function=train_sweep, count=config.N_SWEEP)
-    wandb.finish()
\ No newline at end of file
+    wandb.finish()
+
+
+#### Local sweep (no wandb server): same config.sweep_config schema, trials in a process pool
+
+# sweep parameter name -> Config attribute
+SWEEP_PARAM_ATTRS = {
+    'lr': 'lr',
+    'batch_size': 'BATCH_SIZE',
+    'dropout_rate': 'DROPOUT_RATE',
+    'activation': 'ACTIVATION',
+    'optimizer': 'OPTIMIZER',
+    'weight_decay': 'weight_decay',
+    'num_epochs': 'NUM_EPOCHS',
+}
+
+
+def _param_kind(spec):
+    if 'value' in spec:
+        return 'constant'
+    if 'values' in spec:
+        return 'categorical'
+    distribution = spec.get('distribution')
+    if distribution is None:
+        distribution = 'int_uniform' if isinstance(spec['min'], int) and isinstance(spec['max'], int) else 'uniform'
+    if distribution not in ('uniform', 'int_uniform', 'log_uniform_values'):
+        raise ValueError(f"Unsupported distribution: {distribution}")
+    return distribution
+
+
+def _to_unit(spec, kind, value):
+    # numeric parameters are modelled on [0, 1] (log scale for log_uniform_values)
+    low, high = spec['min'], spec['max']
+    if kind == 'log_uniform_values':
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    return (value - low) / (high - low) if high > low else 0.0
+
+
+def _from_unit(spec, kind, u):
+    low, high = spec['min'], spec['max']
+    u = min(max(u, 0.0), 1.0)
+    if kind == 'log_uniform_values':
+        return float(math.exp(math.log(low) + u * (math.log(high) - math.log(low))))
+    if kind == 'int_uniform':
+        return int(round(low + u * (high - low)))
+    return float(low + u * (high - low))
+
+
+class SearchSpace:
+    """
+    Parameter sampling for a wandb-style sweep_config.
+
+    method 'random': independent draws; 'grid': every combination of `values`
+    (in order, capped at n_trials); 'bayes' / 'tpe': Tree-structured Parzen
+    Estimator, per parameter, after n_startup random trials: completed trials
+    are split into the best `gamma` fraction and the rest, and of n_candidates
+    draws from the good-trial density the one maximising l(x)/g(x) is proposed.
+    """
+    def __init__(self, sweep_config, seed=0, n_startup=10, gamma=0.1, n_candidates=24):
+        self.method = sweep_config.get('method', 'random')
+        if self.method not in ('random', 'grid', 'bayes', 'tpe'):
+            raise ValueError(f"Unknown sweep method: {self.method}")
+        self.parameters = sweep_config['parameters']
+        self.kinds = {name: _param_kind(spec) for name, spec in self.parameters.items()}
+        metric = sweep_config.get('metric', {'name': 'val.loss', 'goal': 'minimize'})
+        self.metric_name = metric['name']
+        self.maximize = metric.get('goal', 'minimize') == 'maximize'
+        self.rng = np.random.default_rng(seed)
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.n_candidates = n_candidates
+        self.observations = [] # (params, value)
+        self._grid = None
+        if self.method == 'grid':
+            continuous = [name for name, kind in self.kinds.items() if kind not in ('constant', 'categorical')]
+            if continuous:
+                raise ValueError(f"Grid search needs 'values' for every parameter: {continuous}")
+            names = list(self.parameters)
+            choices = [self.parameters[n]['values'] if 'values' in self.parameters[n] else [self.parameters[n]['value']] for n in names]
+            self._grid = iter([dict(zip(names, combo)) for combo in itertools.product(*choices)])
+
+    @property
+    def grid_size(self):
+        if self.method != 'grid':
+            return None
+        return int(np.prod([len(spec.get('values', [None])) for spec in self.parameters.values()]))
+
+    def _sample_random(self, name):
+        spec, kind = self.parameters[name], self.kinds[name]
+        if kind == 'constant':
+            return spec['value']
+        if kind == 'categorical':
+            return spec['values'][int(self.rng.integers(len(spec['values'])))]
+        return _from_unit(spec, kind, self.rng.uniform())
+
+    def _sample_tpe(self, name, good, bad):
+        spec, kind = self.parameters[name], self.kinds[name]
+        if kind == 'constant':
+            return spec['value']
+        if kind == 'categorical':
+            values = spec['values']
+            index = {repr(v): i for i, v in enumerate(values)}
+            def density(params):
+                counts = np.ones(len(values))
+                for p in params:
+                    counts[index[repr(p[name])]] += 1
+                return counts / counts.sum()
+            l, g = density(good), density(bad)
+            candidates = self.rng.choice(len(values), size=self.n_candidates, p=l)
+            best = max(candidates, key=lambda i: l[i] / g[i])
+            return values[int(best)]
+
+        def kde(params):
+            centers = np.array([_to_unit(spec, kind, p[name]) for p in params])
+            # Scott's rule, floored so a few near-identical good trials cannot collapse the search
+            bandwidth = max(np.std(centers) * len(centers) ** -0.2, 1 / (1 + len(centers)))
+            return centers, bandwidth
+
+        def log_density(x, centers, bandwidth):
+            # Gaussian mixture over observations plus a uniform prior component on [0, 1]
+            n = len(centers)
+            pdf = np.exp(-0.5 * ((x[:, None] - centers[None, :]) / bandwidth) ** 2).sum(axis=1)
+            pdf = pdf / (n * bandwidth * math.sqrt(2 * math.pi))
+            return np.log(n / (n + 1) * pdf + 1 / (n + 1))
+
+        good_centers, good_bw = kde(good)
+        bad_centers, bad_bw = kde(bad)
+        # candidates from l(x): a kernel around a good trial, or the uniform prior with weight 1/(n+1)
+        picks = self.rng.integers(len(good_centers), size=self.n_candidates)
+        candidates = np.clip(good_centers[picks] + self.rng.normal(0, good_bw, self.n_candidates), 0, 1)
+        from_prior = self.rng.uniform(size=self.n_candidates) < 1 / (len(good_centers) + 1)
+        candidates[from_prior] = self.rng.uniform(size=from_prior.sum())
+        score = log_density(candidates, good_centers, good_bw) - log_density(candidates, bad_centers, bad_bw)
+        return _from_unit(spec, kind, float(candidates[np.argmax(score)]))
+
+    def suggest(self):
+        """Next parameter set, or None when a grid is exhausted."""
+        if self.method == 'grid':
+            return next(self._grid, None)
+        finished = [(p, v) for p, v in self.observations if v is not None and np.isfinite(v)]
+        if self.method == 'random' or len(finished) < max(self.n_startup, 2):
+            return {name: self._sample_random(name) for name in self.parameters}
+        finished.sort(key=lambda pv: -pv[1] if self.maximize else pv[1])
+        n_good = max(1, int(math.ceil(self.gamma * len(finished))))
+        good = [p for p, _ in finished[:n_good]]
+        bad = [p for p, _ in finished[n_good:]] or good
+        return {name: self._sample_tpe(name, good, bad) for name in self.parameters}
+
+    def observe(self, params, value):
+        self.observations.append((params, value))
+
+
+class ASHAScheduler:
+    """
+    Asynchronous successive halving (ASHA) over epochs.
+
+    Rungs are at min_epochs * eta**k epochs (below max_epochs). A trial reaching a
+    rung records its best metric so far there and continues only if that value is
+    in the top 1/eta of everything recorded at the rung, so roughly one in eta
+    trials survives each rung, without waiting for a full bracket to finish.
+    Pass a multiprocessing Manager to share the rung records between trial processes.
+    """
+    def __init__(self, max_epochs, metric_name='val.loss', maximize=False, min_epochs=1, eta=3, manager=None):
+        if eta < 2:
+            raise ValueError(f"ASHA eta must be >= 2, got {eta}")
+        self.max_epochs = max_epochs
+        self.maximize = maximize
+        self.eta = eta
+        self.stage, self.key = metric_name.split('.', 1) if '.' in metric_name else ('val', metric_name)
+        self.rungs = []
+        epoch = max(1, min_epochs)
+        while epoch < max_epochs:
+            self.rungs.append(epoch)
+            epoch *= eta
+        if manager is None:
+            self._records, self._lock = {}, threading.Lock()
+        else:
+            self._records, self._lock = manager.dict(), manager.Lock()
+        for rung in self.rungs:
+            self._records[rung] = []
+
+    @classmethod
+    def from_sweep_config(cls, sweep_config, max_epochs, manager=None):
+        """Built from sweep_config['early_terminate'] (the wandb hyperband keys min_iter / eta); None if absent."""
+        early_terminate = sweep_config.get('early_terminate')
+        if not early_terminate:
+            return None
+        if early_terminate.get('type', 'hyperband') != 'hyperband':
+            raise ValueError(f"Unsupported early_terminate type: {early_terminate['type']}")
+        metric = sweep_config.get('metric', {'name': 'val.loss', 'goal': 'minimize'})
+        return cls(max_epochs, metric['name'], metric.get('goal', 'minimize') == 'maximize',
+                   min_epochs=early_terminate.get('min_iter', 1), eta=early_terminate.get('eta', 3), manager=manager)
+
+    def should_stop(self, epoch, value):
+        if epoch not in self.rungs:
+            return False
+        with self._lock:
+            recorded = list(self._records[epoch]) + [value]
+            self._records[epoch] = recorded # reassigned: Manager dicts do not see in-place appends
+        if self.maximize:
+            return value < np.quantile(recorded, 1 - 1 / self.eta)
+        return value > np.quantile(recorded, 1 / self.eta)
+
+    def epoch_callback(self, on_stop=None):
+        """A train_model epoch_callback for one trial; train_model passes the epochs completed (1, 2, ...), so the trial stops right after its rung epoch."""
+        best = [None]
+        def callback(epoch, train_metrics, val_metrics):
+            value = getattr(train_metrics if self.stage == 'train' else val_metrics, self.key)
+            value = float(value)
+            if best[0] is None or (value > best[0] if self.maximize else value < best[0]):
+                best[0] = value
+            stop = self.should_stop(epoch, best[0])
+            if stop and on_stop is not None:
+                on_stop(epoch)
+            return stop
+        return callback
+
+
+def report_compute_saved(results, max_epochs):
+    """Epochs trained versus running every trial to max_epochs (e.g. with ASHA)."""
+    results = results[results['epochs'] > 0]
+    if results.empty:
+        return
+    run = int(results['epochs'].sum())
+    full = len(results) * max_epochs
+    epoch_time = results['elapsed'].sum() / run
+    n_pruned = int((results['status'] == 'pruned').sum())
+    print(f'\n##### Sweep compute #####\n'
+          f'-Trials: {len(results)} ({n_pruned} stopped early)\n'
+          f'-Epochs trained: {run} / {full} for a full sweep ({1 - run / full:.1%} saved)\n'
+          f'-Trial time: {results["elapsed"].sum() / 60:.1f} min, ~{(full - run) * epoch_time / 60:.1f} min saved\n')
+
+
+# set in the parent before the pool forks, so workers inherit the loaders (and their features) without pickling
+_SWEEP_STATE = {}
+
+
+def _init_trial_worker(n_threads):
+    torch.set_num_threads(n_threads)
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    os.environ['WANDB_MODE'] = _SWEEP_STATE['config'].SWEEP_WANDB_MODE
+
+
+def _trial_loader(loader, config, shuffle):
+    if isinstance(loader, FeatureTensorLoader):
+        return loader.with_batch_size(config.BATCH_SIZE)
+    lengths = getattr(getattr(loader, 'batch_sampler', None), 'lengths', None) # length-bucketed raw-audio loaders
+    return make_loader(loader.dataset, config, shuffle, lengths, num_workers=0)
+
+
+def _metric_of(history, metric_name, maximize):
+    stage, key = metric_name.split('.', 1) if '.' in metric_name else ('val', metric_name)
+    values = history.get(stage, {}).get(key, [])
+    if not values:
+        return float('nan'), 0
+    best_epoch = int(np.argmax(values) if maximize else np.argmin(values))
+    return float(values[best_epoch]), best_epoch + 1
+
+
+def _failed_row(trial_id, params, error):
+    return {'trial': trial_id, **params, 'status': f'failed: {type(error).__name__}: {error}', 'metric': float('nan'),
+            'best_epoch': 0, 'epochs': 0, 'elapsed': 0.0, 'model_path': None}
+
+
+def run_trial(trial_id, params):
+    """One sweep trial on the shared loaders; returns a result row for the results table (also when it fails)."""
+    row = {**_failed_row(trial_id, params, RuntimeError('not run')), 'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        config = copy.deepcopy(_SWEEP_STATE['config'])
+        for name, value in params.items():
+            attr = SWEEP_PARAM_ATTRS.get(name, name)
+            if not hasattr(config, attr):
+                raise ValueError(f"Sweep parameter does not match a Config attribute: {name}")
+            setattr(config, attr, value)
+
+        # per-trial output directory; figures are skipped inside trials
+        config.MODEL_DIR = os.path.join(_SWEEP_STATE['sweep_dir'], f'trial_{trial_id:03d}')
+        config.MODEL_RESULTS = os.path.join(config.MODEL_DIR, 'results')
+        config.MODEL_SAVE_PATH = os.path.join(config.MODEL_DIR, f'best_model_{config.WANDB_PROJECT}.pth')
+        config.CKPT_SAVE_PATH = os.path.join(config.MODEL_DIR, f'checkpoint_{config.WANDB_PROJECT}.pth')
+        row['model_path'] = config.MODEL_SAVE_PATH
+        os.makedirs(config.MODEL_RESULTS, exist_ok=True)
+        config.N_STEP_FIG = config.NUM_EPOCHS + 1
+        config.CUR_MODE = 'sweep'
+        config.IS_SWEEP = False # local trials have no wandb sweep id to store
+        config.WANDB_MODE = config.SWEEP_WANDB_MODE # no network needed: trials are logged to results.csv
+        config.RUN_ID = '' # trials are listed in the sweep's results.csv, not as registry runs
+        config.id_wandb = wandb.util.generate_id()
+        config.global_epoch = 0
+
+        train_loader = _trial_loader(_SWEEP_STATE['train_loader'], config, True)
+        val_loader = _trial_loader(_SWEEP_STATE['val_loader'], config, False)
+        model, optimizer, criterion, device = prep_model(config, train_loader, is_sweep=True)
+        scheduler = _SWEEP_STATE.get('scheduler')
+        epoch_callback = None
+        if scheduler is not None:
+            epoch_callback = scheduler.epoch_callback(on_stop=lambda epoch: row.update(status='pruned'))
+        history, best_val_loss, best_val_acc = train_model(model, train_loader, val_loader, config, device, optimizer, criterion,
+                                                           epoch_callback=epoch_callback)
+        row['metric'], row['best_epoch'] = _metric_of(history, _SWEEP_STATE['metric_name'], _SWEEP_STATE['maximize'])
+        row['epochs'] = len(history['val']['loss'])
+        row['best_val_loss'], row['best_val_acc'] = best_val_loss, best_val_acc
+    except Exception as e:
+        row['status'] = _failed_row(trial_id, params, e)['status']
+    finally:
+        if wandb.run is not None:
+            wandb.finish()
+    row['elapsed'] = time.perf_counter() - start
+    return row
+
+
+def run_local_sweep(config, train_loader, val_loader):
+    """
+    Offline hyperparameter search over config.sweep_config, without a wandb server.
+
+    Up to N_SWEEP_WORKERS trials run at once in forked processes, each limited to
+    SWEEP_THREADS_PER_TRIAL torch threads; the loaders (for classifier_only the
+    cached feature matrix) are inherited from this process, not re-extracted.
+    On cuda the trials run one after another in this process (cuda cannot be forked).
+    Every finished trial is appended to <MODEL_BASE_DIR>/sweeps/<project>_<time>/results.csv.
+    """
+    space = SearchSpace(config.sweep_config, seed=config.SEED)
+    n_trials = config.N_SWEEP if space.grid_size is None else min(config.N_SWEEP, space.grid_size)
+    n_workers = max(1, min(config.N_SWEEP_WORKERS, n_trials))
+    if n_workers > 1 and torch.cuda.is_available():
+        print('cuda available: local sweep trials run sequentially in this process.')
+        n_workers = 1
+    n_threads = config.SWEEP_THREADS_PER_TRIAL or max(1, (os.cpu_count() or 1) // n_workers)
+    manager = multiprocessing.get_context('fork').Manager() if n_workers > 1 else None
+    scheduler = ASHAScheduler.from_sweep_config(config.sweep_config, config.NUM_EPOCHS, manager)
+
+    sweep_dir = os.path.join(config.MODEL_BASE_DIR, 'sweeps', f"{config.WANDB_PROJECT}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(sweep_dir, exist_ok=True)
+    results_path = os.path.join(sweep_dir, 'results.csv')
+    _SWEEP_STATE.update(config=config, train_loader=train_loader, val_loader=val_loader, sweep_dir=sweep_dir,
+                        metric_name=space.metric_name, maximize=space.maximize, scheduler=scheduler)
+    print(f'\nLocal sweep ({space.method}): {n_trials} trials, {n_workers} workers x {n_threads} threads, '
+          f'{config.NUM_EPOCHS} epochs each, {space.metric_name} ({"max" if space.maximize else "min"})\n-Results: {results_path}')
+    if scheduler is not None:
+        print(f'-ASHA: rungs at epochs {scheduler.rungs}, eta={scheduler.eta}')
+    print()
+
+    rows = []
+    def record(params, row):
+        space.observe(params, row['metric'] if row['status'] in ('ok', 'pruned') else None)
+        rows.append(row)
+        pd.DataFrame(rows).to_csv(results_path, index=False)
+        print(f"[trial {row['trial']}] {row['status']} {space.metric_name}={row['metric']:.4f} ({row['elapsed']:.1f} s) {params}")
+
+    start = time.perf_counter()
+    if n_workers == 1:
+        previous_mode = os.environ.get('WANDB_MODE')
+        os.environ['WANDB_MODE'] = config.SWEEP_WANDB_MODE
+        try:
+            for trial_id in range(n_trials):
+                params = space.suggest()
+                if params is None:
+                    break
+                record(params, run_trial(trial_id, params))
+        finally:
+            if previous_mode is None:
+                os.environ.pop('WANDB_MODE', None)
+            else:
+                os.environ['WANDB_MODE'] = previous_mode
+    else:
+        context = multiprocessing.get_context('fork')
+        pool = None
+        pending = {}
+        next_trial = 0
+        held = None # suggested, not yet submitted
+        try:
+            while next_trial < n_trials or pending:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                               initializer=_init_trial_worker, initargs=(n_threads,))
+                # ask as late as possible so TPE sees every finished trial
+                while next_trial < n_trials and len(pending) < n_workers:
+                    params = held if held is not None else space.suggest()
+                    held = None
+                    if params is None:
+                        n_trials = next_trial
+                        break
+                    try:
+                        future = pool.submit(run_trial, next_trial, params)
+                    except BrokenProcessPool: # a worker died since the last wait: submit again to a new pool
+                        held = params
+                        pool.shutdown(wait=False)
+                        pool = None
+                        break
+                    pending[future] = (next_trial, params, pool)
+                    next_trial += 1
+                if not pending:
+                    if held is None:
+                        break
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial_id, params, owner = pending.pop(future)
+                    try:
+                        row = future.result()
+                    except Exception as e: # the worker process died (BrokenProcessPool) or the result did not arrive
+                        row = _failed_row(trial_id, params, e)
+                        if isinstance(e, BrokenProcessPool) and owner is pool:
+                            pool.shutdown(wait=False)
+                            pool = None # the trials still pending fail with it; later trials get a new pool
+                    record(params, row)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            manager.shutdown()
+    elapsed = time.perf_counter() - start
+
+    results = pd.DataFrame(rows)
+    if results.empty:
+        print('No sweep trials were run.')
+        return results
+    results = results.sort_values('metric', ascending=not space.maximize, na_position='last')
+    results.to_csv(results_path, index=False)
+    print(f'\nLocal sweep finished: {len(results)} trials in {elapsed:.1f} s. Top trials:')
+    print(results.head(5).to_string(index=False))
+    report_compute_saved(results, config.NUM_EPOCHS)
+    return results
@@ -5,12 +5,13 @@ import re
 import torch
 import torch.nn as nn
 from config import Config
-from data_utils import load_data, prepare_dataloaders, prep_audio, preprocess_data, preprocess_data_meld
+from data_utils import load_data, prepare_dataloaders, prep_audio, preprocess_data, preprocess_data_meld, benchmark_dataloader, benchmark_feature_loader, FeatureTensorLoader
 from models import list_models, chk_best_model_info, find_best_model, prep_model
 from train_utils import train_model, evaluate_model, load_checkpoint
 from evaluation import compare_models
 from visualization import visualize_results
-from hyperparameter_search import run_hyperparameter_sweep
+from hyperparameter_search import run_hyperparameter_sweep, run_local_sweep
+from feature_extraction import run_extraction
 import pandas as pd
 
 # def generate_unique_filename(filename):
@@ -45,6 +46,21 @@ def init_weights(m):
         nn.init.constant_(m.bias, 0)
 
 
+def load_data_paths(config):
+    data_dir = config.DATA_FULL_DIR
+    if config.DATA_NAME in ("MELD", "MELD_toy"):
+        suffix = '_toy' if config.DATA_NAME == "MELD_toy" else ''
+        text_train_df = pd.read_csv(os.path.join(config.DATA_DIR, f'MELD_train_sampled{suffix}.csv'))
+        data, labels = preprocess_data_meld(os.path.join(data_dir, f'train_audio{suffix}'), text_train_df)
+        dict_label = {v: k for k, v in config.LABELS_EMO_MELD.items()}
+        labels = [dict_label[val] for val in labels]
+        config.LABELS_EMOTION = config.LABELS_EMO_MELD
+    elif config.DATA_NAME == 'RAVDESS':
+        data, labels = preprocess_data(data_dir)
+    else:
+        raise ValueError(f"Unknown dataset: {config.DATA_NAME}")
+    return data, labels
+
 def print_menu():
     print("\n<<< NMA 2024 Emotion Recognition Model >>> - Choose an option:")
     print("0. Download and Prepare Dataset")
@@ -55,7 +71,9 @@ def print_menu():
     print("5. Compare with baseline models")
     print("6. Find best performing model")
     print("7. Exit")
-    return input("Enter your choice (0-7): ")
+    print("8. Extract wav2vec2 features (offline)")
+    print("9. Benchmark DataLoader workers")
+    return input("Enter your choice (0-9): ")
 def main(args=None):
     config = Config()
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -83,6 +101,10 @@ def main(args=None):
             elif choice == '7':
                 print("Exit program.")
                 return
+            elif choice == '8':
+                args = argparse.Namespace(mode='extract')
+            elif choice == '9':
+                args = argparse.Namespace(mode='bench_loader')
             else:
                 print("Something's wrong. Try again.")
                 continue
@@ -114,11 +136,8 @@ def main(args=None):
             label_info_df = pd.read_csv(f'https://raw.githubusercontent.com/declare-lab/MELD/master/data/MELD/{config.TARGET}_sent_emo.csv')
             label_info_df = label_info_df.sample(config.N_SAMPLE, random_state=config.SEED, ignore_index=True)
             data_meld_path=os.path.join(config.extracted_path, f'{config.TARGET}_audio')
-            if not os.path.exists(data_meld_path):
-                print('Audio extraction is needed.')
-                prep_audio(config, label_info_df, data_meld_path, config.TARGET)
-            else:
-                print('Audio extraction from MELD data is done.')
+            # resumable: only clips missing from the prep manifest are converted
+            prep_audio(config, label_info_df, data_meld_path, config.TARGET)
             data, labels = preprocess_data_meld(data_meld_path, label_info_df)
         else:
             data, labels = preprocess_data(data_dir)
@@ -266,15 +285,28 @@ def main(args=None):
         num_epoch_sweep = input("Number of epoch / sweep for Hyperparameter Search: (e.g., 10 5 # 10 epoch / 5 sweep)")
         config.NUM_EPOCHS, config.N_SWEEP = [int(i) for i in num_epoch_sweep.split(' ')]
         print(f'{config.NUM_EPOCHS}-epoch / {config.N_SWEEP}-sweep\n')
-        run_hyperparameter_sweep(config, train_loader, val_loader)
+        select_data = int(input('Select dataset for the sweep.\n1. RAVDESS\n2. MELD\n3. MELD toy\n'))
+        config.DATA_NAME = {1: 'RAVDESS', 2: 'MELD', 3: 'MELD_toy'}[select_data]
+        config.update_path() # data dir, WANDB_PROJECT and model dir follow the selected dataset
+        data, labels = load_data_paths(config)
+        train_loader, val_loader, _ = prepare_dataloaders(data, labels, config)
+        if config.SWEEP_LOCAL:
+            config.IS_SWEEP=False
+            run_local_sweep(config, train_loader, val_loader)
+        else:
+            run_hyperparameter_sweep(config, train_loader, val_loader)
     
     elif args.mode == 'evaluate':
         model, _, criterion, device = prep_model(config, train_loader, is_sweep=False)
         #test_loss, test_metrics 
-        test_loss, test_accuracy, _, _, test_f1, _, _ = evaluate_model(config, model, test_loader, criterion, device)
+        test_outputs = {}
+        test_loss, test_accuracy, _, _, test_f1, _, _, per_class = evaluate_model(config, model, test_loader, criterion, device, outputs=test_outputs)
         
         print(f"Test Loss: {test_loss:.4f}, Accuracy: {test_accuracy:.4f}, F1: {test_f1:.4f}")
-        visualize_results(config, model, test_loader, device, None, 'test')
+        for label, name in sorted(config.LABELS_EMOTION.items()):
+            print(f"  {name:>10}: precision {per_class['precision'][label]:.4f}, recall {per_class['recall'][label]:.4f}, "
+                  f"F1 {per_class['f1'][label]:.4f} ({per_class['support'][label]} samples)")
+        visualize_results(config, model, test_loader, device, None, 'test', outputs=test_outputs)
     
     elif args.mode == 'benchmark':
         data_dir = config.DATA_FULL_DIR
@@ -288,7 +320,31 @@ def main(args=None):
         model, _, criterion, device = prep_model(config, train_loader, is_sweep=False)
         compare_models(model, train_loader, val_loader, test_loader, config, device)
     
+    elif args.mode == 'extract':
+        select_data = int(input('Select dataset for feature extraction.\n1. RAVDESS\n2. MELD\n3. MELD toy\n'))
+        config.DATA_NAME = {1: 'RAVDESS', 2: 'MELD', 3: 'MELD_toy'}[select_data]
+        config.update_path()
+        data, _ = load_data_paths(config)
+        run_extraction(config, data)
+    
+    elif args.mode == 'bench_loader':
+        select_data = int(input('Select dataset for the DataLoader benchmark.\n1. RAVDESS\n2. MELD\n3. MELD toy\n'))
+        config.DATA_NAME = {1: 'RAVDESS', 2: 'MELD', 3: 'MELD_toy'}[select_data]
+        config.update_path()
+        data, labels = load_data_paths(config)
+        train_loader, _, _ = prepare_dataloaders(data, labels, config)
+        if isinstance(train_loader, FeatureTensorLoader): # classifier_only with FEATURE_CACHE: no DataLoader, no workers
+            benchmark_feature_loader(train_loader, config, device=device)
+        else:
+            lengths = getattr(getattr(train_loader, 'batch_sampler', None), 'lengths', None) # set for length-bucketed loaders
+            benchmark_dataloader(train_loader.dataset, config, lengths=lengths)
+    
     elif args.mode == 'find_best':
+        select_data = int(input('Select the test dataset.\n1. RAVDESS\n2. MELD\n3. MELD toy\n'))
+        config.DATA_NAME = {1: 'RAVDESS', 2: 'MELD', 3: 'MELD_toy'}[select_data]
+        config.update_path()
+        data, labels = load_data_paths(config)
+        _, _, test_loader = prepare_dataloaders(data, labels, config)
         best_model_path = find_best_model(config, test_loader, device)
         if best_model_path:
             print(f"Best model found: {best_model_path}")
@@ -300,7 +356,7 @@ def main(args=None):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Emotion Recognition Model")
-    parser.add_argument("--mode", choices=['train', 'sweep', 'evaluate', 'benchmark', 'find_best'],
+    parser.add_argument("--mode", choices=['train', 'sweep', 'evaluate', 'benchmark', 'find_best', 'extract', 'bench_loader'],
                         help="Mode of operation")
     parser.add_argument("--epochs", type=int, default=10, help="Number of epochs")
     parser.add_argument("--sweeps", type=int, default=10, help="Number of sweeps for hyperparameter search")
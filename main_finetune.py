@@ -14,12 +14,14 @@ import gc
 
 from transformers import Wav2Vec2Model, Wav2Vec2ForSequenceClassification
 from config import Config
-from data_utils import preprocess_data_meld
+from data_utils import preprocess_data_meld, collate_fn, LengthBucketBatchSampler
+from feature_extraction import get_num_samples_16k, resample
+from waveform_store import WaveformStore
 from visualization import visualize_results
-from train_utils import log_metrics, evaluate_model
+from train_utils import log_metrics, evaluate_model, train_epoch, make_grad_scaler
 import torch
 
-from models import get_model, print_model_info, unfreeze_layers, EmotionRecognitionModel_v2, EmotionRecognitionWithWav2Vec 
+from models import get_model, print_model_info, unfreeze_layers, build_optimizer, add_unfrozen_params, report_optimizer_memory, EmotionRecognitionModel_v2, EmotionRecognitionWithWav2Vec 
 
 gc.collect()
 torch.cuda.empty_cache()
@@ -59,47 +61,35 @@ def load_and_preprocess_audio(file_path, max_length=80000):
     waveform, sample_rate = torchaudio.load(str(file_path))
     if waveform.ndim == 2:
         waveform = waveform.mean(dim=0)
-    if sample_rate != 16000:
-        resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)
-        waveform = resampler(waveform)
-  
+    waveform = resample(waveform, sample_rate)
+
+    # truncate only; padding to the batch max is done in collate_fn
     if waveform.shape[0] > max_length:
         waveform = waveform[:max_length]
-    else:
-        padding = torch.zeros(max_length - waveform.shape[0])
-        waveform = torch.cat([waveform, padding])
     
     return waveform
 
 class AudioDataset(Dataset):
-    def __init__(self, file_paths, labels):
+    def __init__(self, file_paths, labels, max_length=80000, store=None):
         self.file_paths = [str(path) for path in file_paths]
         self.labels = labels.tolist() if isinstance(labels, np.ndarray) else labels
+        self.max_length = max_length
+        self.store = store # WaveformStore: decoded 16 kHz clips, sliced instead of loaded
 
     def __len__(self):
         return len(self.file_paths)
 
+    def get_lengths(self):
+        if self.store is not None:
+            return np.minimum(self.store.get_lengths(self.file_paths), self.max_length)
+        return np.array([min(get_num_samples_16k(path), self.max_length) for path in self.file_paths])
+
     def __getitem__(self, idx):
-        audio = load_and_preprocess_audio(self.file_paths[idx])
+        if self.store is not None:
+            audio = torch.from_numpy(self.store.get(self.file_paths[idx])[:self.max_length].astype(np.float32))
+        else:
+            audio = load_and_preprocess_audio(self.file_paths[idx], self.max_length)
         return {"audio": audio, "label": self.labels[idx]}
-  
-def collate_fn(batch):
-    if isinstance(batch[0], dict):
-        # 배치 아이템이 딕셔너리 형태일 경우
-        audio = [item['audio'] for item in batch]
-        labels = [item['label'] for item in batch]
-    else:
-        # 배치 아이템이 튜플 형태일 경우
-        audio, labels = zip(*batch)
-    
-    # audio 텐서로 변환 및 패딩
-    audio_tensors = [torch.tensor(a, dtype=torch.float32) if not isinstance(a, torch.Tensor) else a for a in audio]
-    audio_padded = torch.nn.utils.rnn.pad_sequence(audio_tensors, batch_first=True, padding_value=0.0)
-    
-    # 레이블을 텐서로 변환
-    labels_tensor = torch.tensor(labels, dtype=torch.long)
-    
-    return {"audio": audio_padded, "label": labels_tensor}
 def train(model, train_dataloader, val_dataloader, config):
     device = config.device
     best_val_f1 = 0
@@ -107,12 +97,11 @@ def train(model, train_dataloader, val_dataloader, config):
         'train': {'loss': [], 'accuracy': [], 'precision': [], 'recall': [], 'f1': []},
         'val': {'loss': [], 'accuracy': [], 'precision': [], 'recall': [], 'f1': []}
     }
-    optimizer_grouped_parameters = [
-    {'params': model.wav2vec2.parameters(), 'lr': config.lr/10,  'weight_decay':config.weight_decay/10},
-    {'params': model.classifier.parameters(), 'lr': config.lr, 'weight_decay':config.weight_decay}
-    ]
-    optimizer = torch.optim.AdamW(optimizer_grouped_parameters)
+    # trainable parameters only, backbone at lr/10 (BACKBONE_LR_SCALE); grows as layers are unfrozen
+    optimizer = build_optimizer(model, config)
+    report_optimizer_memory(optimizer)
     criterion = nn.CrossEntropyLoss(label_smoothing=config.label_smoothing)
+    scaler = make_grad_scaler(config, device)
     
     for epoch in tqdm(range(config.NUM_EPOCHS)):
         config.global_epoch+=1
@@ -122,31 +111,12 @@ def train(model, train_dataloader, val_dataloader, config):
             unfreeze_layers(model, 9)  # 10번째 에폭 후 9개 레이어 동결 해제
         elif config.global_epoch == 15:
             unfreeze_layers(model, 15)  # 10번째 에폭 후 15개 레이어 동결 해제
-        model.train()
-        total_loss = 0
-        all_preds = []
-        all_labels = []
-        
-        for batch in train_dataloader:
-            audio_input = batch['audio'].to(device)
-            labels = batch['label'].to(device)
-
-            outputs = model(audio_input) # type diff/ SeqClassifier
-            logits = get_logits_from_output(outputs)#outputs.logits#['logits']
-            loss = criterion(logits, labels)
-            
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-            total_loss += loss.item()
-            
-            preds = torch.argmax(logits, dim=1)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-        
-        # Validation
-        train_metrics =  evaluate_model(config, model, train_dataloader, criterion, device)
-        val_metrics =  evaluate_model(config, model, val_dataloader, criterion, device)
+        if config.global_epoch in (5, 10, 15):
+            add_unfrozen_params(optimizer, model, config)
+        # autocast (AMP_DTYPE) and gradient accumulation (EFFECTIVE_BATCH_SIZE) as in train_model
+        train_metrics = train_epoch(config, model, train_dataloader, criterion, optimizer, device, scaler)
+        val_outputs = {} if config.global_epoch % config.N_STEP_FIG == 0 else None # figures reuse this pass
+        val_metrics =  evaluate_model(config, model, val_dataloader, criterion, device, outputs=val_outputs)
             
         # Update history
         for i, metric in enumerate(['loss', 'accuracy', 'precision', 'recall', 'f1']):
@@ -162,9 +132,9 @@ def train(model, train_dataloader, val_dataloader, config):
         log_metrics('train', train_metrics, config.global_epoch)
         log_metrics('val', val_metrics[:5], config.global_epoch)  # val_metrics might have 7 values, we only need first 5
         
-        if config.global_epoch % config.N_STEP_FIG ==0: # visualization for val data
+        if val_outputs is not None: # visualization for val data
             try:
-                visualize_results(config, model, val_dataloader, device, history, 'val')
+                visualize_results(config, model, val_dataloader, device, history, 'val', outputs=val_outputs)
             except Exception as e:
                 print(f"Error during visualization: {e}")         
         
@@ -221,6 +191,8 @@ config.NUM_EPOCHS=num_epochs
 #lr=1e-4
 n_batch = 8 # 74% GPU. 8 is danger high n_batch -> small batch size -> low gpu?
 config.BATCH_SIZE=n_batch
+config.EFFECTIVE_BATCH_SIZE=32 # 4 micro-batches of n_batch per optimizer step
+config.AMP_DTYPE='bf16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else ''
 n_labels = len(config.LABELS_EMO_MELD)
 
 #wav2vec_path = ".models/wav2vec2_finetuned"  # 파인튜닝된 wav2vec2 모델 경로
@@ -239,15 +211,23 @@ dict_label = {v: k for k, v in config.LABELS_EMO_MELD.items()}
 labels=[dict_label[val] for val in labels]
 config.LABELS_EMOTION =config.LABELS_EMO_MELD
 
-dataset = AudioDataset(file_paths, labels)
+store = None
+if config.WAVEFORM_STORE:
+    store = WaveformStore.open_or_build(file_paths, os.path.join(config.DATA_DIR, 'MELD', 'waveform_store'), config.EXTRACT_NUM_WORKERS)
+dataset = AudioDataset(file_paths, labels, store=store)
 
 # 데이터셋 분할
 train_size = int(0.8 * len(dataset))
 val_size = len(dataset) - train_size
 train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
 
-train_dataloader = DataLoader(train_dataset, batch_size=n_batch, shuffle=True, collate_fn=collate_fn)
-val_dataloader = DataLoader(val_dataset, batch_size=n_batch, shuffle=False, collate_fn=collate_fn)
+# length-bucketed batches: similar-length clips together, so little of each batch is padding
+lengths = dataset.get_lengths()
+train_sampler = LengthBucketBatchSampler(lengths[train_dataset.indices], n_batch, max_tokens=config.MAX_TOKENS_PER_BATCH,
+                                         shuffle=True, bucket_size=config.BUCKET_SIZE, seed=config.SEED)
+val_sampler = LengthBucketBatchSampler(lengths[val_dataset.indices], n_batch, max_tokens=config.MAX_TOKENS_PER_BATCH, shuffle=False)
+train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+val_dataloader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=collate_fn)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # model.to(device)
@@ -269,6 +249,7 @@ config.WANDB_PROJECT=config.MODEL+'_'+config.DATA_NAME
 # os.makedirs(path_best, exist_ok=True)
 # print(path_best)
 config.update_path()
+config.start_run()
 print(config.MODEL_PRE_BASE_DIR)
 
 model = Wav2Vec2ForSequenceClassification.from_pretrained(config.path_pretrained, num_labels=n_labels, output_hidden_states=True)
@@ -15,7 +15,8 @@
 # from transformers import Wav2Vec2Processor, Wav2Vec2Model
 
 from config import Config
-from data_utils import load_data
+from data_utils import load_data, get_wav2vec2
+from feature_extraction import resample
 import pandas as pd
 import os
 import numpy as np
@@ -26,7 +27,6 @@ from torch.utils.data import Dataset, DataLoader, random_split
 
 # speech
 import torchaudio
-from transformers import Wav2Vec2Processor, Wav2Vec2Model
 
 RANDOM_STATE = 2024
 # fetch file paths and labels for speech data
@@ -49,12 +49,6 @@ def preprocess_data_meld(data_dir, text_train_df):
     return np.array(data), np.array(labels)
 # wav2vec
 
-# Import the Wav2Vec2Processor class from the transformers library using a pre-trained model
-processor = Wav2Vec2Processor.from_pretrained("facebook/wav2vec2-base")
-
-# Import the Wav2Vec2Model class from the transformers library using a pre-trained model
-wav2vec2_model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-base")
-
 # Define a function to extract features from the waveform with a given sample rate
 def extract_speech_features(waveform, sample_rate):
 
@@ -65,14 +59,11 @@ def extract_speech_features(waveform, sample_rate):
     if waveform.ndim == 2:
         waveform = waveform.mean(dim=0)
 
-    # If the sample rate of the waveform is not 16000 Hz, resample it to 16000 Hz
-    if sample_rate != 16000:
-
-        # Create a resampler object to convert the waveform's sample rate to 16000 Hz
-        resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)
+    # Resample to 16000 Hz with the shared resampler (its kernel is built once per sample rate)
+    waveform = resample(waveform, sample_rate)
 
-        # Apply the resampler to the waveform
-        waveform = resampler(waveform)
+    # Load wav2vec2 on first use (process-wide, so DataLoader worker forks do not each carry a copy from import)
+    processor, wav2vec2_model = get_wav2vec2("facebook/wav2vec2-base")
 
     # Process the waveform to prepare it for the Wav2Vec2 model, converting it to tensors and padding if necessary
     inputs = processor(waveform, sampling_rate=16000, return_tensors="pt", padding=True)
@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+import numpy as np
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def test_set_signature(config, test_loader):
+    # results are only comparable on the same test split: hash what defines it
+    hasher = hashlib.sha1(f'{config.DATA_NAME}|{len(test_loader.dataset)}'.encode('utf-8'))
+    if hasattr(test_loader, 'features'): # FeatureTensorLoader: the features themselves
+        hasher.update(test_loader.features.cpu().numpy().tobytes())
+        hasher.update(test_loader.labels.cpu().numpy().tobytes())
+    elif hasattr(test_loader.dataset, 'indices'): # Subset of the full dataset (random_split)
+        hasher.update(np.asarray(test_loader.dataset.indices, dtype=np.int64).tobytes())
+    return hasher.hexdigest()[:16]
+
+
+# hyperparameters stored with each run
+RUN_PARAMS = ('MODEL', 'DATA_NAME', 'lr', 'BATCH_SIZE', 'NUM_EPOCHS', 'DROPOUT_RATE', 'ACTIVATION', 'OPTIMIZER',
+              'weight_decay', 'POOLING', 'FEATURE_POOLING', 'n_unfreeze', 'SEED')
+
+_REGISTRIES = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Metadata of every run and evaluated checkpoint under MODEL_BASE_DIR, in one JSONL file.
+
+    The file is append-only; each line is a record:
+      run         run_id, name (WANDB_PROJECT), version, paths, MODEL, DATA_NAME, params
+      run_update  run_id and the fields to change (e.g. best_val_loss, saved)
+      hash        path, size, mtime_ns, sha1 of a checkpoint file
+      evaluation  sha1, test_set signature, path, MODEL, DATA_NAME and test metrics
+    The records are folded into dicts in memory, so the next version of a name,
+    the best model for a dataset and a cached evaluation are dict lookups.
+    Lines appended by other processes (e.g. sweep trials) are read on the next call.
+    A missing registry is created once from the existing model folders.
+    """
+    def __init__(self, registry_path, model_base_dir=None):
+        self.registry_path = registry_path
+        self.runs = {}
+        self.run_by_path = {}
+        self.versions = {}
+        self.hashes = {}
+        self.evaluations = {}
+        self.best = {} # (DATA_NAME, MODEL, test_set) -> evaluation with the lowest test loss
+        self.latest_test_set = {} # (DATA_NAME, MODEL) -> test_set of the most recent evaluation
+        self._offset = 0
+        self._lock = threading.RLock()
+        if not os.path.exists(registry_path) and model_base_dir is not None:
+            self._import_existing(model_base_dir)
+        self._refresh()
+
+    @classmethod
+    def open(cls, model_base_dir):
+        """One registry per file per process (the in-memory cache)."""
+        registry_path = os.path.join(model_base_dir, 'model_registry.jsonl')
+        with _REGISTRIES_LOCK:
+            if registry_path not in _REGISTRIES:
+                _REGISTRIES[registry_path] = cls(registry_path, model_base_dir)
+            return _REGISTRIES[registry_path]
+
+    @classmethod
+    def from_config(cls, config):
+        return cls.open(config.MODEL_BASE_DIR)
+
+    #### file
+    def _refresh(self):
+        with self._lock:
+            if not os.path.exists(self.registry_path) or os.path.getsize(self.registry_path) <= self._offset:
+                return
+            with open(self.registry_path, 'r') as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith('\n'): # a record still being written
+                        break
+                    self._offset += len(line.encode('utf-8'))
+                    if line.strip():
+                        self._apply(json.loads(line))
+
+    def _append(self, record):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.registry_path) or '.', exist_ok=True)
+            # one write() in append mode: concurrent writers do not interleave lines
+            with open(self.registry_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self._refresh() # applies this record and any appended before it by other processes
+        return record
+
+    def _apply(self, record):
+        kind = record['kind']
+        if kind == 'run':
+            self.runs[record['run_id']] = dict(record)
+            self.run_by_path[record['model_path']] = record['run_id']
+            self.versions[record['name']] = max(self.versions.get(record['name'], -1), record['version'])
+        elif kind == 'run_update':
+            run = self.runs.get(record['run_id'])
+            if run is not None:
+                if 'model_path' in record:
+                    self.run_by_path[record['model_path']] = record['run_id']
+                run.update({key: value for key, value in record.items() if key not in ('kind', 'run_id')})
+        elif kind == 'hash':
+            self.hashes[record['path']] = record
+        elif kind == 'evaluation':
+            self.evaluations[self._evaluation_key(record['sha1'], record['test_set'])] = record
+            # losses are only comparable on the same test split
+            key = (record['DATA_NAME'], record['MODEL'], record['test_set'])
+            if key not in self.best or record['loss'] < self.best[key]['loss']:
+                self.best[key] = record
+            self.latest_test_set[key[:2]] = record['test_set']
+
+    def _import_existing(self, model_base_dir):
+        # <MODEL_BASE_DIR>/<name>/<name>[_v<k>] folders from before the registry existed
+        if not os.path.isdir(model_base_dir):
+            return
+        print(f'Building model registry from {model_base_dir}')
+        for name in sorted(os.listdir(model_base_dir)):
+            project_dir = os.path.join(model_base_dir, name)
+            if not os.path.isdir(project_dir):
+                continue
+            pattern = re.compile(re.escape(name) + r'(?:_v(\d+))?$')
+            for folder in sorted(os.listdir(project_dir)):
+                match = pattern.match(folder)
+                if not match:
+                    continue
+                model_dir = os.path.join(project_dir, folder)
+                saved = sorted(f for f in os.listdir(model_dir) if 'best_model' in f and f.endswith('.pth'))
+                model_path = os.path.join(model_dir, saved[0] if saved else f'best_model_{name}.pth')
+                # name is f"{MODEL}_{DATA_NAME}"
+                data_name = next((data for data in ('MELD_toy', 'MELD', 'RAVDESS') if name.endswith('_' + data)), None)
+                model = name[:-len(data_name) - 1] if data_name else None
+                self._append({'kind': 'run', 'run_id': uuid.uuid4().hex[:12], 'name': name,
+                              'version': int(match.group(1) or 0), 'model_dir': model_dir, 'model_path': model_path,
+                              'ckpt_path': model_path.replace('best_model', 'checkpoint'),
+                              'MODEL': model, 'DATA_NAME': data_name, 'params': {}, 'saved': bool(saved),
+                              'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(model_dir)))})
+
+    def compact(self):
+        """Rewrite the file with only the current state (one line per run, hash and evaluation)."""
+        with self._lock:
+            self._refresh()
+            records = ([{**run, 'kind': 'run'} for run in self.runs.values()]
+                       + list(self.hashes.values()) + list(self.evaluations.values()))
+            tmp_path = self.registry_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+            os.replace(tmp_path, self.registry_path)
+            self._offset = os.path.getsize(self.registry_path)
+
+    #### runs
+    def next_version(self, name):
+        self._refresh()
+        return self.versions.get(name, -1) + 1
+
+    def register_run(self, config, version):
+        return self._append({'kind': 'run', 'run_id': uuid.uuid4().hex[:12], 'name': config.WANDB_PROJECT,
+                             'version': version, 'model_dir': config.MODEL_DIR, 'model_path': config.MODEL_SAVE_PATH,
+                             'ckpt_path': config.CKPT_SAVE_PATH, 'MODEL': config.MODEL, 'DATA_NAME': config.DATA_NAME,
+                             'params': {name: getattr(config, name, None) for name in RUN_PARAMS}, 'saved': False,
+                             'created_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def update_run(self, run_id, **fields):
+        if run_id not in self.runs:
+            return None
+        return self._append({'kind': 'run_update', 'run_id': run_id, **fields})
+
+    def get_run(self, run_id=None, model_path=None):
+        self._refresh()
+        if run_id is None:
+            run_id = self.run_by_path.get(model_path)
+        return self.runs.get(run_id)
+
+    def saved_models(self):
+        """Model files of runs that saved one, plus every evaluated checkpoint, oldest run first."""
+        self._refresh()
+        paths = [run['model_path'] for run in sorted(self.runs.values(), key=lambda run: run['created_at']) if run.get('saved')]
+        paths += sorted({record['path'] for record in self.evaluations.values()} - set(paths))
+        return paths
+
+    #### checkpoint hashes and test evaluations
+    def sha1(self, path):
+        """sha1 of a file, re-read only when its size or mtime changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha1']
+        digest = file_sha1(path)
+        self._append({'kind': 'hash', 'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest})
+        return digest
+
+    @staticmethod
+    def _evaluation_key(sha1, test_signature):
+        return f'{sha1}:{test_signature}'
+
+    def get_evaluation(self, sha1, test_signature):
+        self._refresh()
+        return self.evaluations.get(self._evaluation_key(sha1, test_signature))
+
+    def log_evaluation(self, sha1, test_signature, path, metrics, model=None, data_name=None):
+        run = self.get_run(model_path=path) or {}
+        return self._append({'kind': 'evaluation', 'sha1': sha1, 'test_set': test_signature, 'path': os.path.abspath(path),
+                             'run_id': run.get('run_id'), 'MODEL': run.get('MODEL') or model,
+                             'DATA_NAME': run.get('DATA_NAME') or data_name, 'evaluated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                             **{name: float(value) for name, value in metrics.items()}})
+
+    def _is_current(self, record):
+        # the file still exists and is the one that was evaluated
+        return os.path.exists(record['path']) and self.sha1(record['path']) == record['sha1']
+
+    def best_model(self, data_name, model, test_set=None):
+        """
+        Evaluation with the lowest test loss for a dataset and model type on one test split
+        (test_set_signature); without test_set, the split evaluated most recently.
+        """
+        self._refresh()
+        test_set = test_set or self.latest_test_set.get((data_name, model))
+        best = self.best.get((data_name, model, test_set))
+        if best is None or self._is_current(best):
+            return best
+        # the best file was deleted or overwritten: next best that is still current
+        candidates = sorted((record for record in self.evaluations.values()
+                             if (record['DATA_NAME'], record['MODEL'], record['test_set']) == (data_name, model, test_set)),
+                            key=lambda record: record['loss'])
+        return next((record for record in candidates if self._is_current(record)), None)
+
+    def to_frame(self, kind='evaluation'):
+        import pandas as pd
+        self._refresh()
+        records = {'run': self.runs.values(), 'evaluation': self.evaluations.values()}[kind]
+        return pd.DataFrame(list(records))
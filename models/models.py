@@ -1,21 +1,21 @@
 import os
+import re
+import inspect
 import torch
 import torch.nn as nn
-from sklearn.svm import SVC
-import joblib
 import wandb
 from train_utils import load_checkpoint
 import numpy as np
 import random
-from torch.optim.lr_scheduler import ReduceLROnPlateau
 from glob import glob
 
-from transformers import Wav2Vec2Model
-from train_utils import evaluate_model
+from train_utils import evaluate_model, autocast_context, metrics_from_confusion
+from feature_extraction import masked_pool
+from checkpoint_utils import load_partial_state_dict, cpu_snapshot
+from model_registry import ModelRegistry, test_set_signature
+from data_utils import FeatureTensorLoader, extract_features_and_labels
 from config import Config
 
-config = Config()
-
 
 
 def set_seed(seed):
@@ -32,7 +32,7 @@ def set_seed(seed):
     return device
 
 def list_models(config):
-    models = glob(os.path.join(config.MODEL_BASE_DIR, '**', '*best_model*.pth'), recursive=True)
+    models = ModelRegistry.from_config(config).saved_models()
     if not models:
         print("No trained models found.")
         return None
@@ -42,98 +42,162 @@ def list_models(config):
     return models
 
 def chk_best_model_info(config):
-    if os.path.exists(config.best_model_info_path):
-        print(f'\n##### Trained model info exists #####\n')
-        with open(config.best_model_info_path, 'r') as f:
-            best_model_info = f.read().strip()
-        
-        best_model_path = None
-        for line in best_model_info.split('\n'):
-            if line.startswith("Best model path:"):
-                best_model_path = line.split(": ", 1)[1].strip()
-                break
-        
-        if best_model_path:
-            config.MODEL_SAVE_PATH = best_model_path
-            config.CKPT_SAVE_PATH = best_model_path.replace("best_model", "checkpoint")
-            print(f"Current best model: {config.MODEL_SAVE_PATH}")
-        else:
-            print("Best model information found, but path is not available.")
-    else:
+    best = ModelRegistry.from_config(config).best_model(config.DATA_NAME, config.MODEL)
+    if best is None:
         print("No best model information found.")
+        return
+    print('\n##### Trained model info exists #####\n')
+    config.MODEL_SAVE_PATH = best['path']
+    config.CKPT_SAVE_PATH = best['path'].replace("best_model", "checkpoint")
+    print(f"Current best model: {config.MODEL_SAVE_PATH}\nTest loss: {best['loss']:.4f}, accuracy: {best['accuracy']:.4f}, F1: {best['f1']:.4f}")
+
+
+def _shared_test_loader(config, test_loader):
+    # classifier_only candidates all read the same backbone features: extract them once
+    if config.MODEL != 'classifier_only' or isinstance(test_loader, FeatureTensorLoader):
+        return test_loader
+    features, labels = extract_features_and_labels(test_loader)
+    return FeatureTensorLoader(features, labels, config.BATCH_SIZE)
+
+
+def _evaluate_checkpoint(config, model, model_path, test_loader, device):
+    load_partial_state_dict(model, torch.load(model_path, map_location=device))
+    model.to(device)
+    model.eval()
+    result = evaluate_model(config, model, test_loader, torch.nn.CrossEntropyLoss(), device)
+    return {'loss': result.loss, 'accuracy': result.accuracy, 'precision': result.precision,
+            'recall': result.recall, 'f1': result.f1}
+
+
+def _evaluate_stacked(config, model, candidates, test_loader, device):
+    """
+    classifier_only candidates evaluated together: their weights are stacked and
+    one vmap'd forward per test batch gives every candidate's logits. Same loss
+    (mean of the batch losses) and metrics as evaluate_model, one pass over the features.
+    """
+    initial_state = cpu_snapshot(model.state_dict())
+    loaded = []
+    for sha1, model_path in candidates:
+        model.load_state_dict(initial_state)
+        try:
+            load_partial_state_dict(model, torch.load(model_path, map_location=device))
+        except Exception as e:
+            print(f"Error evaluating model {model_path}: {str(e)}")
+            continue
+        loaded.append((sha1, model_path, {name: tensor.detach().clone() for name, tensor in
+                                          list(model.named_parameters()) + list(model.named_buffers())}))
+    if not loaded:
+        return []
+    stacked = {name: torch.stack([state[name] for _, _, state in loaded]) for name in loaded[0][2]}
+    param_names = {name for name, _ in model.named_parameters()}
+    params = {name: value for name, value in stacked.items() if name in param_names}
+    buffers = {name: value for name, value in stacked.items() if name not in param_names}
+    forward = torch.func.vmap(lambda p, b, x: torch.func.functional_call(model, (p, b), (x,)), in_dims=(0, 0, None))
+
+    n_candidates, n_classes = len(loaded), len(config.LABELS_EMOTION)
+    labels = test_loader.labels
+    if labels.numel() and (int(labels.min()) < 0 or int(labels.max()) >= n_classes):
+        raise ValueError(f"Test labels outside 0..{n_classes - 1}: LABELS_EMOTION does not match the data")
+    running_loss = torch.zeros(n_candidates, device=device)
+    confusion = torch.zeros(n_candidates * n_classes ** 2, dtype=torch.long, device=device)
+    offsets = (torch.arange(n_candidates, device=device) * n_classes ** 2).unsqueeze(1)
+    with torch.no_grad():
+        for batch in test_loader:
+            inputs = batch['audio'].to(device)
+            labels = batch['label'].to(device)
+            with autocast_context(config, device):
+                logits = forward(params, buffers, inputs) # (candidates, batch, classes)
+            logits = logits.float()
+            losses = torch.nn.functional.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.repeat(n_candidates),
+                                                       reduction='none')
+            running_loss += losses.view(n_candidates, -1).mean(dim=1)
+            confusion += torch.bincount((offsets + labels * n_classes + logits.argmax(dim=-1)).view(-1),
+                                        minlength=n_candidates * n_classes ** 2)
+    model.penultimate_features = None # the fc3 hook kept a vmap'd tensor
+    model.load_state_dict(initial_state)
+
+    results = []
+    losses = (running_loss / len(test_loader)).tolist()
+    for (sha1, model_path, _), loss, cm in zip(loaded, losses, confusion.view(n_candidates, n_classes, n_classes)):
+        metrics = metrics_from_confusion(cm)
+        results.append((sha1, model_path, {'loss': loss, 'accuracy': metrics['accuracy'], 'precision': metrics['precision'],
+                                           'recall': metrics['recall'], 'f1': metrics['f1']}))
+    return results
 
 
-def read_best_model_info(config):
-    info_path = os.path.join(config.MODEL_BASE_DIR, 'best_model_info.txt')
-    if os.path.exists(info_path):
-        with open(info_path, 'r') as f:
-            return f.read().strip()
-    return None
-  
-def write_best_model_info(config, info, dict_models):
-    info_path = os.path.join(config.MODEL_BASE_DIR, 'best_model_info.txt')
-    with open(info_path, 'w') as f:
-        f.write(info)
-        for i in dict_models:
-            f.write(f'Model: {i} / {dict_models[i]}')
-            
 def find_best_model(config, test_loader, device, exclude_models=None):
-    model_folders = [f for f in os.listdir(config.MODEL_BASE_DIR) if os.path.isdir(os.path.join(config.MODEL_BASE_DIR, f))]
-    best_models = []
-    
-    for folder in model_folders:
-        folder_path = os.path.join(config.MODEL_BASE_DIR, folder)
-        best_model_files = glob(os.path.join(folder_path, '*best_model*.pth'))
-        best_models.extend(best_model_files)
-    
+    """
+    Evaluate every *best_model*.pth under MODEL_BASE_DIR on the test set and rank them by loss.
+
+    Metrics are kept in the ModelRegistry keyed by checkpoint sha1 and test
+    split, so only new or changed files are evaluated.
+    classifier_only candidates share one test feature matrix and are evaluated
+    FIND_BEST_STACK at a time in one vectorised pass (_evaluate_stacked). Backbone
+    models are built once and reset to their initial weights before each checkpoint.
+    """
+    best_models = sorted(glob(os.path.join(config.MODEL_BASE_DIR, '**', '*best_model*.pth'), recursive=True))
     if exclude_models:
         best_models = [m for m in best_models if m not in exclude_models]
-    
     if not best_models:
-        print(f"No new best model files found in {config.MODEL_BASE_DIR}")
+        print(f"No best model files found in {config.MODEL_BASE_DIR}")
         return None
-    
-    print(f"Found {len(best_models)} putative best model files:")
+    print(f"Found {len(best_models)} putative best model files.")
+
+    registry = ModelRegistry.from_config(config)
+    test_loader = _shared_test_loader(config, test_loader)
+    test_signature = test_set_signature(config, test_loader)
+    if isinstance(test_loader, FeatureTensorLoader): # on device once, for every candidate
+        test_loader = test_loader.with_batch_size(test_loader.batch_size).to(device)
+
+    # identical files (e.g. hard-linked history) are evaluated once
+    to_evaluate = {}
     for model_path in best_models:
-        print(model_path)
-    
-    best_performance = float('inf')  # Using loss as the metric, lower is better
-    best_model_path = None
-    dict_models={}
+        sha1 = registry.sha1(model_path)
+        if registry.get_evaluation(sha1, test_signature) is None:
+            to_evaluate.setdefault(sha1, model_path)
+    print(f"{len(best_models) - len(to_evaluate)} cached, {len(to_evaluate)} to evaluate on {len(test_loader.dataset)} test samples.")
+
+    if to_evaluate:
+        model = get_model(config, test_loader).to(device)
+        model.eval()
+        if config.MODEL == 'classifier_only':
+            # small heads on shared features: FIND_BEST_STACK candidates per vectorised pass
+            candidates = list(to_evaluate.items())
+            for start in range(0, len(candidates), max(1, config.FIND_BEST_STACK)):
+                for sha1, model_path, metrics in _evaluate_stacked(config, model, candidates[start:start + config.FIND_BEST_STACK],
+                                                                   test_loader, device):
+                    registry.log_evaluation(sha1, test_signature, model_path, metrics, config.MODEL, config.DATA_NAME)
+                    print(f"Model: {model_path}\nTest Loss: {metrics['loss']:.4f}")
+        else:
+            # backbone models: one after another on one device, reset to the initial weights before each checkpoint
+            initial_state = cpu_snapshot(model.state_dict())
+            for sha1, model_path in to_evaluate.items():
+                model.load_state_dict(initial_state)
+                try:
+                    metrics = _evaluate_checkpoint(config, model, model_path, test_loader, device)
+                except Exception as e:
+                    print(f"Error evaluating model {model_path}: {str(e)}")
+                    continue
+                registry.log_evaluation(sha1, test_signature, model_path, metrics, config.MODEL, config.DATA_NAME)
+                print(f"Model: {model_path}\nTest Loss: {metrics['loss']:.4f}")
+
+    # every current path of an evaluated file, cached or new
+    ranking = []
     for model_path in best_models:
-        
-        try:
-            model = get_model(config, test_loader)
-            model.load_state_dict(torch.load(model_path, map_location=device))
-            model.to(device)
-            model.eval()
-            
-            loss, accuracy, _, _, f1, _, _ = evaluate_model(config, model, test_loader, torch.nn.CrossEntropyLoss(), device)
-            
-            dict_models[model_path]={'loss':loss, 'accuracy':accuracy,'f1':f1}
-            
-            print(f"Model: {model_path}")
-            print(f"Test Loss: {loss:.4f}")
-            
-            if loss < best_performance:
-                best_performance = loss
-                best_model_path = model_path
-        
-        except Exception as e:
-            print(f"Error evaluating model {model_path}: {str(e)}")
-            continue
-    
-    if best_model_path:
-        print(f"\nBest performing model: {best_model_path}")
-        print(f"Best performance (Loss): {best_performance:.4f}")
-        print(f"Other metrics\n{dict_models[best_model_path]}")
-        
-        # Save best model info
-        info = f"Best model path: {best_model_path}\nBest performance (Loss): {best_performance:.4f}"
-        write_best_model_info(config, info, dict_models)
-    else:
+        entry = registry.get_evaluation(registry.sha1(model_path), test_signature)
+        if entry is not None:
+            ranking.append({**entry, 'path': os.path.abspath(model_path)})
+    if not ranking:
         print("\nNo valid models found or all models failed evaluation.")
-    
+        return None
+    ranking.sort(key=lambda entry: entry['loss'])
+
+    print("\n##### Leaderboard (test loss) #####")
+    for rank, entry in enumerate(ranking[:10], 1):
+        print(f"{rank}. {entry['loss']:.4f} / acc {entry['accuracy']:.4f} / F1 {entry['f1']:.4f}  {entry['path']}")
+    best_model_path = ranking[0]['path']
+    print(f"\nBest performing model: {best_model_path}")
+    print(f"Best performance (Loss): {ranking[0]['loss']:.4f}")
     return best_model_path
 
 def prep_model(config, train_loader, is_sweep=False):
@@ -144,36 +208,20 @@ def prep_model(config, train_loader, is_sweep=False):
     
     #### Optimizer & Cost function 
     model = get_model(config, train_loader)
-    
-    if config.OPTIMIZER == "adam":
-        optimizer = torch.optim.Adam(model.parameters(),  lr=float(config.lr)) #weight_decay=config.weight_decay,
-        if config.MODEL == 'wav2vec_pretrained' or config.MODEL == 'wav2vec_finetuning':
-            print('\nOptimizer setup for wav2vec...')
-            
-            optimizer_grouped_parameters = [
-            {'params': model.wav2vec.parameters(), 'lr': config.lr/10, 'weight_decay':config.weight_decay/10},
-            {'params': model.emotion_classifier.parameters(), 'lr': config.lr, 'weight_decay':config.weight_decay}
-            ]
-            optimizer = torch.optim.AdamW(optimizer_grouped_parameters)
-        else:
-            optimizer = torch.optim.Adam(model.emotion_classifier.parameters(), weight_decay=config.weight_decay, lr=config.lr)
-        
-        
-    elif config.OPTIMIZER == "SGD":
-        optimizer = torch.optim.SGD(model.parameters(), lr=float(config.lr), momentum=0.9)
-    else:
-        print('err optimizer')
-        raise ValueError(f"Unknown optimizer: {config.OPTIMIZER}")
+    model = model.to(device) # before the optimizer: fused AdamW needs the parameters on cuda
+    optimizer = build_optimizer(model, config)
+    report_optimizer_memory(optimizer)
     
     criterion = torch.nn.CrossEntropyLoss()
     #### Model loading or start new
     if config.CUR_MODE == 'train' or config.CUR_MODE =='benchmark':
         print('New training / benchmark begins.')
+        config.start_run() # versioned model folder + registry run
         global_epoch = 0
         id_wandb = wandb.util.generate_id()
         print(f'Wandb id generated: {id_wandb}')
         config.id_wandb = id_wandb
-        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS)#, resume=True)
+        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, mode=config.WANDB_MODE)#, resume=True)
         # model = get_model(config, train_loader)
     elif config.CUR_MODE == 'resume':
         
@@ -182,15 +230,14 @@ def prep_model(config, train_loader, is_sweep=False):
         print(f"Resuming training from epoch {global_epoch}. Best val accuracy: {best_val_accuracy:.3f}\nWandb id loaded: {config.id_wandb}\nWandb project: {config.WANDB_PROJECT}")
         
         config.id_wandb=id_wandb
-        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, resume="must", settings=wandb.Settings(start_method="thread"))
+        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, resume="must", mode=config.WANDB_MODE, settings=wandb.Settings(start_method="thread"))
     elif config.CUR_MODE == 'sweep':
         print('\n####### Sweep starts. ')
         global_epoch = 0
         #id_wandb = wandb.util.generate_id()
         #config.WANDB_PROJECT+="_"+config.CUR_MODE
         id_wandb=config.id_wandb
-        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, resume=False, settings=wandb.Settings(start_method="thread"))
-        model = get_model(config, train_loader)
+        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, resume=False, mode=config.WANDB_MODE, settings=wandb.Settings(start_method="thread"))
 
     else:
         print('\n\n######### to be checked #####\n\n')
@@ -199,11 +246,10 @@ def prep_model(config, train_loader, is_sweep=False):
         print(f'Wandb id generated: {id_wandb}')
         config.id_wandb = id_wandb
         
-        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS)
+        wandb.init(id=id_wandb, project=config.WANDB_PROJECT, config=config.CONFIG_DEFAULTS, mode=config.WANDB_MODE)
         
     config.global_epoch = global_epoch
 
-    model = model.to(device)
     return model, optimizer, criterion, device
 
 def print_model_info(model):
@@ -226,38 +272,164 @@ def print_model_info(model):
     print(f"Total parameters: {total_params:,}")
     print(f"Trainable parameters: {trainable_params:,}")
     
+def _get_backbone(model):
+    # EmotionRecognitionWithWav2Vec.wav2vec or Wav2Vec2ForSequenceClassification.wav2vec2
+    for attr in ('wav2vec', 'wav2vec2'):
+        backbone = getattr(model, attr, None)
+        if isinstance(backbone, nn.Module) and hasattr(backbone, 'encoder'):
+            return attr, backbone
+    return None, None
+
+def get_layer_depths(model):
+    """
+    Depth of every parameter counted from the output: 0 for the head (pooling, classifier),
+    1 for the top transformer layer, ..., n_layers + 1 for the CNN feature encoder,
+    feature projection and positional embedding.
+    """
+    attr, backbone = _get_backbone(model)
+    if backbone is None:
+        return {name: 0 for name, _ in model.named_parameters()}
+    n_layers = len(backbone.encoder.layers)
+    stable_layer_norm = getattr(backbone.config, 'do_stable_layer_norm', False)
+    depths = {}
+    for name, _ in model.named_parameters():
+        if not name.startswith(attr + '.'):
+            depths[name] = 0
+            continue
+        match = re.search(r'\.encoder\.layers\.(\d+)\.', name)
+        if match:
+            depths[name] = n_layers - int(match.group(1))
+        elif stable_layer_norm and '.encoder.layer_norm.' in name:
+            depths[name] = 1 # final norm after the last layer
+        else:
+            depths[name] = n_layers + 1
+    return depths
+
 def unfreeze_layers(model, num_layers):
-    # 먼저 모든 파라미터를 고정
-    for param in model.parameters():
-        param.requires_grad = False
-    
-    # 모델의 모든 모듈을 리스트로 변환
-    all_modules = list(model.modules())
-    
-    # 마지막 num_layers 개의 모듈에 대해 파라미터 학습 가능하게 설정
-    for module in all_modules[-num_layers:]:
-        for param in module.parameters():
-            param.requires_grad = True
+    # the head stays trainable; of the wav2vec2 backbone only the top num_layers transformer layers
+    # (num_layers > n_layers also unfreezes the feature encoder)
+    depths = get_layer_depths(model)
+    for name, param in model.named_parameters():
+        param.requires_grad = depths[name] <= num_layers
     
     # 학습 가능한 파라미터 수 확인
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(f"Trainable parameters: {trainable_params}")
 
+def _make_param_groups(model, config, exclude=()):
+    """
+    One group per layer depth, trainable parameters only. The head uses config.lr; backbone
+    depth d uses lr * BACKBONE_LR_SCALE * LAYER_DECAY**(d - 1) and a tenth of the weight decay.
+    """
+    depths = get_layer_depths(model)
+    by_depth = {}
+    for name, param in model.named_parameters():
+        if param.requires_grad and id(param) not in exclude:
+            by_depth.setdefault(depths[name], []).append(param)
+    
+    weight_decay = 0.0 if config.OPTIMIZER == 'SGD' else config.weight_decay
+    param_groups = []
+    for depth in sorted(by_depth):
+        if depth == 0:
+            group = {'name': 'head', 'lr': config.lr, 'weight_decay': weight_decay}
+        else:
+            group = {'name': f'backbone_depth_{depth}', 'weight_decay': weight_decay / 10,
+                     'lr': config.lr * config.BACKBONE_LR_SCALE * config.LAYER_DECAY ** (depth - 1)}
+        group['params'] = by_depth[depth]
+        param_groups.append(group)
+    return param_groups
+
+def _fast_impl_kwargs(optimizer_cls, params):
+    # fused kernels need every parameter on cuda; otherwise the multi-tensor (foreach) path
+    signature = inspect.signature(optimizer_cls).parameters
+    if params and all(p.is_cuda for p in params) and 'fused' in signature:
+        return {'fused': True}
+    if 'foreach' in signature:
+        return {'foreach': True}
+    return {}
+
+def build_optimizer(model, config):
+    """Optimizer over the trainable parameters only, grouped by layer depth (see _make_param_groups)."""
+    param_groups = _make_param_groups(model, config)
+    if not param_groups:
+        raise ValueError("Model has no trainable parameters.")
+    params = [p for group in param_groups for p in group['params']]
+    
+    if config.OPTIMIZER == "adam":
+        # decoupled weight decay once the wav2vec2 backbone is part of the model
+        optimizer_cls = torch.optim.AdamW if _get_backbone(model)[1] is not None else torch.optim.Adam
+        kwargs = {}
+    elif config.OPTIMIZER == "SGD":
+        optimizer_cls = torch.optim.SGD
+        kwargs = {'momentum': 0.9}
+    else:
+        print('err optimizer')
+        raise ValueError(f"Unknown optimizer: {config.OPTIMIZER}")
+    impl_kwargs = _fast_impl_kwargs(optimizer_cls, params)
+    try:
+        optimizer = optimizer_cls(param_groups, lr=float(config.lr), **kwargs, **impl_kwargs)
+    except (RuntimeError, TypeError) as e:
+        # e.g. fused kernels not available for this dtype/device
+        print(f'{optimizer_cls.__name__}{impl_kwargs} unavailable ({e}); using the default implementation.')
+        impl_kwargs = {}
+        optimizer = optimizer_cls(param_groups, lr=float(config.lr), **kwargs)
+    print(f'Optimizer: {optimizer_cls.__name__} {impl_kwargs}, {len(param_groups)} param groups, '
+          f'{sum(p.numel() for p in params):,} trainable parameters')
+    return optimizer
+
+def add_unfrozen_params(optimizer, model, config):
+    """After unfreeze_layers: add param groups for trainable parameters the optimizer does not hold yet."""
+    known = {id(p) for group in optimizer.param_groups for p in group['params']}
+    new_groups = _make_param_groups(model, config, exclude=known)
+    for group in new_groups:
+        optimizer.add_param_group(group)
+    if new_groups:
+        print(f'Optimizer: added {sum(p.numel() for g in new_groups for p in g["params"]):,} unfrozen parameters')
+    return optimizer
+
+def report_optimizer_memory(optimizer):
+    # state is allocated lazily on the first step; before that it is estimated from the optimizer type
+    n_buffers = {'Adam': 2, 'AdamW': 2, 'SGD': 1 if optimizer.defaults.get('momentum') else 0}.get(type(optimizer).__name__, 2)
+    print(f"\n{'group':<22}{'params':>14}{'lr':>12}{'state MB':>10}")
+    total = 0
+    for i, group in enumerate(optimizer.param_groups):
+        numel = sum(p.numel() for p in group['params'])
+        state_bytes = 0
+        for p in group['params']:
+            state = optimizer.state.get(p)
+            if state:
+                state_bytes += sum(v.numel() * v.element_size() for v in state.values() if torch.is_tensor(v) and v.dim() > 0)
+            else:
+                state_bytes += n_buffers * p.numel() * p.element_size()
+        total += state_bytes
+        print(f"{group.get('name', str(i)):<22}{numel:>14,}{group['lr']:>12.2e}{state_bytes / 2**20:>10.1f}")
+    print(f"{'total':<22}{'':>26}{total / 2**20:>10.1f}\n")
+    return total
+
 def freeze_wav2vec(model):
     for param in model.wav2vec.parameters():
         param.requires_grad = False
 
+def get_input_size(config, train_loader):
+    # only the classifier_only model takes precomputed features; wav2vec models use hidden_size
+    if config.MODEL == 'classifier_only':
+        if hasattr(train_loader, 'feature_dim'): # FeatureTensorLoader: no extraction just to probe
+            return train_loader.feature_dim
+        return train_loader.dataset[0][0].shape[1]
+    return None
+
 def get_model(config, train_loader):
+    input_size = get_input_size(config, train_loader)
     
     if config.MODEL == 'classifier_only':
         print('classifer only')
-        model = EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=train_loader.dataset[0][0].shape[1], dropout_rate=config.DROPOUT_RATE,
+        model = EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=input_size, dropout_rate=config.DROPOUT_RATE,
         activation=config.ACTIVATION, use_wav2vec=False)
         
     elif config.MODEL =='wav2vec_pretrained':
         print('Pretrained model loaded. Feature extraction only, and wav2vec model is frozen.')
         
-        model= EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=train_loader.dataset[0][0].shape[1], dropout_rate=config.DROPOUT_RATE,
+        model= EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=input_size, dropout_rate=config.DROPOUT_RATE,
         activation=config.ACTIVATION, use_wav2vec=True)
         freeze_wav2vec(model)
         
@@ -265,7 +437,7 @@ def get_model(config, train_loader):
         
         #config.path_pretrained= os.path.join(config.MODEL_BASE_DIR,'finetuning', 'wav2vec_finetuning_best')
         print('Finetuned model loaded from: ',config.path_pretrained ) # from wav2vec original
-        model= EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=train_loader.dataset[0][0].shape[1], dropout_rate=config.DROPOUT_RATE,
+        model= EmotionRecognitionWithWav2Vec(num_classes=len(config.LABELS_EMOTION), config=config,  input_size=input_size, dropout_rate=config.DROPOUT_RATE,
         activation=config.ACTIVATION, use_wav2vec=True)
         freeze_wav2vec(model)
         # for param in model.parameters():
@@ -323,6 +495,47 @@ class EmotionRecognitionBase(nn.Module):
             raise ValueError(f"Unknown activation function: {activation}")
 
 
+class Wav2VecPooling(nn.Module):
+    """
+    Pools wav2vec2 frames (batch, time, hidden) into one vector per clip, ignoring padded frames.
+
+    mode: 'mean' (masked mean), 'attention' (learned frame weights) or 'stats' (mean + std).
+    layers: hidden_states indices mixed by a learned softmax-weighted sum.
+    With layers=None only last_hidden_state is used and no hidden_states are requested.
+    """
+    def __init__(self, hidden_size, mode='mean', layers=None):
+        super().__init__()
+        self.mode = mode
+        self.layers = list(layers) if layers else None
+        if self.layers:
+            self.layer_weights = nn.Parameter(torch.zeros(len(self.layers)))
+        if mode == 'attention':
+            self.attention = nn.Linear(hidden_size, 1)
+        elif mode not in ('mean', 'stats'):
+            raise ValueError(f"Unknown pooling mode: {mode}")
+        self.output_size = hidden_size * 2 if mode == 'stats' else hidden_size
+
+    @property
+    def needs_hidden_states(self):
+        return self.layers is not None
+
+    def combine_layers(self, hidden_states):
+        stacked = torch.stack([hidden_states[i] for i in self.layers], dim=0)
+        weights = torch.softmax(self.layer_weights, dim=0).view(-1, 1, 1, 1)
+        return (weights * stacked).sum(dim=0)
+
+    def forward(self, frames, frame_mask=None):
+        if frame_mask is None:
+            frame_mask = torch.ones(frames.shape[:2], dtype=torch.bool, device=frames.device)
+        if self.mode == 'mean':
+            return masked_pool(frames, frame_mask, 'mean')
+        elif self.mode == 'stats':
+            return masked_pool(frames, frame_mask, 'mean_std')
+        scores = self.attention(frames).squeeze(-1).masked_fill(~frame_mask, float('-inf'))
+        weights = torch.softmax(scores, dim=1).unsqueeze(-1)
+        return (weights * frames).sum(dim=1)
+
+
 class EmotionRecognitionWithWav2Vec(nn.Module):
     def __init__(self, num_classes, config, dropout_rate=0.5, activation='relu', use_wav2vec=True, input_size=None):
         super().__init__()
@@ -332,9 +545,16 @@ class EmotionRecognitionWithWav2Vec(nn.Module):
         self.penultimate_features = None
         
         if use_wav2vec:
+            from transformers import Wav2Vec2Model
             self.wav2vec = Wav2Vec2Model.from_pretrained(self.config.path_pretrained)
             self.wav2vec.config.mask_time_length = config.mask_time_length
-            wav2vec_output_size = self.wav2vec.config.hidden_size
+            self.pooling = Wav2VecPooling(self.wav2vec.config.hidden_size, mode=config.POOLING, layers=config.POOL_LAYERS)
+            if self.pooling.layers and not self.wav2vec.config.do_stable_layer_norm:
+                # transformer layers above the deepest pooled one never reach the classifier
+                n_layers = max(self.pooling.layers)
+                self.wav2vec.encoder.layers = self.wav2vec.encoder.layers[:n_layers]
+                self.wav2vec.config.num_hidden_layers = n_layers
+            wav2vec_output_size = self.pooling.output_size
         else:
             wav2vec_output_size = input_size
         
@@ -351,14 +571,27 @@ class EmotionRecognitionWithWav2Vec(nn.Module):
     def _hook_fn(self, module, input, output):
         self.penultimate_features = output
 
-    def forward(self, input_values):
+    def _frame_mask(self, attention_mask, n_frames):
+        frame_lengths = self.wav2vec._get_feat_extract_output_lengths(attention_mask.sum(dim=-1))
+        return torch.arange(n_frames, device=attention_mask.device).unsqueeze(0) < frame_lengths.unsqueeze(1)
+
+    def forward(self, input_values, attention_mask=None):
         if self.use_wav2vec:
             if input_values.dim() == 4:
                 input_values = input_values.squeeze(2)
             if input_values.dim() == 3:
                 input_values = input_values.squeeze(1)
-            wav2vec_outputs = self.wav2vec(input_values, output_hidden_states=True).last_hidden_state
-            features = torch.mean(wav2vec_outputs, dim=1)
+            wav2vec_kwargs = {'output_hidden_states': self.pooling.needs_hidden_states}
+            # group-norm checkpoints (wav2vec2-base) expect zero padding without a mask
+            if attention_mask is not None and self.wav2vec.config.feat_extract_norm == 'layer':
+                wav2vec_kwargs['attention_mask'] = attention_mask
+            wav2vec_outputs = self.wav2vec(input_values, **wav2vec_kwargs)
+            if self.pooling.needs_hidden_states:
+                frames = self.pooling.combine_layers(wav2vec_outputs.hidden_states)
+            else:
+                frames = wav2vec_outputs.last_hidden_state
+            frame_mask = None if attention_mask is None else self._frame_mask(attention_mask, frames.shape[1])
+            features = self.pooling(frames, frame_mask)
         else:
             features = input_values.view(input_values.size(0), -1)
         
@@ -372,7 +605,7 @@ class EmotionRecognitionWithWav2Vec(nn.Module):
 class EmotionRecognitionModel_v2(EmotionRecognitionBase):
     def __init__(self, input_size, num_classes, dropout_rate, activation):
         super().__init__(input_size, num_classes, dropout_rate, activation)
-        momentum = config.momentum #0.1
+        momentum = Config.momentum #0.1
         self.fc1 = nn.Linear(input_size, 256)
         self.bn1 = nn.BatchNorm1d(256, momentum=momentum)
         self.fc2 = nn.Linear(256, 128)
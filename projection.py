@@ -0,0 +1,132 @@
+import time
+import inspect
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+
+PROJECTION_METHODS = ('pca', 'tsne', 'opentsne', 'umap')
+
+
+def _tsne_iter_kwargs(n_iter):
+    # sklearn >= 1.5 renamed n_iter to max_iter
+    name = 'max_iter' if 'max_iter' in inspect.signature(TSNE).parameters else 'n_iter'
+    return {name: n_iter}
+
+
+class EmbeddingProjector:
+    """
+    2-D projection of embeddings for the embedding figure.
+
+    Inputs are first reduced to pca_dims with a PCA that is refitted only every
+    refit_pca_every calls (or when the input width changes). method 'pca' stops
+    there and plots the first two components, which is cheap enough for every
+    epoch; 'tsne' runs sklearn's multi-threaded Barnes-Hut t-SNE, 'opentsne'
+    and 'umap' use openTSNE / umap-learn when installed (else 'tsne').
+    With warm_start, samples seen in the previous call (matched by sample_ids)
+    start from their previous layout and fewer iterations are run, so the layout
+    also stays comparable from epoch to epoch.
+    """
+    def __init__(self, method='tsne', pca_dims=50, refit_pca_every=5, warm_start=True,
+                 n_iter=1000, warm_n_iter=300, perplexity=30.0, n_jobs=-1, seed=42):
+        if method not in PROJECTION_METHODS:
+            raise ValueError(f"Invalid method. Use one of {PROJECTION_METHODS}.")
+        self.method = method
+        self.pca_dims = pca_dims
+        self.refit_pca_every = refit_pca_every
+        self.warm_start = warm_start
+        self.n_iter = n_iter
+        self.warm_n_iter = warm_n_iter
+        self.perplexity = perplexity
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self._pca = None
+        self._pca_calls = 0
+        self._layout = {} # sample id -> previous 2-D position
+        self.timings = {}
+
+    def _reduce(self, embeddings):
+        n_components = min(self.pca_dims, *embeddings.shape)
+        stale = self._pca is None or self._pca.n_features_in_ != embeddings.shape[1] or self._pca.n_components_ != n_components
+        if stale or (self.refit_pca_every and self._pca_calls % self.refit_pca_every == 0):
+            self._pca = PCA(n_components=n_components, svd_solver='randomized' if n_components < embeddings.shape[1] // 2 else 'full',
+                            random_state=self.seed).fit(embeddings)
+            self._pca_calls = 0
+        self._pca_calls += 1
+        return self._pca.transform(embeddings).astype(np.float32)
+
+    def _initial_layout(self, sample_ids, reduced):
+        if not self.warm_start or sample_ids is None or not self._layout:
+            return None
+        known = np.array([i in self._layout for i in sample_ids])
+        if known.mean() < 0.5:
+            return None
+        # new samples start at the mean of the known ones plus a little noise
+        layout = np.zeros((len(sample_ids), 2), dtype=np.float32)
+        layout[known] = [self._layout[i] for i, k in zip(sample_ids, known) if k]
+        rng = np.random.default_rng(self.seed)
+        layout[~known] = layout[known].mean(axis=0) + rng.normal(0, layout[known].std() * 0.1 + 1e-6, ((~known).sum(), 2))
+        return layout
+
+    def _tsne(self, reduced, init):
+        method = self.method
+        if method == 'opentsne':
+            try:
+                from openTSNE import TSNE as OpenTSNE
+            except ImportError:
+                print('openTSNE is not installed; using sklearn t-SNE.')
+                method = self.method = 'tsne'
+        elif method == 'umap':
+            try:
+                import umap
+            except ImportError:
+                print('umap-learn is not installed; using sklearn t-SNE.')
+                method = self.method = 'tsne'
+
+        perplexity = min(self.perplexity, (len(reduced) - 1) / 3)
+        # a warm start continues the previous layout at its scale, without early exaggeration:
+        # it is already clustered, and fewer iterations keep it close to last epoch's
+        warm = init is not None
+        if method == 'opentsne':
+            return np.asarray(OpenTSNE(n_components=2, perplexity=perplexity, n_jobs=self.n_jobs, random_state=self.seed,
+                                       initialization=init if warm else 'pca', early_exaggeration_iter=0 if warm else 250,
+                                       n_iter=self.warm_n_iter if warm else self.n_iter).fit(reduced))
+        if method == 'umap':
+            return umap.UMAP(n_components=2, random_state=self.seed, n_jobs=self.n_jobs,
+                             init=init if warm else 'spectral').fit_transform(reduced)
+        return TSNE(n_components=2, perplexity=perplexity, init=init if warm else 'pca',
+                    early_exaggeration=1.0 if warm else 12.0, random_state=self.seed, n_jobs=self.n_jobs, method='barnes_hut',
+                    **_tsne_iter_kwargs(self.warm_n_iter if warm else self.n_iter)).fit_transform(reduced)
+
+    def fit_transform(self, embeddings, sample_ids=None):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        start = time.perf_counter()
+        reduced = self._reduce(embeddings)
+        self.timings = {'pca': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        init = None
+        if self.method == 'pca':
+            layout = reduced[:, :2]
+        else:
+            init = self._initial_layout(sample_ids, reduced)
+            layout = self._tsne(reduced, init)
+        self.timings['layout'] = time.perf_counter() - start
+        self.timings['warm_start'] = init is not None
+
+        if sample_ids is not None:
+            self._layout = {i: position for i, position in zip(sample_ids, np.asarray(layout, dtype=np.float32))}
+        print(f"Projection ({self.method}): {embeddings.shape[0]}x{embeddings.shape[1]} -> PCA {reduced.shape[1]} "
+              f"({self.timings['pca']:.2f} s) -> 2-D ({self.timings['layout']:.2f} s{', warm start' if init is not None else ''})")
+        return layout
+
+
+_PROJECTORS = {}
+
+
+def get_projector(key, **settings):
+    """One projector per key (e.g. stage) and settings in this process, so PCA and layouts carry over between calls."""
+    cache_key = (key, tuple(sorted(settings.items())))
+    if cache_key not in _PROJECTORS:
+        _PROJECTORS[cache_key] = EmbeddingProjector(**settings)
+    return _PROJECTORS[cache_key]
@@ -0,0 +1,108 @@
+import torch
+
+SIMILARITY_METHODS = ('cka', 'rsa')
+
+
+def flatten_activation(act):
+    # (batch, ...) -> (batch, features); layers keep their own width
+    return act.reshape(act.shape[0], -1).float()
+
+
+def gram_matrices(activations):
+    """Linear-kernel Gram matrix (batch x batch) of each layer, stacked: (layers, batch, batch), float64 on CPU."""
+    grams = [(x @ x.T) for x in map(flatten_activation, activations)]
+    return torch.stack(grams).double().cpu()
+
+
+def unbiased_hsic(grams):
+    """
+    Unbiased HSIC estimator (Song et al., 2012) for every pair of layers at once.
+    grams: (layers, n, n) with n >= 4. Returns (layers, layers).
+    """
+    n = grams.shape[-1]
+    grams = grams.clone()
+    grams.diagonal(dim1=1, dim2=2).zero_()
+    flat = grams.reshape(len(grams), -1)
+    trace_kl = flat @ flat.T # tr(K L) for symmetric K, L
+    sums = flat.sum(dim=1)
+    row_sums = grams.sum(dim=2)
+    hsic = trace_kl + torch.outer(sums, sums) / ((n - 1) * (n - 2)) - 2.0 / (n - 2) * (row_sums @ row_sums.T)
+    return hsic / (n * (n - 3))
+
+
+def _rank(x):
+    # ranks along the last dim (ties are broken by order)
+    return x.argsort(dim=-1).argsort(dim=-1).double()
+
+
+def rdm_correlations(activations):
+    """
+    RSA for every pair of layers: Spearman correlation between the layers'
+    representational dissimilarity matrices (1 - Pearson correlation between samples).
+    """
+    rdms = []
+    for x in map(flatten_activation, activations):
+        x = x - x.mean(dim=1, keepdim=True)
+        x = x / (x.norm(dim=1, keepdim=True) + 1e-8)
+        rdms.append(1 - x @ x.T)
+    rdms = torch.stack(rdms).double().cpu()
+    n = rdms.shape[-1]
+    rows, cols = torch.triu_indices(n, n, offset=1)
+    ranks = _rank(rdms[:, rows, cols])
+    ranks = ranks - ranks.mean(dim=1, keepdim=True)
+    ranks = ranks / (ranks.norm(dim=1, keepdim=True) + 1e-12)
+    return ranks @ ranks.T
+
+
+class LayerSimilarity:
+    """
+    Layer x layer representational similarity, accumulated over batches.
+
+    method 'cka': minibatch linear CKA (Nguyen et al., 2021). The unbiased HSIC of
+    every layer pair is summed over batches and normalised at the end, so the
+    estimate does not depend on the batch size and layers of any width can be compared.
+    method 'rsa': Spearman correlation of the layers' RDMs, averaged over batches.
+    Each batch is reduced to (layers x layers) numbers right away, so only the
+    current batch's activations are held.
+    """
+    def __init__(self, method='cka'):
+        if method not in SIMILARITY_METHODS:
+            raise ValueError(f"Invalid method. Use one of {SIMILARITY_METHODS}.")
+        self.method = method
+        self.layer_names = None
+        self.total = None
+        self.n_batches = 0
+        self.n_samples = 0
+
+    def update(self, activations):
+        """activations: dict layer name -> tensor of shape (batch, ...) for one batch."""
+        if self.layer_names is None:
+            self.layer_names = list(activations.keys())
+        acts = [activations[name] for name in self.layer_names]
+        n = acts[0].shape[0]
+        if n < 4: # the unbiased estimator needs 4 samples; a small last batch is skipped
+            return
+        with torch.no_grad():
+            batch_total = unbiased_hsic(gram_matrices(acts)) if self.method == 'cka' else rdm_correlations(acts)
+        self.total = batch_total if self.total is None else self.total + batch_total
+        self.n_batches += 1
+        self.n_samples += n
+
+    def compute(self):
+        if self.total is None:
+            return None
+        if self.method == 'cka':
+            self_hsic = self.total.diagonal().clamp_min(1e-12)
+            matrix = self.total / torch.sqrt(torch.outer(self_hsic, self_hsic))
+        else:
+            matrix = self.total / self.n_batches
+        return matrix.numpy()
+
+    def result(self):
+        """What make_figure_jobs needs (plain arrays)."""
+        matrix = self.compute()
+        if matrix is None:
+            return None
+        return {'similarity_matrix': matrix, 'layer_names': list(self.layer_names), 'method': self.method,
+                'n_samples': self.n_samples, 'n_batches': self.n_batches}
+
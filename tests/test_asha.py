@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+from hyperparameter_search import ASHAScheduler
+
+
+def run_trial(scheduler, losses):
+    """Drive the callback like train_model does (global_epoch reset to 0, incremented before the callback)."""
+    callback = scheduler.epoch_callback()
+    global_epoch = 0
+    for loss in losses:
+        global_epoch += 1
+        if callback(global_epoch, None, SimpleNamespace(loss=loss)):
+            break
+    return global_epoch
+
+
+def test_rungs():
+    assert ASHAScheduler(max_epochs=20, min_epochs=2, eta=3).rungs == [2, 6, 18]
+    assert ASHAScheduler(max_epochs=9, min_epochs=0, eta=3).rungs == [1, 3]
+
+
+def test_worse_trial_cut_exactly_at_first_rung():
+    scheduler = ASHAScheduler(max_epochs=10, min_epochs=2, eta=3)
+    assert run_trial(scheduler, [1.0, 0.5, 0.4, 0.3, 0.2, 0.1, 0.1, 0.1, 0.1, 0.1]) == 10
+    assert run_trial(scheduler, [2.0] * 10) == 2
+
+
+def test_better_trial_passes_rungs():
+    scheduler = ASHAScheduler(max_epochs=10, min_epochs=2, eta=3)
+    run_trial(scheduler, [2.0] * 10)
+    assert run_trial(scheduler, [1.0] * 10) == 10
+
+
+def test_maximize_cuts_lower_values():
+    scheduler = ASHAScheduler(max_epochs=10, metric_name='val.accuracy', maximize=True, min_epochs=1, eta=2)
+    callback = scheduler.epoch_callback()
+    assert not callback(1, None, SimpleNamespace(accuracy=0.9))
+    callback = scheduler.epoch_callback()
+    assert callback(1, None, SimpleNamespace(accuracy=0.2))
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+import torch
+
+from checkpoint_utils import CheckpointWriter, atomic_save
+
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    path = str(tmp_path / 'checkpoint.pth')
+    atomic_save({'epoch': 1}, path)
+    with pytest.raises(Exception):
+        atomic_save({'epoch': 2, 'unpicklable': lambda: None}, path)
+    assert torch.load(path) == {'epoch': 1}
+
+
+@pytest.mark.parametrize('asynchronous', [True, False])
+def test_save_snapshots_state_at_call_time(tmp_path, asynchronous):
+    path = str(tmp_path / 'ckpt' / 'checkpoint.pth')
+    weight = torch.zeros(3)
+    with CheckpointWriter(asynchronous=asynchronous) as writer:
+        writer.save({'weight': weight}, path)
+        weight += 1 # a later optimizer step must not leak into the queued checkpoint
+        writer.wait()
+    torch.testing.assert_close(torch.load(path)['weight'], torch.zeros(3))
+    assert os.listdir(os.path.dirname(path)) == ['checkpoint.pth']
+
+
+def test_keep_last_versions(tmp_path):
+    path = str(tmp_path / 'checkpoint.pth')
+    with CheckpointWriter(keep_last=2) as writer:
+        for epoch in range(1, 5):
+            writer.save({'epoch': epoch}, path, tag=epoch)
+    assert sorted(os.listdir(tmp_path)) == ['checkpoint.pth', 'checkpoint_e0003.pth', 'checkpoint_e0004.pth']
+    assert torch.load(path)['epoch'] == 4
+    assert torch.load(str(tmp_path / 'checkpoint_e0003.pth'))['epoch'] == 3
+
+
+def test_background_error_is_raised_on_wait(tmp_path):
+    writer = CheckpointWriter()
+    writer.save({'unpicklable': lambda: None}, str(tmp_path / 'checkpoint.pth'))
+    with pytest.raises(RuntimeError, match='Background checkpoint write failed'):
+        writer.wait()
+    writer.close()
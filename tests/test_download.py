@@ -0,0 +1,97 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from data_utils import download_file
+
+PAYLOAD = os.urandom(300_000)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD with (optionally ignored) single-range support, like a file server."""
+    honour_range = True
+    requests_seen = []
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        type(self).requests_seen.append(range_header)
+        start = 0
+        if range_header and self.honour_range:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(PAYLOAD)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}')
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    RangeHandler.honour_range = True
+    RangeHandler.requests_seen = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/data.zip'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_writes_file_and_digest(server, tmp_path):
+    destination = str(tmp_path / 'data.zip')
+    assert download_file(server, destination, expected_sha256=SHA256) == SHA256
+    assert open(destination, 'rb').read() == PAYLOAD
+    assert open(destination + '.sha256').read() == SHA256
+    assert not os.path.exists(destination + '.part')
+
+
+def test_download_resumes_from_partial_file(server, tmp_path):
+    destination = str(tmp_path / 'data.zip')
+    with open(destination + '.part', 'wb') as f:
+        f.write(PAYLOAD[:123_456])
+    assert download_file(server, destination, expected_sha256=SHA256) == SHA256
+    assert RangeHandler.requests_seen == ['bytes=123456-']
+    assert open(destination, 'rb').read() == PAYLOAD
+
+
+def test_download_restarts_when_range_is_ignored(server, tmp_path):
+    RangeHandler.honour_range = False
+    destination = str(tmp_path / 'data.zip')
+    with open(destination + '.part', 'wb') as f:
+        f.write(b'stale bytes')
+    assert download_file(server, destination, expected_sha256=SHA256) == SHA256
+    assert open(destination, 'rb').read() == PAYLOAD
+
+
+def test_download_complete_partial_file_gets_416(server, tmp_path):
+    destination = str(tmp_path / 'data.zip')
+    with open(destination + '.part', 'wb') as f:
+        f.write(PAYLOAD)
+    assert download_file(server, destination, expected_sha256=SHA256) == SHA256
+    assert RangeHandler.requests_seen == [f'bytes={len(PAYLOAD)}-']
+    assert open(destination, 'rb').read() == PAYLOAD
+
+
+def test_download_checksum_mismatch_discards_file(server, tmp_path):
+    destination = str(tmp_path / 'data.zip')
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        download_file(server, destination, expected_sha256='0' * 64)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + '.part')
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+from feature_cache import FeatureCache
+
+
+@pytest.fixture
+def wavs(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'clip_{i}.wav'
+        path.write_bytes(b'RIFF' + bytes([i]))
+        paths.append(str(path))
+    return paths
+
+
+def fill(cache, paths):
+    features = {path: np.full(4, i, dtype=np.float32) for i, path in enumerate(paths)}
+    for path, feature in features.items():
+        cache.put(path, feature)
+    cache.flush()
+    return features
+
+
+def test_roundtrip_through_index_and_mmap(tmp_path, wavs):
+    cache_dir = str(tmp_path / 'cache')
+    features = fill(FeatureCache(cache_dir, 'wav2vec2', shard_size=2), wavs)
+
+    reopened = FeatureCache(cache_dir, 'wav2vec2')
+    assert len(reopened) == 3
+    assert reopened.missing(wavs) == []
+    row = reopened.get(wavs[2])
+    assert isinstance(row, np.memmap) # a view into the shard, not a copy
+    np.testing.assert_array_equal(reopened.get_many(wavs), np.stack([features[path] for path in wavs]))
+
+
+def test_modified_file_invalidates_its_entry(tmp_path, wavs):
+    cache_dir = str(tmp_path / 'cache')
+    fill(FeatureCache(cache_dir, 'wav2vec2'), wavs)
+    stat = os.stat(wavs[1])
+    os.utime(wavs[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    cache = FeatureCache(cache_dir, 'wav2vec2')
+    assert wavs[1] not in cache and wavs[0] in cache
+    assert cache.get(wavs[1]) is None
+    assert cache.missing(wavs + [wavs[1]]) == [wavs[1]]
+    with pytest.raises(KeyError):
+        cache.get_many(wavs)
+
+
+@pytest.mark.parametrize('model_id, pooling', [('other-model', 'mean'), ('wav2vec2', 'max')])
+def test_other_model_or_pooling_misses(tmp_path, wavs, model_id, pooling):
+    cache_dir = str(tmp_path / 'cache')
+    fill(FeatureCache(cache_dir, 'wav2vec2', pooling='mean'), wavs)
+    assert FeatureCache(cache_dir, model_id, pooling=pooling).missing(wavs) == wavs
+
+
+def test_unflushed_rows_are_not_indexed(tmp_path, wavs):
+    cache_dir = str(tmp_path / 'cache')
+    cache = FeatureCache(cache_dir, 'wav2vec2')
+    cache.put(wavs[0], np.zeros(4))
+    assert len(FeatureCache(cache_dir, 'wav2vec2')) == 0
+    assert not [name for name in os.listdir(cache_dir) if name.endswith('.tmp')]
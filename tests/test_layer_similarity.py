@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import torch
+
+from rsa_utils import LayerSimilarity, gram_matrices, unbiased_hsic
+
+
+def reference_hsic(x, y):
+    """Unbiased HSIC (Song et al., 2012, eq. 5) written out for one pair of linear kernels."""
+    n = len(x)
+    k, l = x @ x.T, y @ y.T
+    np.fill_diagonal(k, 0)
+    np.fill_diagonal(l, 0)
+    ones = np.ones(n)
+    return (np.trace(k @ l) + (ones @ k @ ones) * (ones @ l @ ones) / ((n - 1) * (n - 2))
+            - 2 / (n - 2) * ones @ k @ l @ ones) / (n * (n - 3))
+
+
+def random_layers(n=32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    a = torch.randn(n, 20, generator=generator)
+    b = a @ torch.randn(20, 5, generator=generator) + 0.5 * torch.randn(n, 5, generator=generator)
+    c = torch.randn(n, 3, 4, generator=generator) # flattened to 12 features
+    return {'a': a, 'b': b, 'c': c}
+
+
+def test_unbiased_hsic_matches_reference():
+    layers = list(random_layers().values())
+    hsic = unbiased_hsic(gram_matrices(layers)).numpy()
+    flat = [layer.reshape(len(layer), -1).double().numpy() for layer in layers]
+    expected = np.array([[reference_hsic(x, y) for y in flat] for x in flat])
+    np.testing.assert_allclose(hsic, expected, rtol=1e-6) # Gram matrices are computed in float32
+
+
+def test_cka_properties():
+    layers = random_layers(n=256)
+    q, _ = torch.linalg.qr(torch.randn(20, 20))
+    layers['a_rotated_scaled'] = 3.0 * layers['a'] @ q
+    similarity = LayerSimilarity('cka')
+    for batch in range(4):
+        similarity.update({name: value[batch * 64:(batch + 1) * 64] for name, value in layers.items()})
+    matrix = similarity.compute()
+
+    np.testing.assert_allclose(np.diag(matrix), 1.0, rtol=1e-10)
+    np.testing.assert_allclose(matrix, matrix.T, rtol=1e-10)
+    assert matrix[0, 3] == pytest.approx(1.0) # invariant to orthogonal transforms and isotropic scaling
+    assert matrix[0, 1] > 0.3 # b is a noisy projection of a
+    assert abs(matrix[0, 2]) < 0.1 # independent: the unbiased estimator is centred on 0
+    assert similarity.result()['n_samples'] == 256
+
+
+def test_minibatch_cka_sums_hsic_over_batches_and_skips_tiny_batches():
+    layers = random_layers(n=42)
+    similarity = LayerSimilarity('cka')
+    for start in (0, 20, 40): # the last batch has 2 samples: skipped
+        similarity.update({name: value[start:start + 20] for name, value in layers.items()})
+    assert (similarity.n_batches, similarity.n_samples) == (2, 40)
+
+    totals = sum(unbiased_hsic(gram_matrices([value[start:start + 20] for value in layers.values()])) for start in (0, 20))
+    expected = totals / torch.sqrt(torch.outer(totals.diagonal(), totals.diagonal()))
+    np.testing.assert_allclose(similarity.compute(), expected.numpy(), rtol=1e-10)
+
+
+def test_rsa_of_identical_layers_is_one():
+    layers = random_layers()
+    layers['a_copy'] = layers['a'].clone()
+    similarity = LayerSimilarity('rsa')
+    similarity.update(layers)
+    matrix = similarity.compute()
+    assert matrix[0, 3] == pytest.approx(1.0)
+    with pytest.raises(ValueError):
+        LayerSimilarity('cosine')
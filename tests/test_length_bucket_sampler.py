@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from data_utils import LengthBucketBatchSampler
+
+LENGTHS = np.random.default_rng(0).integers(16_000, 160_000, size=503)
+
+
+@pytest.mark.parametrize('max_tokens', [0, 600_000])
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_every_index_once_per_epoch_and_len_matches(shuffle, max_tokens):
+    sampler = LengthBucketBatchSampler(LENGTHS, batch_size=8, max_tokens=max_tokens, shuffle=shuffle, bucket_size=5)
+    for _ in range(3):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(LENGTHS)))
+        assert all(1 <= len(batch) <= 8 for batch in batches)
+
+
+def test_max_tokens_bounds_padded_batch():
+    sampler = LengthBucketBatchSampler(LENGTHS, batch_size=32, max_tokens=600_000, shuffle=True)
+    for batch in sampler:
+        assert len(batch) == 1 or len(batch) * LENGTHS[batch].max() <= 600_000
+
+
+def test_epochs_reshuffle_and_are_reproducible():
+    first = LengthBucketBatchSampler(LENGTHS, batch_size=8, seed=3)
+    second = LengthBucketBatchSampler(LENGTHS, batch_size=8, seed=3)
+    epoch0, epoch1 = list(first), list(first)
+    assert epoch0 != epoch1
+    assert list(second) == epoch0 and list(second) == epoch1
+
+
+def test_batches_sorted_within_buckets():
+    # bucketing keeps the padding well below that of random batches
+    sampler = LengthBucketBatchSampler(LENGTHS, batch_size=8, bucket_size=10)
+    padded = sum(len(batch) * LENGTHS[batch].max() for batch in sampler)
+    order = np.random.default_rng(1).permutation(len(LENGTHS))
+    random_padded = sum(len(batch) * LENGTHS[batch].max() for batch in np.array_split(order, len(sampler)))
+    assert padded < 0.8 * random_padded
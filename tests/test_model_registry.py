@@ -0,0 +1,99 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from model_registry import ModelRegistry
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(str(tmp_path / 'model_registry.jsonl'))
+
+
+def evaluate(registry, path, loss, test_set='split_a'):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(64))
+    registry.log_evaluation(registry.sha1(path), test_set, path, {'loss': loss, 'accuracy': 1 - loss},
+                            model='classifier_only', data_name='RAVDESS')
+
+
+def test_best_model_is_lowest_loss_on_the_split(tmp_path, registry):
+    paths = [str(tmp_path / f'best_model_{i}.pth') for i in range(3)]
+    evaluate(registry, paths[0], 0.9)
+    evaluate(registry, paths[1], 0.4)
+    evaluate(registry, paths[2], 0.1, test_set='split_b')
+
+    assert registry.best_model('RAVDESS', 'classifier_only', 'split_a')['path'] == paths[1]
+    assert registry.best_model('RAVDESS', 'classifier_only')['path'] == paths[2] # most recently evaluated split
+    assert registry.best_model('MELD', 'classifier_only') is None
+
+
+def test_best_model_skips_overwritten_and_deleted_files(tmp_path, registry):
+    paths = [str(tmp_path / f'best_model_{i}.pth') for i in range(3)]
+    for path, loss in zip(paths, (0.3, 0.2, 0.1)):
+        evaluate(registry, path, loss)
+
+    with open(paths[2], 'wb') as f: # retrained since its evaluation
+        f.write(os.urandom(128))
+    assert registry.best_model('RAVDESS', 'classifier_only')['path'] == paths[1]
+    os.remove(paths[1])
+    assert registry.best_model('RAVDESS', 'classifier_only')['path'] == paths[0]
+
+
+def test_records_are_shared_through_the_file(tmp_path, registry):
+    path = str(tmp_path / 'best_model.pth')
+    evaluate(registry, path, 0.5)
+    sha1 = registry.sha1(path)
+
+    other = ModelRegistry(registry.registry_path) # e.g. another process
+    assert other.get_evaluation(sha1, 'split_a')['loss'] == 0.5
+    assert other.get_evaluation(sha1, 'split_b') is None
+    evaluate(other, str(tmp_path / 'best_model_2.pth'), 0.2)
+    assert registry.best_model('RAVDESS', 'classifier_only')['loss'] == 0.2
+
+
+def test_sha1_is_cached_until_the_file_changes(tmp_path, registry):
+    path = str(tmp_path / 'best_model.pth')
+    evaluate(registry, path, 0.5)
+    n_lines = sum(1 for _ in open(registry.registry_path))
+    registry.sha1(path)
+    assert sum(1 for _ in open(registry.registry_path)) == n_lines
+
+
+def run_config(tmp_path, version):
+    model_dir = str(tmp_path / 'classifier_only_RAVDESS' / f'classifier_only_RAVDESS_v{version}')
+    return SimpleNamespace(WANDB_PROJECT='classifier_only_RAVDESS', MODEL='classifier_only', DATA_NAME='RAVDESS',
+                           MODEL_DIR=model_dir, MODEL_SAVE_PATH=os.path.join(model_dir, 'best_model.pth'),
+                           CKPT_SAVE_PATH=os.path.join(model_dir, 'checkpoint.pth'), lr=1e-3)
+
+
+def test_run_versions_and_updates(tmp_path, registry):
+    assert registry.next_version('classifier_only_RAVDESS') == 0
+    for version in range(2):
+        run = registry.register_run(run_config(tmp_path, version), version)
+    assert registry.next_version('classifier_only_RAVDESS') == 2
+    assert run['params']['lr'] == 1e-3 and run['params']['SEED'] is None
+
+    registry.update_run(run['run_id'], saved=True, best_val_loss=0.3)
+    reopened = ModelRegistry(registry.registry_path)
+    assert reopened.get_run(model_path=run['model_path'])['best_val_loss'] == 0.3
+    assert reopened.saved_models() == [run['model_path']]
+
+    registry.compact()
+    assert sum(1 for _ in open(registry.registry_path)) == 2
+    assert ModelRegistry(registry.registry_path).runs == registry.runs
+
+
+def test_existing_model_folders_are_imported(tmp_path):
+    for folder in ('classifier_only_MELD_toy', 'classifier_only_MELD_toy_v2'):
+        model_dir = tmp_path / 'classifier_only_MELD_toy' / folder
+        model_dir.mkdir(parents=True)
+    (model_dir / 'best_model_classifier_only_MELD_toy.pth').write_bytes(b'weights')
+
+    registry = ModelRegistry.open(str(tmp_path))
+    assert registry.next_version('classifier_only_MELD_toy') == 3
+    runs = sorted(registry.runs.values(), key=lambda run: run['version'])
+    assert [(run['version'], run['saved']) for run in runs] == [(0, False), (2, True)]
+    assert runs[1]['MODEL'] == 'classifier_only' and runs[1]['DATA_NAME'] == 'MELD_toy'
+    assert ModelRegistry.open(str(tmp_path)) is registry
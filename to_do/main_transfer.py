@@ -16,6 +16,7 @@ from torch.utils.data import DataLoader
 
 from config import Config
 from data_utils import preprocess_data_meld
+from feature_extraction import resample
 import numpy as np
 import torch
 import torchaudio
@@ -90,7 +91,6 @@ class AudioDataset(torch.utils.data.Dataset):
         self.labels = labels
         self.feature_extractor = feature_extractor
         self.max_length = max_length
-        self.resampler = T.Resample(orig_freq=44100, new_freq=16000)
 
     def __len__(self):
         return len(self.audio_paths)
@@ -99,9 +99,8 @@ class AudioDataset(torch.utils.data.Dataset):
         audio_path = self.audio_paths[idx]
         waveform, sample_rate = torchaudio.load(audio_path)
         
-        # 리샘플링 적용
-        if sample_rate != 16000:
-            waveform = self.resampler(waveform)
+        # 리샘플링 적용 (파일의 실제 샘플레이트 기준, 커널은 레이트별로 캐시)
+        waveform = resample(waveform, sample_rate)
         
         waveform = waveform.squeeze()
 
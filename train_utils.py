@@ -1,16 +1,57 @@
 import torch
+import numpy as np
 from tqdm import tqdm
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-import wandb
 import os
-from collections import namedtuple
 from visualization import visualize_results
 from data_utils import get_logits_from_output
-def process_batch(model, batch, criterion, device, is_training=False):
+from checkpoint_utils import CheckpointWriter, model_state_dict, load_partial_state_dict
+from model_registry import ModelRegistry
+from rsa_utils import LayerSimilarity
+from activation_capture import ActivationCapture
+from figure_worker import FigureWorker
+def get_amp_dtype(config, device):
+    # None: full precision
+    device_type = torch.device(device).type
+    if config.AMP_DTYPE == 'bf16':
+        return torch.bfloat16
+    if config.AMP_DTYPE == 'fp16':
+        if device_type == 'cuda':
+            return torch.float16
+        print('fp16 autocast needs cuda; training in full precision.')
+    return None
+
+def autocast_context(config, device):
+    dtype = get_amp_dtype(config, device)
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+def make_grad_scaler(config, device):
+    # loss scaling only for fp16; a disabled scaler passes everything through
+    enabled = get_amp_dtype(config, device) == torch.float16
+    if hasattr(torch.amp, 'GradScaler'):
+        scaler = torch.amp.GradScaler('cuda', enabled=enabled)
+    else:
+        scaler = torch.cuda.amp.GradScaler(enabled=enabled)
+    if enabled and config.scaler_state:
+        scaler.load_state_dict(config.scaler_state)
+        print('Loading GradScaler info.')
+    return scaler
+
+def get_accumulation_steps(config):
+    if config.EFFECTIVE_BATCH_SIZE <= 0:
+        return 1
+    return max(1, config.EFFECTIVE_BATCH_SIZE // config.BATCH_SIZE)
+
+def process_batch(model, batch, criterion, device, is_training=False, return_logits=False):
     inputs = batch['audio'].to(device)
     labels = batch['label'].to(device)
     
-    outputs, penultimate_features = model(inputs)
+    # Hugging Face group-norm checkpoints (e.g. wav2vec2-base) are trained without attention_mask on zero padding;
+    # EmotionRecognitionWithWav2Vec takes the mask for pooling and makes that choice for its backbone itself
+    model_config = getattr(model, 'config', None)
+    if 'attention_mask' in batch and getattr(model_config, 'feat_extract_norm', 'layer') == 'layer':
+        outputs = model(inputs, attention_mask=batch['attention_mask'].to(device))
+    else:
+        outputs = model(inputs)
     try:
         logits = get_logits_from_output(outputs)
     except Exception as e:
@@ -29,21 +70,78 @@ def process_batch(model, batch, criterion, device, is_training=False):
         print("Warning: Hidden states not available. Using logits as embeddings.")
         penultimate_features = logits
     
-    loss = criterion(logits, labels)
+    loss = criterion(logits, labels) if criterion is not None else None
     _, preds = torch.max(logits, 1) 
     
+    if return_logits:
+        return loss, preds, labels, penultimate_features, logits
     return loss, preds, labels, penultimate_features
 
             
-def compute_metrics(all_preds, all_labels):
+class ConfusionMatrixMeter:
+    """
+    Streaming confusion matrix kept on the model's device (rows: true label, columns: prediction).
+
+    update() is one bincount per batch and never syncs with the host; metrics are
+    derived from the matrix once per epoch in compute(). Labels or predictions
+    outside 0..num_classes-1 are counted in an overflow bin instead of the matrix,
+    and compute() raises on them.
+    """
+    def __init__(self, num_classes, device):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+        self.n_invalid = torch.zeros((), dtype=torch.long, device=device)
+
+    def update(self, preds, labels):
+        preds, labels = preds.view(-1), labels.view(-1)
+        n_cells = self.num_classes ** 2
+        valid = (labels >= 0) & (labels < self.num_classes) & (preds >= 0) & (preds < self.num_classes)
+        counts = torch.bincount(torch.where(valid, labels * self.num_classes + preds, n_cells), minlength=n_cells + 1)
+        self.matrix += counts[:n_cells]
+        self.n_invalid += counts[n_cells]
+
+    def compute(self):
+        n_invalid = int(self.n_invalid)
+        if n_invalid:
+            raise ValueError(f"{n_invalid} labels or predictions outside 0..{self.num_classes - 1}: "
+                             f"num_classes ({self.num_classes}) does not match the data (LABELS_EMOTION?)")
+        return metrics_from_confusion(self.matrix.view(self.num_classes, self.num_classes))
+
+
+def metrics_from_confusion(cm):
+    # weighted by support, matching sklearn's average='weighted' with zero_division=0
+    cm = cm.double()
+    tp = cm.diag()
+    support = cm.sum(dim=1)
+    predicted = cm.sum(dim=0)
+    precision = torch.where(predicted > 0, tp / predicted.clamp(min=1), torch.zeros_like(tp))
+    recall = torch.where(support > 0, tp / support.clamp(min=1), torch.zeros_like(tp))
+    denom = precision + recall
+    f1 = torch.where(denom > 0, 2 * precision * recall / denom.clamp(min=1e-12), torch.zeros_like(tp))
+    weights = support / support.sum().clamp(min=1)
+    summary = torch.stack([tp.sum() / support.sum().clamp(min=1),
+                           (weights * precision).sum(), (weights * recall).sum(), (weights * f1).sum()]).tolist()
     return {
-        'accuracy': accuracy_score(all_labels, all_preds),
-        'precision': precision_score(all_labels, all_preds, average='weighted'),
-        'recall': recall_score(all_labels, all_preds, average='weighted'),
-        'f1': f1_score(all_labels, all_preds, average='weighted')
+        'accuracy': summary[0],
+        'precision': summary[1],
+        'recall': summary[2],
+        'f1': summary[3],
+        'per_class': {'precision': precision.tolist(), 'recall': recall.tolist(),
+                      'f1': f1.tolist(), 'support': support.long().tolist()},
     }
 
+
+def compute_metrics(all_preds, all_labels, num_classes=None):
+    preds = torch.as_tensor(np.asarray(all_preds), dtype=torch.long)
+    labels = torch.as_tensor(np.asarray(all_labels), dtype=torch.long)
+    if num_classes is None:
+        num_classes = int(max(preds.max(), labels.max())) + 1
+    meter = ConfusionMatrixMeter(num_classes, 'cpu')
+    meter.update(preds, labels)
+    return meter.compute()
+
 def evaluate_baseline(model, X_test, y_test, config):
+    from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
     y_pred = model.predict(X_test)
     accuracy = accuracy_score(y_test, y_pred)
     precision = precision_score(y_test, y_pred, average=config.METRIC_AVG)
@@ -54,13 +152,19 @@ def evaluate_baseline(model, X_test, y_test, config):
 
 
 def load_checkpoint(config, model, optimizer, device):
+    import wandb
     ckpt_path=config.CKPT_SAVE_PATH
     if os.path.exists(ckpt_path):
         checkpoint = torch.load(ckpt_path, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        load_partial_state_dict(model, checkpoint['model_state_dict'], # may be trainable-only
+                                pretrained=checkpoint.get('pretrained'), model_pretrained=config.path_pretrained)
         if optimizer is not None:
-            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-            print('Loading Optimizer info. ')
+            try:
+                optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+                print('Loading Optimizer info. ')
+            except ValueError as e:
+                # param groups follow the trainable set; a checkpoint from another freeze setting does not fit
+                print(f'Optimizer state not loaded ({e}); starting with a fresh optimizer.')
         if config.SCHEDULER: # chk
             print('Scheduler on.')
             ### Scheduler    
@@ -73,6 +177,8 @@ def load_checkpoint(config, model, optimizer, device):
                 print('Loading Scheduler info.')
             
         
+        config.scaler_state = checkpoint.get('scaler_state_dict')
+        
         global_epoch=checkpoint['global_epoch']
 
         print(f'Previously, total number of epoch: {global_epoch} was trained.')
@@ -94,7 +200,8 @@ def load_checkpoint(config, model, optimizer, device):
         return model, optimizer, 0, 0, wandb.util.generate_id()
     
 
-def train_model(model, train_loader, val_loader, config, device, optimizer, criterion):
+def train_model(model, train_loader, val_loader, config, device, optimizer, criterion, epoch_callback=None):
+    import wandb
     best_val_loss = 1000
     best_val_acc=0.0
     early_stop_counter = 0
@@ -113,131 +220,218 @@ def train_model(model, train_loader, val_loader, config, device, optimizer, crit
         eta_min = config.eta_min 
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=T_max, eta_min=eta_min)
     
+    scaler = make_grad_scaler(config, device)
+    
     progress_bar = tqdm(range(start_epoch+1, end_epoch+1), desc="[ Total Epoch Progress ]")
 
-    for epoch in progress_bar:
-        global_epoch+=1
-        config.global_epoch=global_epoch
-        #print(f'global epoch updated: {global_epoch}')
-        train_metrics = train_epoch(config, model, train_loader, criterion, optimizer, device) #train
-        val_metrics = evaluate_model(config, model, val_loader, criterion, device) #val
-        # Update history
-        for i, metric in enumerate(['loss', 'accuracy', 'precision', 'recall', 'f1']):
-            history['train'][metric].append(train_metrics[i])
-            history['val'][metric].append(val_metrics[i])
+    writer = CheckpointWriter.from_config(config)
+    figure_worker = None # started at the first figure epoch
+    try:
+        for epoch in progress_bar:
+            global_epoch+=1
+            config.global_epoch=global_epoch
+            #print(f'global epoch updated: {global_epoch}')
+            train_metrics = train_epoch(config, model, train_loader, criterion, optimizer, device, scaler) #train
+            # on figure epochs the validation pass also keeps what the figures need
+            val_outputs = {} if global_epoch % config.N_STEP_FIG == 0 else None
+            val_metrics = evaluate_model(config, model, val_loader, criterion, device, outputs=val_outputs) #val
+            # Update history
+            for i, metric in enumerate(['loss', 'accuracy', 'precision', 'recall', 'f1']):
+                history['train'][metric].append(train_metrics[i])
+                history['val'][metric].append(val_metrics[i])
         
-        print(f"Train - Loss: {train_metrics[0]:.4f}, Accuracy: {train_metrics[1]:.4f}, F1: {train_metrics[4]:.4f}")
-        print(f"Val - Loss: {val_metrics[0]:.4f}, Accuracy: {val_metrics[1]:.4f}, F1: {val_metrics[4]:.4f}")
+            print(f"Train - Loss: {train_metrics[0]:.4f}, Accuracy: {train_metrics[1]:.4f}, F1: {train_metrics[4]:.4f}")
+            print(f"Val - Loss: {val_metrics[0]:.4f}, Accuracy: {val_metrics[1]:.4f}, F1: {val_metrics[4]:.4f}")
         
         
-        ######
-        #Log metrics chk
-        log_metrics('train', train_metrics, global_epoch)
-        log_metrics('val', val_metrics[:5], global_epoch)  # val_metrics might have 7 values, we only need first 5
+            ######
+            #Log metrics chk
+            log_metrics('train', train_metrics, global_epoch)
+            log_metrics('val', val_metrics[:5], global_epoch)  # val_metrics might have 7 values, we only need first 5
         
-        if global_epoch % config.N_STEP_FIG ==0: # visualization for val data
-            try:
-                visualize_results(config, model, val_loader, device, history, 'val')
-            except Exception as e:
-                print(f"Error during visualization: {e}") 
+            if val_outputs is not None: # visualization for val data
+                try:
+                    if figure_worker is None and config.ASYNC_FIGURES:
+                        figure_worker = FigureWorker.from_config(config)
+                    visualize_results(config, model, val_loader, device, history, 'val', outputs=val_outputs, worker=figure_worker)
+                except Exception as e:
+                    print(f"Error during visualization: {e}") 
             
             
-        if config.SCHEDULER:
-            scheduler.step()#val_metrics[0]) #[0] val loss
+            if config.SCHEDULER:
+                scheduler.step()#val_metrics[0]) #[0] val loss
         
-        print(f'Val loss/Best val loss:{val_metrics[0]:.4f}/{best_val_loss:.4f}')
-        if val_metrics[0] < best_val_loss: #accuracy:  # val_metrics[1] is accuracy
-            best_val_loss = val_metrics[0]
-            # torch.save(model.state_dict(), config.MODEL_SAVE_PATH)
-            # print(f"Best model saved to {config.MODEL_SAVE_PATH}")
-            early_stop_counter = 0 # reset
-        else:
-            early_stop_counter+=1
-        print(f'Val acc/Best val acc:{val_metrics[1]:.4f}/{best_val_acc:.4f}')
-        if val_metrics[1] > best_val_acc:
-            best_val_acc = val_metrics[1]
-            torch.save(model.state_dict(), config.MODEL_SAVE_PATH)
-            print(f"New Best Model with higher accuracy found.\nBest model saved to {config.MODEL_SAVE_PATH}")
+            print(f'Val loss/Best val loss:{val_metrics[0]:.4f}/{best_val_loss:.4f}')
+            if val_metrics[0] < best_val_loss: #accuracy:  # val_metrics[1] is accuracy
+                best_val_loss = val_metrics[0]
+                # torch.save(model.state_dict(), config.MODEL_SAVE_PATH)
+                # print(f"Best model saved to {config.MODEL_SAVE_PATH}")
+                early_stop_counter = 0 # reset
+            else:
+                early_stop_counter+=1
+            print(f'Val acc/Best val acc:{val_metrics[1]:.4f}/{best_val_acc:.4f}')
+            if val_metrics[1] > best_val_acc:
+                best_val_acc = val_metrics[1]
+                writer.save(model.state_dict(), config.MODEL_SAVE_PATH) # full: loadable without the pretrained weights
+                print(f"New Best Model with higher accuracy found.\nBest model saved to {config.MODEL_SAVE_PATH}")
             
-        # Save checkpoint
-        ckpt = {
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'best_val_loss': best_val_loss,
-            'id_wandb': wandb.run.id,
-            'global_epoch': global_epoch
-        }
-        if config.IS_SWEEP:
-            print(f'Sweep is finished. ID is saved: {config.sweep_id}')
-            ckpt['sweep_id']=config.sweep_id
-        if config.SCHEDULER: #chk
-            ckpt['scheduler_state_dict']= scheduler.state_dict()
-            current_lr = optimizer.param_groups[0]['lr']
-            print(f"Current learning rate: {current_lr}")
-            wandb.log({"learning_rate": current_lr}, step=global_epoch)
+            # Save checkpoint
+            ckpt = {
+                'model_state_dict': model_state_dict(model, config.CKPT_TRAINABLE_ONLY),
+                'trainable_only': config.CKPT_TRAINABLE_ONLY,
+                'pretrained': config.path_pretrained, # the frozen weights a trainable-only state dict relies on
+                'optimizer_state_dict': optimizer.state_dict(),
+                'best_val_loss': best_val_loss,
+                'id_wandb': wandb.run.id,
+                'global_epoch': global_epoch
+            }
+            if scaler.is_enabled():
+                ckpt['scaler_state_dict'] = scaler.state_dict()
+            if config.IS_SWEEP:
+                print(f'Sweep is finished. ID is saved: {config.sweep_id}')
+                ckpt['sweep_id']=config.sweep_id
+            if config.SCHEDULER: #chk
+                ckpt['scheduler_state_dict']= scheduler.state_dict()
+                current_lr = optimizer.param_groups[0]['lr']
+                print(f"Current learning rate: {current_lr}")
+                wandb.log({"learning_rate": current_lr}, step=global_epoch)
             
-        torch.save(ckpt, config.CKPT_SAVE_PATH)
+            writer.save(ckpt, config.CKPT_SAVE_PATH, tag=global_epoch) # CPU snapshot now, written in the background
 
-        print(f"Checkpoint saved to {config.CKPT_SAVE_PATH} at global epoch: {global_epoch}\n{ckpt['id_wandb']}\n")
+            print(f"Checkpoint queued to {config.CKPT_SAVE_PATH} at global epoch: {global_epoch}\n{ckpt['id_wandb']}\n")
             
         
-        if early_stop_counter >= config.early_stop_epoch:
-            print("Early Stopping!")
-            break
+            if early_stop_counter >= config.early_stop_epoch:
+                print("Early Stopping!")
+                break
+            # e.g. a sweep scheduler: called with the epoch's metrics, returns True to stop this run
+            if epoch_callback is not None and epoch_callback(global_epoch, train_metrics, val_metrics):
+                print(f"Stopped by epoch_callback at global epoch {global_epoch}.")
+                break
+            if figure_worker is not None:
+                figure_worker.poll() # log the figures rendered in the background so far
+    finally:
+        writer.close() # every queued checkpoint is on disk before returning
+        if figure_worker is not None:
+            figure_worker.close()
     
+    if config.RUN_ID and best_val_acc > 0:
+        ModelRegistry.from_config(config).update_run(config.RUN_ID, saved=True, model_path=config.MODEL_SAVE_PATH,
+                                                     best_val_loss=float(best_val_loss), best_val_acc=float(best_val_acc),
+                                                     global_epoch=global_epoch)
     return history, best_val_loss, best_val_acc
 
 
 
-def train_epoch(config, model, dataloader, criterion, optimizer, device):
+def train_epoch(config, model, dataloader, criterion, optimizer, device, scaler=None):
+    """
+    One pass over dataloader. With AMP_DTYPE the forward runs under autocast; with
+    EFFECTIVE_BATCH_SIZE gradients of several micro-batches are summed before each
+    optimizer step (a shorter group at the end of the epoch is stepped too).
+    """
     model.train()
-    running_loss = 0.0
-    all_preds = []
-    all_labels = []
+    running_loss = torch.zeros((), device=device)
+    meter = ConfusionMatrixMeter(len(config.LABELS_EMOTION), device)
+    if scaler is None:
+        scaler = make_grad_scaler(config, device)
+    accumulation_steps = get_accumulation_steps(config)
+    n_batches = len(dataloader)
     
+    EvaluationResult = config.EvaluationResult
+    
+    optimizer.zero_grad()
     progress_bar = tqdm(dataloader, desc="Training")
-    for batch in progress_bar:
+    for i, batch in enumerate(progress_bar):
         
-        optimizer.zero_grad()
-        loss, preds, labels, _ = process_batch(model, batch, criterion, device, is_training=True)
+        with autocast_context(config, device):
+            loss, preds, labels, _ = process_batch(model, batch, criterion, device, is_training=True)
         
-        loss.backward()
+        group_start = i - i % accumulation_steps
+        group_size = min(accumulation_steps, n_batches - group_start)
+        scaler.scale(loss / group_size).backward()
         
-        optimizer.step()
+        if (i + 1) % accumulation_steps == 0 or i + 1 == n_batches:
+            if config.GRADIENT_CLIP:
+                scaler.unscale_(optimizer) # clip the true gradients, not the scaled ones
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=config.GRAD_CLIP_NORM)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
 
-        running_loss += loss.item()
-        all_preds.extend(preds.cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
+        running_loss += loss.detach()
+        meter.update(preds, labels)
                 
-    epoch_loss = running_loss / len(dataloader)
-    metrics = compute_metrics(all_preds, all_labels)
-   
+    epoch_loss = running_loss.item() / n_batches
+    metrics = meter.compute()
     
-    return epoch_loss, metrics
+    return EvaluationResult(epoch_loss, metrics['accuracy'], metrics['precision'],
+                            metrics['recall'], metrics['f1'], None, None, metrics['per_class'])
 
-def evaluate_model(config, model, dataloader, criterion, device):
+def evaluate_model(config, model, dataloader, criterion, device, outputs=None):
+    """
+    With an `outputs` dict, the same pass also fills it (on CPU) with 'labels',
+    'predictions', 'logits', 'embeddings' (penultimate features, one row per
+    sample) and 'layer_similarity' (rsa_utils.LayerSimilarity of the layers
+    selected by ACTIVATION_LAYERS / SIMILARITY_LAYERS, reduced by ActivationCapture,
+    over the first SIMILARITY_BATCHES batches), which visualize_results
+    uses instead of running the model again.
+    With criterion=None the loss is not computed (nan).
+    """
     model.eval()
-    running_loss = 0.0
+    running_loss = torch.zeros((), device=device)
+    meter = ConfusionMatrixMeter(len(config.LABELS_EMOTION), device)
     all_preds = []
     all_labels = []
+    all_logits = []
+    all_embeddings = []
+    similarity = LayerSimilarity(config.LAYER_SIMILARITY)
+    capture = ActivationCapture.from_config(config, model)
+    if outputs is not None:
+        capture.attach()
     
     EvaluationResult = config.EvaluationResult
     
-    with torch.no_grad():
-        for batch in tqdm(dataloader, desc="Evaluating"):
-            loss, preds, labels, _ = process_batch(model, batch, criterion, device)
-            
-            running_loss += loss.item()
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-    eval_loss = running_loss / len(dataloader)
-    metrics = compute_metrics(all_preds, all_labels)
+    try:
+        with torch.no_grad():
+            for i, batch in enumerate(tqdm(dataloader, desc="Evaluating")):
+                with autocast_context(config, device):
+                    loss, preds, labels, penultimate_features, logits = process_batch(model, batch, criterion, device, return_logits=True)
+                
+                if loss is not None:
+                    running_loss += loss
+                meter.update(preds, labels)
+                all_preds.append(preds) # kept on device, copied once below
+                all_labels.append(labels)
+                if outputs is not None:
+                    if penultimate_features.dim() > 2:
+                        penultimate_features = penultimate_features.mean(dim=1) # 시퀀스 차원에 대해 평균 계산
+                    all_logits.append(logits.float())
+                    all_embeddings.append(penultimate_features.float())
+                activations = capture.pop_batch()
+                if activations:
+                    similarity.update(activations) # reduced to layers x layers right away
+                    if config.SIMILARITY_BATCHES and i + 1 >= config.SIMILARITY_BATCHES:
+                        capture.detach()
+    finally:
+        capture.detach()
+    eval_loss = running_loss.item() / len(dataloader) if criterion is not None else float('nan')
+    metrics = meter.compute()
+    all_preds = torch.cat(all_preds).cpu().numpy()
+    all_labels = torch.cat(all_labels).cpu().numpy()
+    
+    if outputs is not None:
+        outputs['labels'] = all_labels
+        outputs['predictions'] = all_preds
+        outputs['logits'] = torch.cat(all_logits).cpu().numpy()
+        outputs['embeddings'] = torch.cat(all_embeddings).cpu().numpy()
+        outputs['layer_similarity'] = similarity.result()
     
     return EvaluationResult(eval_loss, metrics['accuracy'], metrics['precision'],
-                            metrics['recall'], metrics['f1'], all_labels, all_preds)
+                            metrics['recall'], metrics['f1'], all_labels, all_preds, metrics['per_class'])
 
 
 def log_metrics(stage, stage_metrics, epoch):
+    import wandb
     metrics = ['loss', 'accuracy', 'precision', 'recall', 'f1']
     log_dict = {
         stage: {metric: value for metric, value in zip(metrics, stage_metrics)},
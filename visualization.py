@@ -1,27 +1,11 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.metrics import confusion_matrix
-from sklearn.manifold import TSNE
-
-from scipy.spatial.distance import cosine
-from scipy.stats import spearmanr
-import pandas as pd
-from tqdm import tqdm
 import os
 
-import wandb
-from collections import OrderedDict, Counter
-
-from transformers.modeling_outputs import SequenceClassifierOutput
-import torch.nn.functional as F
 import torch
 
-from data_utils import get_logits_from_output
-import torch
-import torch.nn.functional as F
-from train_utils import process_batch
+# matplotlib, seaborn, pandas, sklearn, wandb and projection (sklearn's t-SNE) are
+# imported where they are used: train_utils imports this module, and with a
+# FigureWorker only the worker process renders figures.
 
 
 def get_embeddings(model, data_loader):
@@ -39,211 +23,147 @@ def get_embeddings(model, data_loader):
             labels.extend(batch_labels)
     
     return torch.cat(embeddings), labels
-def compute_layer_similarity(activations):
-    layer_names = list(activations.keys())
-    n_layers = len(layer_names)
-    similarity_matrix = np.zeros((n_layers, n_layers))
-    
-    for i in range(n_layers):
-        for j in range(n_layers):
-            act_i = activations[layer_names[i]]
-            act_j = activations[layer_names[j]]
-            
-            # 각 활성화를 2D로 평탄화
-            flat_i = act_i.view(act_i.size(0), -1)
-            flat_j = act_j.view(act_j.size(0), -1)
-            
-            # 정규화
-            norm_i = torch.norm(flat_i, p=2, dim=1, keepdim=True)
-            norm_j = torch.norm(flat_j, p=2, dim=1, keepdim=True)
-            flat_i_normalized = flat_i / (norm_i + 1e-8)
-            flat_j_normalized = flat_j / (norm_j + 1e-8)
-            
-            # 코사인 유사도 계산
-            similarity = F.cosine_similarity(flat_i_normalized.unsqueeze(1), flat_j_normalized.unsqueeze(0))
-            
-            # 평균 유사도 계산
-            similarity_matrix[i, j] = similarity.mean().item()
-    
-    return similarity_matrix, layer_names
-
-def get_flattened_shape(tensor_shape):
-    return int(np.prod(tensor_shape[1:]))  # 배치 차원을 제외한 나머지를 곱함
-
-def get_most_common_layers(model, inputs, num_layers=5, select_all_common=False):
-    activations = OrderedDict()
-    
-    def hook(name):
-        def hook_fn(module, input, output):
-            if isinstance(output, torch.Tensor):
-                activations[name] = output.detach()
-            elif isinstance(output, tuple) and isinstance(output[0], torch.Tensor):
-                activations[name] = output[0].detach()
-        return hook_fn
-
-    hooks = []
-    for name, module in model.named_modules():
-        if isinstance(module, (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d)):
-            hooks.append(module.register_forward_hook(hook(name)))
-
-    with torch.no_grad():
-        _ = model(inputs)
-
-    for h in hooks:
-        h.remove()
-
-    # 레이어 flattened shape 카운트
-    
-    try:
-        shape_counts = Counter(get_flattened_shape(act.shape) for act in activations.items())
-    except:
-        shape_counts = Counter(get_flattened_shape(act.shape) for act in activations.values())
-    
-    # 가장 흔한 flattened shape 찾기
-    most_common_shape = shape_counts.most_common(1)[0][0]
-    most_common_count = shape_counts[most_common_shape]
-    
-    matching_layers = OrderedDict()
-    try:
-        for name, act in reversed(list(activations.items())):
-            if get_flattened_shape(act.shape) == most_common_shape:
-                matching_layers[name] = act
-                if not select_all_common and len(matching_layers) == num_layers:
-                    break
-    except:
-        for name, act in reversed(list(activations.values())):
-            if get_flattened_shape(act.shape) == most_common_shape:
-                matching_layers[name] = act
-                if not select_all_common and len(matching_layers) == num_layers:
-                    break
-    print(f"Most common flattened shape: {most_common_shape}")
-    print(f"Matching layers found ({len(matching_layers)}): {list(matching_layers.keys())}")
-    return matching_layers, most_common_shape
-
-def perform_rsa(model, data_loader, device, num_layers=5, select_all_common=False):
-    model.eval()
-    
-    try:
-        for batch in data_loader:
-            inputs = batch['audio'].to(device)
-            if inputs.dim() == 4:
-                inputs = inputs.squeeze(2)
-            if inputs.dim() == 3:
-                inputs = inputs.squeeze(1)
-            
-            print("Input shape:", inputs.shape)
-            
-            matching_activations, most_common_shape = get_most_common_layers(model, inputs, num_layers, select_all_common)
-            break  # 첫 번째 배치만 사용
-
-        print("Matching activations shapes:", {k: v.shape for k, v in matching_activations.items()})
-
-        if len(matching_activations) < 2:
-            print("Error: Not enough matching layers for RSA. At least 2 layers are required.")
-            return None
-
-        similarity_matrix, layer_names = compute_layer_similarity(matching_activations)
 
-        plt.figure(figsize=(12, 10))
-        sns.heatmap(similarity_matrix, annot=True, cmap='coolwarm', 
-                    xticklabels=layer_names, yticklabels=layer_names)
-        plt.title(f"Layer-wise Representation Similarity Analysis\n({len(layer_names)} layers, flattened shape: {most_common_shape})")
-        plt.xticks(rotation=45, ha='right')
-        plt.yticks(rotation=45)
-        plt.tight_layout()
+def plot_layer_similarity(similarity_matrix, layer_names, method='cka', n_samples=None, n_batches=None):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    plt.figure(figsize=(12, 10))
+    sns.heatmap(similarity_matrix, annot=len(layer_names) <= 16, fmt='.2f', cmap='coolwarm',
+                xticklabels=layer_names, yticklabels=layer_names)
+    name = {'cka': 'linear CKA', 'rsa': 'RDM Spearman correlation'}[method]
+    plt.title(f"Layer-wise Representation Similarity Analysis\n({len(layer_names)} layers, {name}, {n_samples} samples)")
+    plt.xticks(rotation=45, ha='right')
+    plt.yticks(rotation=45)
+    plt.tight_layout()
+    return plt.gcf()
+
+def save_figure(fig, fig_path):
+    import matplotlib.pyplot as plt
+    os.makedirs(os.path.dirname(fig_path), exist_ok=True)
+    fig.savefig(fig_path)
+    plt.close(fig)
+    print('Figure saved at: ', fig_path)
 
-        return plt.gcf()
-    
-    except Exception as e:
-        print(f"An error occurred during RSA: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return None
+def log_figure(stage, name, fig_path, title, step=None):
+    import wandb
+    if wandb.run is not None:
+        wandb.log({stage:{f"{name}": wandb.Image(fig_path, caption=title)}}, step=step)
 
 def save_and_log_figure(stage, fig, config, name, title):
     """Save figure to file and log to wandb"""
     fig_path = os.path.join(config.MODEL_RESULTS, f"{name}_{config.global_epoch}.png")
-    fig.savefig(fig_path)
-    print('Figure saved at: ', fig_path)
-    wandb.log({stage:{f"{name}": wandb.Image(fig_path, caption=title)}}, step=config.global_epoch)
-    plt.close(fig)
-    
-def visualize_results(config, model, data_loader, device, log_data, stage):
-    print('\n[Visualization]\n')
-
-    # Confusion Matrix and Embeddings visualization for all stages
-    model.eval()
-    all_preds = []
-    all_labels = []
-    all_embeddings = []
-
-    with torch.no_grad():
-        for batch in tqdm(data_loader, desc="Preparing data for Visualizing..."):
-            _, preds, labels, penultimate_features = process_batch(model, batch, None, device)
-            
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-            all_embeddings.extend(penultimate_features.cpu().numpy())
-            #activations = get_all_layer_activations(model, inputs)
-            
-            
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-            if len(penultimate_features.shape) > 2:
-                penultimate_features = penultimate_features.mean(dim=1)  # 시퀀스 차원에 대해 평균 계산
-            all_embeddings.extend(penultimate_features.cpu().numpy())
-            
-            
-
-    # Confusion Matrix
-    # Convert lists to numpy arrays
-    all_preds = np.array(all_preds)
-    all_labels = np.array(all_labels)
-    all_embeddings = np.array(all_embeddings)
-    
-    fig_cm = plot_confusion_matrix(all_labels, all_preds, config.LABELS_EMOTION)
-    save_and_log_figure(stage, fig_cm, config, "confusion_matrix", f"{stage} Confusion Matrix")
+    save_figure(fig, fig_path)
+    log_figure(stage, name, fig_path, title, step=config.global_epoch)
+
+def make_figure_jobs(config, outputs, log_data, stage):
+    """
+    The data of each figure as plain arrays (picklable, small): the rendering
+    itself (t-SNE, matplotlib) is left to render_figure, inline or in a FigureWorker.
+    """
+    labels = outputs['labels']
+    jobs = []
+    def add(kind, name, title, **data):
+        jobs.append({'kind': kind, 'stage': stage, 'name': name, 'title': title, 'epoch': config.global_epoch,
+                     'path': os.path.join(config.MODEL_RESULTS, f"{name}_{config.global_epoch}.png"), 'data': data})
+
+    add('confusion_matrix', "confusion_matrix", f"{stage} Confusion Matrix",
+        labels=labels, preds=outputs['predictions'], labels_emotion=dict(config.LABELS_EMOTION))
 
     # Embeddings visualization
+    embeddings = outputs['embeddings']
     max_samples = config.N_EMBEDDINGS # to show
-    
-    if len(all_embeddings) > max_samples:
-        indices = np.random.choice(len(all_embeddings), max_samples, replace=False)
-        all_embeddings = all_embeddings[indices]
-        all_labels = all_labels[indices]
-    
-    try:
-        fig_embd = visualize_embeddings(config, all_embeddings, all_labels)
-    
-        save_and_log_figure(stage, fig_embd, config, "Embeddings", f"{stage.capitalize()} Embeddings (t-SNE)")
-    except:
-        print('No embedding.')   
-         
-    try:
-        fig_rsa = perform_rsa(model, data_loader, config.device, num_layers=10, select_all_common=False)
-        save_and_log_figure(stage, fig_rsa, config, "Representation similarity", f"{stage.capitalize()}")
-        
-    except:
-        print('(Err)RSA\n')
-    
-    try:
-        fig_metric = plot_learning_curves(log_data)
-        save_and_log_figure(stage, fig_metric, config, "Learning curve", f"{stage.capitalize()}")
-    except:
-        print('(Err) learning curve\n')
-    
-def visualize_embeddings(config, embeddings, labels, method='tsne'):
-    print('\n\nVisualization of embedding...\n')
-    if method == 'pca':
-        reducer = PCA(n_components=2)
-    elif method == 'tsne':
-        reducer = TSNE(n_components=2, random_state=42)
-    else:
-        raise ValueError("Invalid method. Use 'pca' or 'tsne'.")
+    embedding_labels = labels
+    indices = np.arange(len(embeddings))
+    if len(embeddings) > max_samples:
+        # the same samples every epoch, so the projection can start from the previous layout
+        indices = np.sort(np.random.default_rng(config.SEED).choice(len(embeddings), max_samples, replace=False))
+        embeddings = embeddings[indices]
+        embedding_labels = labels[indices]
+    method = config.EMBEDDING_PROJECTION
+    add('embeddings', "Embeddings", f"{stage.capitalize()} Embeddings ({method})",
+        embeddings=embeddings, labels=embedding_labels, labels_emotion=dict(config.LABELS_EMOTION),
+        sample_ids=indices, projector=projection_settings(config))
+
+    # layer similarity accumulated during the evaluation pass: a small matrix instead of the activations themselves
+    similarity = outputs.get('layer_similarity')
+    if similarity is not None:
+        if len(similarity['layer_names']) < 2:
+            print("Error: Not enough layers for RSA. At least 2 layers are required.")
+        else:
+            add('rsa', "Representation similarity", f"{stage.capitalize()}", **similarity)
+
+    if log_data is not None:
+        history = {split: {metric: list(values) for metric, values in log_data[split].items()} for split in ('train', 'val')}
+        add('learning_curve', "Learning curve", f"{stage.capitalize()}", history=history)
+    return jobs
+
+def render_figure(job):
+    data = job['data']
+    if job['kind'] == 'confusion_matrix':
+        return plot_confusion_matrix(data['labels'], data['preds'], data['labels_emotion'])
+    elif job['kind'] == 'embeddings':
+        return visualize_embeddings(None, data['embeddings'], data['labels'], labels_emotion=data['labels_emotion'],
+                                    sample_ids=data['sample_ids'], projector_key=job['stage'], **data['projector'])
+    elif job['kind'] == 'rsa':
+        return plot_layer_similarity(**data)
+    elif job['kind'] == 'learning_curve':
+        return plot_learning_curves(data['history'])
+    raise ValueError(f"Unknown figure: {job['kind']}")
+
+def visualize_results(config, model, data_loader, device, log_data, stage, outputs=None, worker=None):
+    """
+    Confusion matrix, embeddings, layer similarity and learning curves.
+    `outputs` is the dict filled by evaluate_model(..., outputs=outputs) during
+    an evaluation pass over data_loader; without it that pass is run here.
+    With a FigureWorker the figures are rendered and logged in the background.
+    """
+    print('\n[Visualization]\n')
 
-    reduced_embeddings = reducer.fit_transform(embeddings)
+    if outputs is None:
+        from train_utils import evaluate_model # train_utils imports this module
+        outputs = {}
+        evaluate_model(config, model, data_loader, None, device, outputs=outputs)
+
+    jobs = make_figure_jobs(config, outputs, log_data, stage)
+    if worker is not None:
+        for job in jobs:
+            worker.submit(job)
+        return
+    for job in jobs:
+        try:
+            fig = render_figure(job)
+            save_figure(fig, job['path'])
+            log_figure(job['stage'], job['name'], job['path'], job['title'], step=job['epoch'])
+        except Exception as e:
+            print(f"(Err) {job['name']}: {e}\n")
+    
+def projection_settings(config):
+    return {'method': config.EMBEDDING_PROJECTION, 'pca_dims': config.PROJECTION_PCA_DIMS,
+            'refit_pca_every': config.PROJECTION_REFIT_PCA_EVERY, 'warm_start': config.PROJECTION_WARM_START,
+            'seed': config.SEED}
+
+def visualize_embeddings(config, embeddings, labels, method=None, labels_emotion=None, sample_ids=None,
+                         projector_key='embeddings', **settings):
+    """
+    2-D projection (projection.EmbeddingProjector) of the embeddings, coloured by label.
+    The projector is kept per projector_key, so with the same sample_ids on the next
+    call the layout is warm-started from this one.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import pandas as pd
+    from projection import get_projector
+    print('\n\nVisualization of embedding...\n')
+    if config is not None:
+        settings = {**projection_settings(config), **settings}
+    if method is not None:
+        settings['method'] = method
+    projector = get_projector(projector_key, **settings)
+    reduced_embeddings = projector.fit_transform(embeddings, sample_ids=sample_ids)
 
-    string_labels = [config.LABELS_EMOTION.get(int(label), f"Unknown_{label}") for label in labels]
+    if labels_emotion is None:
+        labels_emotion = config.LABELS_EMOTION
+    string_labels = [labels_emotion.get(int(label), f"Unknown_{label}") for label in labels]
 
     #string_labels = [config.LABELS_EMOTION.get(str(int(label)), f"Unknown_{label}") for label in labels]
     df = pd.DataFrame({
@@ -254,12 +174,15 @@ def visualize_embeddings(config, embeddings, labels, method='tsne'):
 
     fig, ax = plt.subplots(figsize=(10, 8))
     sns.scatterplot(data=df, x='x', y='y', hue='label', palette="deep", legend="full", ax=ax)
-    ax.set_title(f"{method.upper()} of Emotion Recognition Embeddings")
+    timings = projector.timings
+    ax.set_title(f"{projector.method.upper()} of Emotion Recognition Embeddings\n"
+                 f"(PCA {timings['pca']:.2f} s, layout {timings['layout']:.2f} s{', warm start' if timings['warm_start'] else ''})")
     
     return fig
 
 
 def plot_learning_curves(history):
+    import matplotlib.pyplot as plt
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 12))
     
     epochs = range(1, len(history['train']['loss']) + 1)
@@ -282,6 +205,9 @@ def plot_learning_curves(history):
     return fig
 
 def plot_confusion_matrix(labels, preds, labels_emotion, normalize=True):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from sklearn.metrics import confusion_matrix
     cm = confusion_matrix(labels, preds)
     if normalize:
         cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
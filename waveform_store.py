@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from feature_extraction import load_waveforms_16k, TARGET_SAMPLE_RATE
+
+
+def store_signature(file_paths):
+    # a store is valid for exactly this set of files at these mtimes
+    hasher = hashlib.sha1()
+    for path in sorted(set(os.path.abspath(p) for p in file_paths)):
+        hasher.update(f"{path}|{os.path.getmtime(path)}\n".encode('utf-8'))
+    return hasher.hexdigest()[:16]
+
+
+class WaveformStore:
+    """
+    Decoded 16 kHz mono audio of a whole dataset in one contiguous float16 file.
+
+    waveforms.f16 holds every clip back to back and is opened as a read-only
+    np.memmap; offsets.npy (N+1 entries) delimits clip i as
+    waveforms[offsets[i]:offsets[i+1]]. meta.json lists the source paths and is
+    written last, so its presence marks a complete store.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.paths = meta['paths']
+        self.sample_rate = meta['sample_rate']
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        self._waveforms = None
+
+    @property
+    def waveforms(self):
+        # opened lazily so DataLoader workers map the file themselves
+        if self._waveforms is None:
+            self._waveforms = np.memmap(os.path.join(self.store_dir, 'waveforms.f16'), dtype=np.float16, mode='r')
+        return self._waveforms
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_waveforms'] = None
+        return state
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, file_path):
+        return os.path.abspath(file_path) in self.index
+
+    def get(self, file_path):
+        i = self.index[os.path.abspath(file_path)]
+        return self.waveforms[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_lengths(self, file_paths):
+        idx = np.array([self.index[os.path.abspath(path)] for path in file_paths])
+        return self.offsets[idx + 1] - self.offsets[idx]
+
+    @staticmethod
+    def build(file_paths, store_dir, n_workers=1, chunk_size=16):
+        paths = sorted(set(os.path.abspath(p) for p in file_paths))
+        os.makedirs(store_dir, exist_ok=True)
+        data_path = os.path.join(store_dir, 'waveforms.f16')
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+
+        print(f'Building waveform store for {len(paths)} files: {store_dir}')
+        with ProcessPoolExecutor(max_workers=max(1, n_workers)) as pool, open(data_path + '.tmp', 'wb') as f:
+            # each job decodes a chunk and resamples its equal-rate clips together
+            chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+            i = 0
+            with tqdm(total=len(paths), desc="Decoding audio") as progress_bar:
+                for waveforms in pool.map(load_waveforms_16k, chunks):
+                    for waveform in waveforms:
+                        f.write(waveform.astype(np.float16).tobytes())
+                        offsets[i + 1] = offsets[i] + len(waveform)
+                        i += 1
+                    progress_bar.update(len(waveforms))
+        os.replace(data_path + '.tmp', data_path)
+        np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+            json.dump({'paths': paths, 'sample_rate': TARGET_SAMPLE_RATE}, f)
+        print(f'Waveform store: {offsets[-1] / TARGET_SAMPLE_RATE / 3600:.2f} h of audio, {offsets[-1] * 2 / 2**20:.0f} MB')
+        return WaveformStore(store_dir)
+
+    @classmethod
+    def open_or_build(cls, file_paths, base_dir, n_workers=1):
+        store_dir = os.path.join(base_dir, store_signature(file_paths))
+        if os.path.exists(os.path.join(store_dir, 'meta.json')):
+            return cls(store_dir)
+        return cls.build(file_paths, store_dir, n_workers=n_workers)
+
+    @classmethod
+    def from_config(cls, config, file_paths):
+        """Open the store for these files under DATA_FULL_DIR/waveform_store, building it once if needed."""
+        return cls.open_or_build(file_paths, os.path.join(config.DATA_FULL_DIR, 'waveform_store'), config.EXTRACT_NUM_WORKERS)